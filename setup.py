@@ -78,13 +78,16 @@ setup(
             'pytest-xdist',
             'pytest-cov',
         ],
-        docs=['Sphinx', ]
+        docs=['Sphinx', ],
+        brotli=['brotli', ],
     ),
     cmdclass={'test': PyTest},
     entry_points="""
     [console_scripts]
     oooctl = ulif.openoffice.oooctl:main
     oooclient = ulif.openoffice.client:main
+    oooworker = ulif.openoffice.worker:main
+    ooocache = ulif.openoffice.cachemanager:main
     [ulif.openoffice.processors]
     meta = ulif.openoffice.processor:MetaProcessor
     oocp = ulif.openoffice.processor:OOConvProcessor
@@ -93,6 +96,7 @@ setup(
     tidy = ulif.openoffice.processor:Tidy
     css_cleaner = ulif.openoffice.processor:CSSCleaner
     html_cleaner = ulif.openoffice.processor:HTMLCleaner
+    html_css_cleaner = ulif.openoffice.processor:HTMLCSSCleaner
     error = ulif.openoffice.processor:Error
     [paste.app_factory]
     docconverter = ulif.openoffice.wsgi:make_docconverter_app
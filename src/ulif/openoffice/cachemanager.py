@@ -1,19 +1,82 @@
+import argparse
 import filecmp
 import glob
+import gzip
+import hashlib
+import io
 import logging
+import mimetypes
 import os
+import re
 import shutil
+import sys
+import tempfile
+import threading
+import time
 try:
     import cPickle as pickle  # Python 2.x
 except ImportError:           # pragma: no cover
     import pickle             # Python 3.x
-from hashlib import md5
+try:
+    import fcntl
+except ImportError:           # pragma: no cover
+    fcntl = None              # non-POSIX systems
+try:
+    import sqlite3
+except ImportError:           # pragma: no cover
+    sqlite3 = None            # Python built without sqlite support
+try:
+    import brotli
+except ImportError:           # pragma: no cover
+    brotli = None             # optional, install `brotli` to use it
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import md5, sha256
 try:
     from cStringIO import StringIO  # Python 2.x
 except ImportError:                 # pragma: no cover
     from io import StringIO         # Python 3.x
 from ulif.openoffice.helpers import (
-    filelike_cmp, write_filelike, base64url_encode)
+    filelike_cmp, write_filelike, base64url_encode, string_to_bytes)
+from ulif.openoffice.options import canonical_options
+
+
+#: Regular expression matching valid hash digests in cache keys.
+RE_HASH_DIGEST = re.compile('^[a-zA-Z0-9_\-]+$')
+
+#: Regular expression matching valid bucket keys.
+RE_BUCKET_KEY = re.compile('^[0-9]+_[0-9]+$')
+
+#: Regular expression matching cache keys derived from digests (see
+#: :func:`get_digest_key`).
+RE_DIGEST_KEY = re.compile('^[0-9a-f]{64}-[0-9a-f]{64}$')
+
+#: Regular expression matching names of temporary files (as created
+#: by :func:`tempfile.mkstemp` with prefix ``.`` and suffix ``.tmp``).
+RE_TEMP_FILE = re.compile('^\\.[a-z0-9_]{8}\\.tmp$')
+
+#: Schemes of cache keys: ``bucket`` keys are numbered by buckets,
+#: ``digest`` keys derived from source and options alone.
+KEY_SCHEMES = ('bucket', 'digest')
+
+#: Filename extensions of compressed copies ("sidecars") of
+#: representations by content encoding, in order of preference.
+SIDECAR_EXTENSIONS = OrderedDict([('br', '.br'), ('gzip', '.gz')])
+
+#: Name of the file holding the SHA-256 digest of a representation,
+#: stored next to it.
+REPR_DIGEST_NAME = '.digest'
+
+#: Content types (or prefixes of them) of representations worth
+#: compressing.
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/xhtml+xml', 'application/xml',
+    'application/json', 'application/javascript', 'image/svg+xml')
+
+#: Seconds a stored source without any representation is kept, before
+#: it is considered orphaned. Gives running conversions a chance to
+#: register their results.
+ORPHAN_GRACE_TIME = 3600
 
 
 def get_marker(options=dict()):
@@ -27,12 +90,276 @@ def get_marker(options=dict()):
     manager and to mark different results for the same input file as
     different option sets will result in different output for same
     input.
+
+    Only options affecting the output are considered, with normalized
+    values (see :func:`ulif.openoffice.options.canonical_options`).
+    Options that give the same output therefore give the same marker,
+    for instance if they differ in the listeners to use only.
     """
-    result = sorted(options.items())
-    result = '%s' % result
+    result = '%s' % canonical_options(options)
     return base64url_encode(result).replace('=', '')
 
 
+#: Size of buffers used when hashing files.
+HASH_BUFFER_SIZE = 1024 * 1024
+
+#: Algorithm used by buckets to identify sources and keys.
+BUCKET_DIGEST_ALGORITHM = 'sha256'
+
+#: Digests memoized in the current thread (see :func:`digest_scope`).
+_digest_memo = threading.local()
+
+
+@contextmanager
+def digest_scope():
+    """A context manager to memoize file digests for a while.
+
+    While active, :func:`get_file_digests` computes the digests of
+    each file (version) in the current thread only once, even if
+    several components ask for them. Digests are forgotten when the
+    (outermost) scope is left. Use it around single requests or
+    operations, during which the files involved do not change.
+
+    Scopes can be nested. Inner scopes share the memo of the outer
+    one.
+    """
+    if getattr(_digest_memo, 'digests', None) is not None:
+        yield
+        return
+    _digest_memo.digests = dict()
+    try:
+        yield
+    finally:
+        _digest_memo.digests = None
+
+
+def _get_digest_memo_key(path, algorithm, stat=None):
+    """Get a key to memoize digests of file in `path`.
+
+    The key changes, when the file is modified or replaced.
+    """
+    stat = stat or os.stat(path)
+    mtime = getattr(stat, 'st_mtime_ns', stat.st_mtime)
+    return (os.path.abspath(path), stat.st_size, mtime, stat.st_ino,
+            algorithm)
+
+
+def get_file_digests(path, algorithms=(BUCKET_DIGEST_ALGORITHM, )):
+    """Get digests of the file in `path`.
+
+    `algorithms` is a sequence of names of hash algorithms as
+    supported by :mod:`hashlib`, like ``md5``, ``sha256``, or
+    ``blake2b``. Returns a dict mapping algorithm names to hex
+    digests.
+
+    All digests are computed while reading the file once in chunks of
+    :data:`HASH_BUFFER_SIZE`. Inside a :func:`digest_scope` results
+    are memoized, so that each file is hashed only once per scope.
+    """
+    memo = getattr(_digest_memo, 'digests', None)
+    if memo is None:
+        memo = dict()
+    stat = os.stat(path)
+    result, missing = dict(), []
+    for algorithm in algorithms:
+        key = _get_digest_memo_key(path, algorithm, stat)
+        if key in memo:
+            result[algorithm] = memo[key]
+        else:
+            missing.append(algorithm)
+    if not missing:
+        return result
+    hash_values = [hashlib.new(algorithm) for algorithm in missing]
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with io.open(path, 'rb') as fd:
+        for num in iter(lambda: fd.readinto(buf), 0):
+            for hash_value in hash_values:
+                hash_value.update(view[:num])
+    for algorithm, hash_value in zip(missing, hash_values):
+        result[algorithm] = hash_value.hexdigest()
+        memo[_get_digest_memo_key(path, algorithm, stat)] = result[
+            algorithm]
+    return result
+
+
+def remember_file_digests(path, digests):
+    """Memoize `digests` of the file in `path` in the current scope.
+
+    `digests` is a dict mapping algorithm names to hex digests, as
+    returned by :func:`get_file_digests`. Use it if digests are known
+    already, for instance because they were computed while the file
+    was written. Later calls to :func:`get_file_digests` in the same
+    :func:`digest_scope` will then not read the file again. Outside
+    of digest scopes this function does nothing.
+    """
+    memo = getattr(_digest_memo, 'digests', None)
+    if memo is None:
+        return
+    stat = os.stat(path)
+    for algorithm, digest in digests.items():
+        memo[_get_digest_memo_key(path, algorithm, stat)] = digest
+
+
+def write_hashed(file_obj, path, algorithms=(BUCKET_DIGEST_ALGORITHM, ),
+                 chunksize=HASH_BUFFER_SIZE):
+    """Write contents of `file_obj` to `path` and hash them on the fly.
+
+    `file_obj` must be a file-like object opened for reading in
+    binary mode. Returns a dict of digests like
+    :func:`get_file_digests`. Inside a :func:`digest_scope` the
+    digests are memoized (see :func:`remember_file_digests`), so that
+    the file written is not read again for hashing.
+    """
+    hash_values = [hashlib.new(algorithm) for algorithm in algorithms]
+    with open(path, 'wb') as fd:
+        for chunk in iter(lambda: file_obj.read(chunksize), b''):
+            fd.write(chunk)
+            for hash_value in hash_values:
+                hash_value.update(chunk)
+    result = dict([(algorithm, hash_value.hexdigest()) for
+                   algorithm, hash_value in zip(algorithms, hash_values)])
+    remember_file_digests(path, result)
+    return result
+
+
+def get_file_digest(path, algorithm=BUCKET_DIGEST_ALGORITHM):
+    """Get the digest of the file in `path` computed by `algorithm`.
+
+    See :func:`get_file_digests`.
+    """
+    return get_file_digests(path, (algorithm, ))[algorithm]
+
+
+def is_compressible(path):
+    """Tell whether the file in `path` is worth compressing.
+
+    Decided by the content type guessed from the filename. See
+    :data:`COMPRESSIBLE_TYPES`.
+    """
+    content_type = mimetypes.guess_type(path)[0] or ''
+    return [x for x in COMPRESSIBLE_TYPES
+            if content_type.startswith(x)] != []
+
+
+def get_sidecar_encodings():
+    """Get the content encodings we can write sidecars for.
+
+    Brotli is supported only if the `brotli` package is installed.
+    """
+    return [x for x in SIDECAR_EXTENSIONS if x != 'br' or brotli]
+
+
+def _is_aux_file(name, names=()):
+    """Tell whether `name` is a sidecar, digest, or temporary file.
+
+    Such files live next to representations but are not
+    representations themselves. `names` are the names of all files in
+    the same dir, needed to tell sidecars from representations.
+    """
+    if name == REPR_DIGEST_NAME or RE_TEMP_FILE.match(name):
+        return True
+    return [x for x in SIDECAR_EXTENSIONS.values()
+            if name.endswith(x) and name[:-len(x)] in names] != []
+
+
+def _read_repr_digest(repr_dir):
+    """Get the digest stored for the representation in `repr_dir`.
+
+    Returns ``None`` if no digest was stored (like with
+    representations stored by older versions).
+    """
+    try:
+        with open(os.path.join(repr_dir, REPR_DIGEST_NAME)) as fd:
+            return fd.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def _get_repr_name(names):
+    """Get the name of the representation out of filenames `names`.
+
+    Returns ``None`` if there is none.
+    """
+    names = [x for x in names if not _is_aux_file(x, names)]
+    return names and names[0] or None
+
+
+def write_sidecars(path, encodings=None):
+    """Write compressed copies of the file in `path` next to it.
+
+    For each content encoding in `encodings` (all we support by
+    default, see :func:`get_sidecar_encodings`) we write a file with
+    the respective extension from :data:`SIDECAR_EXTENSIONS`. Copies
+    not smaller than the original are not kept.
+
+    Returns a list of the encodings written.
+    """
+    if encodings is None:
+        encodings = get_sidecar_encodings()
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    result = []
+    for encoding in encodings:
+        if encoding == 'gzip':
+            buf = io.BytesIO()
+            # no filename and timestamp, so that results are the same
+            # for the same input.
+            with gzip.GzipFile(
+                    filename='', mode='wb', fileobj=buf, mtime=0) as gz:
+                gz.write(data)
+            compressed = buf.getvalue()
+        else:
+            compressed = brotli.compress(data)
+        if len(compressed) >= len(data):
+            continue
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.', suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(compressed)
+        os.rename(tmp_path, path + SIDECAR_EXTENSIONS[encoding])
+        result.append(encoding)
+    return result
+
+
+def get_key_digest(repr_key):
+    """Get the SHA-256 digest of `repr_key`.
+
+    `repr_key` can be a string or a file-like object opened for
+    reading. File-like objects are read completely and, if possible,
+    rewound afterwards.
+    """
+    hash_value = sha256()
+    if isinstance(repr_key, (str, bytes)) or not hasattr(repr_key, 'read'):
+        chunks = [repr_key]
+    else:
+        chunks = iter(lambda: repr_key.read(65536), repr_key.read(0))
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        hash_value.update(chunk)
+    if hasattr(repr_key, 'seek'):
+        repr_key.seek(0)
+    return hash_value.hexdigest()
+
+
+def get_digest_key(source_digest, repr_key=''):
+    """Get the cache key of a source and `repr_key` in ``digest`` scheme.
+
+    `source_digest` is the SHA-256 hex digest of the source contents,
+    `repr_key` a string or file-like object as accepted by
+    :func:`get_key_digest`. The key is derived from both digests only
+    and therefore the same in all caches, for instance::
+
+      >>> get_digest_key(64 * '0', '')  # doctest: +ELLIPSIS
+      '000...000-e3b0c44298fc1c149afbf4c8996fb924...b855'
+
+    Clients can compute keys of documents themselves, using
+    :func:`get_marker` for the options of a conversion as `repr_key`.
+    """
+    return '%s-%s' % (source_digest, get_key_digest(repr_key))
+
+
 class Bucket(object):
     """A bucket where we store files with same hash sums.
 
@@ -55,22 +382,43 @@ class Bucket(object):
 
     For stored documents you will get a `bucket key` which can be used
     later to retrieve data stored.
+
+    Sources and keys are found by their SHA-256 digests, which are
+    kept in the bucket data together with an inverted mapping from
+    digests to filenames. In `paranoid` mode we additionally compare
+    the contents of sources and keys byte by byte.
+
+    Files without recorded digest (stored by older versions, for
+    instance) are compared byte by byte if no file with matching
+    digest is found. Their digests are recorded when the next
+    representation is stored. Lookups never write bucket data.
+
+    `read_only` buckets never modify the filesystem: dirs are not
+    created, data is not written and representations are not marked
+    as used. Storing representations is not possible then.
     """
-    def __init__(self, path):
+    def __init__(self, path, paranoid=False, read_only=False):
         self.path = path
+        self.paranoid = paranoid
+        self.read_only = read_only
         self.srcdir = os.path.join(self.path, 'sources')
         self.resultdir = os.path.join(self.path, 'repr')
         self.keysdir = os.path.join(self.path, 'keys')
-        self.create()
-        if self.data is None:
-            self.data = dict(
+        if not read_only:
+            self.create()
+        data = self.data
+        if data is None:
+            data = dict(
                 version=1,
                 curr_src_num=0,
                 curr_repr_num=dict(),
                 )
-        self._data = self.data
+            self.data = data
+        self._data = data
 
     def _set_internal_data(self, data):
+        if self.read_only:
+            return  # keep changes (digests, for instance) in memory
         data_path = os.path.join(self.path, 'data')
         with open(data_path, 'wb') as fd:
             pickle.dump(data, fd)
@@ -134,16 +482,98 @@ class Bucket(object):
             os.makedirs(path)
         return
 
-    def get_stored_source_num(self, src_path):
+    def _get_digest_maps(self, subdir):
+        """Get the digests of files in `subdir` of this bucket.
+
+        Returns a tuple of two dicts, one mapping filenames to SHA-256
+        digests, the other one mapping digests to filenames. Only
+        digests recorded in bucket data are considered. Nothing is
+        written.
+        """
+        digests = self._data.setdefault('digests', dict()).setdefault(
+            subdir, dict())
+        all_names = self._data.setdefault('names', dict())
+        names = all_names.get(subdir)
+        if names is None or len(names) != len(digests):
+            # data written by older versions: invert in memory
+            names = all_names[subdir] = dict(
+                [(digest, name) for name, digest in digests.items()])
+        return digests, names
+
+    def _set_digest(self, subdir, name, digest):
+        """Remember `digest` of file `name` in `subdir` of this bucket.
+
+        The bucket data is not written. Callers have to do that.
+        """
+        digests, names = self._get_digest_maps(subdir)
+        if names.get(digests.get(name)) == name:
+            del names[digests[name]]
+        digests[name] = digest
+        names[digest] = name
+
+    def _drop_digests(self, subdir, name=None):
+        """Forget digest of file `name` or of all files in `subdir`.
+
+        The bucket data is not written. Callers have to do that.
+        """
+        if name is None:
+            self._data.get('digests', dict()).pop(subdir, None)
+            self._data.get('names', dict()).pop(subdir, None)
+            return
+        digests, names = self._get_digest_maps(subdir)
+        digest = digests.pop(name, None)
+        if names.get(digest) == name:
+            del names[digest]
+
+    def _get_untracked(self, subdir):
+        """Get names of files in `subdir` without recorded digest.
+        """
+        path = os.path.join(self.path, subdir)
+        if not os.path.isdir(path):
+            return []
+        digests = self._get_digest_maps(subdir)[0]
+        names = sorted(os.listdir(path))
+        return [x for x in names
+                if x not in digests and not _is_aux_file(x, names)]
+
+    def _record_digests(self, subdir):
+        """Record digests of files in `subdir` lacking one.
+
+        The bucket data is not written. Callers have to do that.
+        """
+        for name in self._get_untracked(subdir):
+            self._set_digest(subdir, name, get_file_digest(
+                os.path.join(self.path, subdir, name)))
+
+    def get_stored_source_num(self, src_path, digest=None):
         """Tell whether a file like that in `src_path` is already stored.
 
         A stored one and the file in `src_path` are compared by
         content. That means that `os.stat` attributes, filename,
         etc. do not matter.
 
+        Contents are compared by SHA-256 digest. If the digest of
+        `src_path` was computed already, it can be passed in as
+        `digest`. In `paranoid` mode we compare byte by byte in
+        addition.
+
+        `src_path` can be ``None`` if `digest` is given. Sources stored
+        without a digest (by older versions) are not found then.
+
         Returns the number of the stored source if found, `None` else.
         """
-        for name in os.listdir(self.srcdir):
+        if digest is None:
+            digest = get_file_digest(src_path)
+        name = self._get_digest_maps('sources')[1].get(digest)
+        if name is not None:
+            path = os.path.join(self.srcdir, name)
+            if os.path.isfile(path) and not (
+                    self.paranoid and not filecmp.cmp(
+                        path, src_path, shallow=False)):
+                return int(name.split('_')[-1])
+        if src_path is None:
+            return None  # nothing to compare with
+        for name in self._get_untracked('sources'):
             if filecmp.cmp(
                     os.path.join(self.srcdir, name), src_path, shallow=False):
                 return int(name.split('_')[-1])
@@ -162,16 +592,30 @@ class Bucket(object):
         keydir = os.path.join(self.keysdir, str(src_num))
         if not os.path.isdir(keydir):
             return None
-        for name in os.listdir(keydir):
-            keypath = os.path.join(keydir, name)
-            f1 = open(keypath, 'rb')
-            f2 = repr_key
-            if isinstance(f2, str):
-                f2 = StringIO(repr_key)
-            if filelike_cmp(f1, f2):
+        name = self._get_digest_maps(os.path.join(
+            'keys', str(src_num)))[1].get(get_key_digest(repr_key))
+        if name is not None:
+            path = os.path.join(keydir, name)
+            if os.path.isfile(path) and not (
+                    self.paranoid and not self._key_equals(path, repr_key)):
+                return int(name.split('.')[0])
+        for name in self._get_untracked(os.path.join('keys', str(src_num))):
+            if self._key_equals(os.path.join(keydir, name), repr_key):
                 return int(name.split('.')[0])
         return None
 
+    def _key_equals(self, path, repr_key):
+        """Tell whether the key stored in `path` equals `repr_key`.
+        """
+        f2 = repr_key
+        if isinstance(f2, str):
+            f2 = StringIO(repr_key)
+        with open(path, 'rb') as f1:
+            equal = filelike_cmp(f1, f2)
+        if hasattr(f2, 'seek'):
+            f2.seek(0)
+        return equal
+
     def store_representation(self, src_path, repr_path, repr_key=''):
         """Store a representation for a source under a representation
         key.
@@ -194,14 +638,20 @@ class Bucket(object):
 
         Returns a bucket key.
         """
-        src_num = self.get_stored_source_num(src_path)
+        if self.read_only:
+            raise IOError('bucket is read-only: %s' % self.path)
+        self._record_digests('sources')
+        src_digest = get_file_digest(src_path)
+        src_num = self.get_stored_source_num(src_path, digest=src_digest)
         if src_num is None:
             # create new source
             src_num = self.get_current_source_num() + 1
             shutil.copy2(
                 src_path, os.path.join(self.srcdir, 'source_%s' % src_num))
+            self._set_digest('sources', 'source_%s' % src_num, src_digest)
             self.set_current_source_num(src_num)
             os.makedirs(os.path.join(self.keysdir, str(src_num)))
+        self._record_digests(os.path.join('keys', str(src_num)))
         repr_num = self.get_stored_repr_num(src_num, repr_key)
         if repr_num is None:
             # store new key
@@ -210,6 +660,9 @@ class Bucket(object):
             key_path = os.path.join(
                 self.keysdir, str(src_num), '%s.key' % repr_num)
             write_filelike(repr_key, key_path)
+            self._set_digest(
+                os.path.join('keys', str(src_num)), '%s.key' % repr_num,
+                get_file_digest(key_path))
         # store/update representation
         repr_dir = os.path.join(
             self.resultdir, str(src_num), str(repr_num))
@@ -217,6 +670,10 @@ class Bucket(object):
             shutil.rmtree(repr_dir)  # remove any old representation
         os.makedirs(repr_dir)
         shutil.copy2(repr_path, repr_dir)
+        name = os.path.basename(repr_path)
+        with open(os.path.join(repr_dir, REPR_DIGEST_NAME), 'w') as fd:
+            fd.write(get_file_digest(os.path.join(repr_dir, name)))
+        self.data = self._data
         return '%s_%s' % (src_num, repr_num)
 
     def get_representation(self, bucket_key):
@@ -228,9 +685,148 @@ class Bucket(object):
         repr_dir = os.path.join(self.resultdir, src_num, repr_num)
         if not os.path.isdir(repr_dir):
             return None
-        basename = os.listdir(repr_dir)[0]
+        basename = _get_repr_name(os.listdir(repr_dir))
+        if basename is None:
+            return None
         return os.path.join(repr_dir, basename)
 
+    def get_representation_digest(self, bucket_key):
+        """Get the SHA-256 digest of representation `bucket_key`.
+
+        Digests are computed when storing representations. Returns
+        ``None`` if no such representation is stored or it has no
+        digest recorded.
+        """
+        src_num, repr_num = bucket_key.split('_')
+        return _read_repr_digest(
+            os.path.join(self.resultdir, src_num, repr_num))
+
+    def touch(self, bucket_key):
+        """Mark the representation identified by `bucket_key` as used.
+
+        We remember the time of last access as modification time of
+        the representation dir. Cache eviction removes least recently
+        used representations first.
+        """
+        if self.read_only:
+            return
+        src_num, repr_num = bucket_key.split('_')
+        repr_dir = os.path.join(self.resultdir, src_num, repr_num)
+        try:
+            os.utime(repr_dir, None)
+        except OSError:                         # pragma: no cover
+            pass  # removed in the meantime
+
+    def get_entries(self):
+        """Get a generator of all representations stored in this bucket.
+
+        Yields tuples ``(<BUCKET_KEY>, <LAST_ACCESS>, <SIZE>)`` where
+        ``<LAST_ACCESS>`` is the time of the last store or retrieval
+        (in seconds since epoch) and ``<SIZE>`` the number of bytes
+        used by the representation.
+        """
+        for bucket_key in self.keys():
+            src_num, repr_num = bucket_key.split('_')
+            repr_dir = os.path.join(self.resultdir, src_num, repr_num)
+            try:
+                last_access = os.path.getmtime(repr_dir)
+                size = sum([os.path.getsize(os.path.join(repr_dir, name))
+                            for name in os.listdir(repr_dir)
+                            if name != REPR_DIGEST_NAME])
+            except OSError:                     # pragma: no cover
+                continue  # removed in the meantime
+            yield bucket_key, last_access, size
+
+    def get_source_digest(self, src_num):
+        """Get the SHA-256 digest of source number `src_num`.
+
+        Returns ``None`` if no such source is stored.
+        """
+        name = 'source_%s' % src_num
+        digest = self._get_digest_maps('sources')[0].get(name)
+        path = os.path.join(self.srcdir, name)
+        if not os.path.isfile(path):
+            return None
+        if digest is None:
+            digest = get_file_digest(path)  # stored by older versions
+        return digest
+
+    def get_source_size(self, src_num):
+        """Get the size of source number `src_num` in bytes.
+
+        Returns zero if no such source is stored.
+        """
+        path = os.path.join(self.srcdir, 'source_%s' % src_num)
+        if not os.path.isfile(path):
+            return 0
+        return os.path.getsize(path)
+
+    def remove_representation(self, bucket_key):
+        """Remove the representation identified by `bucket_key`.
+
+        The key of the representation is removed as well. If it was
+        the last representation of its source, the source is removed
+        too.
+
+        Returns the number of bytes freed.
+        """
+        src_num, repr_num = bucket_key.split('_')
+        repr_dir = os.path.join(self.resultdir, src_num, repr_num)
+        if not os.path.isdir(repr_dir):
+            return 0
+        freed = sum([os.path.getsize(os.path.join(repr_dir, name))
+                     for name in os.listdir(repr_dir)
+                     if name != REPR_DIGEST_NAME])
+        shutil.rmtree(repr_dir)
+        key_path = os.path.join(self.keysdir, src_num, '%s.key' % repr_num)
+        if os.path.isfile(key_path):
+            os.unlink(key_path)
+        self._drop_digests(
+            os.path.join('keys', src_num), '%s.key' % repr_num)
+        self.data = self._data
+        if not os.listdir(os.path.join(self.resultdir, src_num)):
+            freed += self.remove_source(src_num)
+        return freed
+
+    def remove_source(self, src_num):
+        """Remove source number `src_num` with all its representations.
+
+        Returns the number of bytes freed.
+        """
+        src_num = str(src_num)
+        freed = self.get_source_size(src_num)
+        src_path = os.path.join(self.srcdir, 'source_%s' % src_num)
+        for path in (os.path.join(self.resultdir, src_num),
+                     os.path.join(self.keysdir, src_num)):
+            if os.path.isdir(path):
+                for name in os.listdir(path):
+                    freed += os.path.getsize(os.path.join(path, name))
+                shutil.rmtree(path)
+        if os.path.isfile(src_path):
+            os.unlink(src_path)
+        self._drop_digests('sources', 'source_%s' % src_num)
+        self._drop_digests(os.path.join('keys', src_num))
+        self.data = self._data
+        return freed
+
+    def get_orphaned_sources(self, grace_time=ORPHAN_GRACE_TIME):
+        """Get numbers of stored sources without any representation.
+
+        Sources stored less than `grace_time` seconds ago are not
+        considered orphaned, as their representation might still be
+        computed.
+        """
+        now = time.time()
+        for name in os.listdir(self.srcdir):
+            src_num = name.split('_')[-1]
+            repr_dir = os.path.join(self.resultdir, src_num)
+            if os.path.isdir(repr_dir) and os.listdir(repr_dir):
+                continue
+            src_path = os.path.join(self.srcdir, name)
+            if now - os.path.getmtime(src_path) < grace_time:
+                continue
+            yield int(src_num)
+
     def keys(self):
         """Get a generator of all bucket keys available in this bucket.
         """
@@ -240,6 +836,195 @@ class Bucket(object):
                 yield '%s_%s' % (src_num, repr_num)
 
 
+class _hybridmethod(object):
+    """A decorator for methods callable on classes and instances.
+
+    The decorated function gets the instance as first argument if
+    called on an instance, the class otherwise.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        return self.func.__get__(cls if obj is None else obj, cls)
+
+
+def _int_or_none(value):
+    """Turn `value` into an integer. Empty values give ``None``.
+    """
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+#: Version of the index schema, stored as ``user_version`` in indexes.
+INDEX_SCHEMA_VERSION = 1
+
+#: Indexes prepared by this process, as (path, device, inode) tuples.
+_prepared_indexes = set()
+
+
+class CacheIndex(object):
+    """An SQLite database indexing all entries of a cache.
+
+    The index lives in the file `path` and records for each stored
+    representation the hash digest of its source, source number,
+    representation number, a digest of the representation key (see
+    :func:`get_key_digest`), the size, modification time, content
+    type, and SHA-256 digest of the representation.
+
+    With an index, lookups and listings of cache entries are simple
+    indexed queries instead of scans over the whole cache dir.
+
+    Each operation opens a connection of its own, so that indexes can
+    be used by several threads and processes at the same time.
+
+    `read_only` indexes must exist already. They are opened for
+    reading only (where supported by Python).
+
+    The schema is created (or upgraded) only once per index and
+    process. Indexes with a current schema are not written to when
+    creating a :class:`CacheIndex`.
+    """
+    def __init__(self, path, read_only=False):
+        if sqlite3 is None:                     # pragma: no cover
+            raise IOError('sqlite3 not available')
+        self.path = path
+        self.read_only = read_only
+        if read_only or self._get_file_id() in _prepared_indexes:
+            return
+        with self._connect() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < INDEX_SCHEMA_VERSION:
+                self._create_schema(conn)
+        _prepared_indexes.add(self._get_file_id())
+
+    def _get_file_id(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (self.path, st.st_dev, st.st_ino)
+
+    def _create_schema(self, conn):
+        """Create or upgrade the tables of the index.
+        """
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "hash TEXT, src_num INTEGER, repr_num INTEGER, "
+            "key_digest TEXT, size INTEGER, mtime REAL, "
+            "content_type TEXT, "
+            "PRIMARY KEY (hash, src_num, repr_num))")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_by_key "
+            "ON entries (hash, key_digest)")
+        columns = [row[1] for row in conn.execute(
+            "PRAGMA table_info(entries)")]
+        if 'digest' not in columns:
+            # indexes created by older versions
+            conn.execute("ALTER TABLE entries ADD COLUMN digest TEXT")
+        conn.execute("PRAGMA user_version = %d" % INDEX_SCHEMA_VERSION)
+
+    @contextmanager
+    def _connect(self):
+        if self.read_only and sys.version_info >= (3, 4):
+            conn = sqlite3.connect(
+                'file:%s?mode=ro' % self.path, timeout=30, uri=True)
+        else:
+            conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:  # commit or rollback
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, hash_digest, bucket_key, key_digest, repr_path,
+            digest=None):
+        """Record the representation stored in `repr_path`.
+
+        `digest` is the SHA-256 digest of the representation.
+        """
+        src_num, repr_num = bucket_key.split('_')
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (hash, src_num, repr_num, "
+                "key_digest, size, mtime, content_type, digest) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (hash_digest, int(src_num), int(repr_num), key_digest,
+                 os.path.getsize(repr_path), os.path.getmtime(repr_path),
+                 mimetypes.guess_type(repr_path)[0], digest))
+
+    def remove(self, hash_digest, bucket_key):
+        """Remove the entry for `hash_digest` and `bucket_key`.
+        """
+        src_num, repr_num = bucket_key.split('_')
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM entries WHERE hash = ? AND src_num = ? "
+                "AND repr_num = ?", (hash_digest, int(src_num), int(repr_num)))
+
+    def clear(self):
+        """Remove all entries.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries")
+
+    def find(self, hash_digest, key_digest):
+        """Get bucket keys stored for `hash_digest` and `key_digest`.
+
+        Returns a list of bucket keys. There might be several of them
+        in case of hash collisions.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT src_num, repr_num FROM entries "
+                "WHERE hash = ? AND key_digest = ? ORDER BY src_num",
+                (hash_digest, key_digest)).fetchall()
+        return ['%s_%s' % row for row in rows]
+
+    def get_digest(self, hash_digest, bucket_key):
+        """Get the digest of the representation `bucket_key`.
+
+        Returns ``None`` if the entry is not indexed or has no digest
+        recorded.
+        """
+        src_num, repr_num = bucket_key.split('_')
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT digest FROM entries WHERE hash = ? "
+                    "AND src_num = ? AND repr_num = ?",
+                    (hash_digest, int(src_num), int(repr_num))).fetchone()
+        except sqlite3.OperationalError:
+            return None  # old index opened read-only
+        return row and row[0] or None
+
+    def keys(self):
+        """Get a list of all cache keys indexed.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT hash, src_num, repr_num FROM entries").fetchall()
+        return ['%s_%s_%s' % row for row in rows]
+
+    def stats(self):
+        """Get the number and overall size of indexed representations.
+
+        Returns a dict with keys ``entries`` and ``size``.
+        """
+        with self._connect() as conn:
+            num, size = conn.execute(
+                "SELECT COUNT(*), SUM(size) FROM entries").fetchone()
+        return dict(entries=num, size=size or 0)
+
+
+#: Locks of documents currently processed in this process.
+#: Mapping: lock file path <-> [<LOCK>, <NUMBER OF USERS>]
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
 class CacheManager(object):
     """A cache manager.
 
@@ -257,11 +1042,98 @@ class CacheManager(object):
 
     It also checks for hash collisions: if two input files give the
     same hash, they will be handled correctly.
+
+    The cache can be limited in size: `max_size` gives the maximum
+    number of bytes used by sources and representations (sizes like
+    ``'500M'`` are accepted as well), `max_entries` the maximum number
+    of representations stored, and `max_age` the number of seconds a
+    representation is kept after its last use. Limits are enforced by
+    :meth:`evict`, which removes least recently used representations
+    first. Use a :class:`CacheJanitor` to run evictions regularly.
+
+    With `use_index` set to ``True`` we maintain a :class:`CacheIndex`
+    in the cache dir (file :data:`INDEX_NAME`) to speed up lookups and
+    listings. Caches without an index are indexed first. With
+    `use_index` set to ``None`` (the default), an index is used if it
+    exists already. Please note that all processes sharing a cache
+    dir must use the index then.
+
+    Stored sources and keys are identified by their SHA-256
+    digests. Set `paranoid` to ``True`` to compare contents byte by
+    byte in addition.
+
+    Sources are put into buckets by their `hash_algorithm` digest,
+    MD5 by default. Other algorithms supported by :mod:`hashlib` (like
+    ``sha256`` or ``blake2b``) can be used for new caches. The
+    algorithm is then stored in the cache dir (file
+    :data:`HASH_ALGORITHM_NAME`) and used by all cache managers
+    working on this cache dir.
+
+    A `read_only` cache manager never modifies the cache dir. It only
+    looks up documents, which makes it suitable for web nodes serving
+    a cache from read-only (network) mounts. Storing documents,
+    locking and evictions are not possible then.
+
+    With `sidecars` set, compressed copies of compressible
+    representations (HTML, text, etc.) are stored next to them (see
+    :func:`write_sidecars`), so that they can be delivered compressed
+    without compressing them on each request.
+
+    The `key_scheme` determines the cache keys returned. With
+    ``bucket`` (the default) keys contain the numbers buckets assign
+    to sources and representations. These numbers depend on the order
+    docs were stored in. With ``digest`` keys are derived from the
+    SHA-256 digests of source and representation key only (see
+    :func:`get_digest_key`), so that any cache or client computes the
+    same key for the same document and options. Like the hash
+    algorithm, the key scheme of new cache dirs is stored (file
+    :data:`KEY_SCHEME_NAME`). :meth:`get_cached_file` accepts keys of
+    both schemes.
     """
-    def __init__(self, cache_dir, level=1):
+    #: Filename of the index (if any) in cache dir.
+    INDEX_NAME = '.index.sqlite'
+
+    #: Hash algorithm to determine buckets of sources.
+    hash_algorithm = 'md5'
+
+    #: Filename of hash algorithm setting (if any) in cache dir.
+    HASH_ALGORITHM_NAME = '.hash_algorithm'
+
+    #: Scheme of cache keys returned, one of :data:`KEY_SCHEMES`.
+    key_scheme = 'bucket'
+
+    #: Filename of key scheme setting (if any) in cache dir.
+    KEY_SCHEME_NAME = '.key_scheme'
+
+    #: Name of dir mapping ``digest`` keys to bucket keys in cache dir.
+    DIGEST_KEYS_DIR = '.keys'
+
+    def __init__(self, cache_dir, level=1, max_size=None, max_entries=None,
+                 max_age=None, use_index=None, paranoid=False,
+                 read_only=False, hash_algorithm=None, sidecars=False,
+                 key_scheme=None):
         self.cache_dir = cache_dir
+        self.paranoid = paranoid
+        self.sidecars = sidecars
+        self.read_only = read_only
         self._prepare_cache_dir()
+        self._init_hash_algorithm(hash_algorithm)
+        if key_scheme not in (None, ) + KEY_SCHEMES:
+            raise ValueError('unknown key scheme: %s' % key_scheme)
+        self.key_scheme = self._init_setting(
+            self.KEY_SCHEME_NAME, key_scheme, self.key_scheme, 'key scheme')
         self.level = level  # How many dir levels will we create?
+        self.max_size = string_to_bytes(max_size)
+        self.max_entries = _int_or_none(max_entries)
+        self.max_age = _int_or_none(max_age)
+        self.index = None
+        if self.cache_dir is not None and use_index is not False:
+            index_path = os.path.join(self.cache_dir, self.INDEX_NAME)
+            exists = os.path.isfile(index_path)
+            if exists or (use_index and not read_only):
+                self.index = CacheIndex(index_path, read_only=read_only)
+            if use_index and not exists and not read_only:
+                self.rebuild_index()
 
     def _prepare_cache_dir(self):
         """Prepare the cache dir, create dirs, etc.
@@ -277,12 +1149,63 @@ class CacheManager(object):
             raise IOError('not a dir but a file: %s' % cache_dir)
 
         if not os.path.exists(cache_dir):
+            if self.read_only:
+                raise IOError('no such cache dir: %s' % cache_dir)
             os.mkdir(cache_dir)
             logging.getLogger(name="ulif.openoffice").info(
                 "Created cache dir: %s" % cache_dir)
         self.cache_dir = cache_dir
         return
 
+    def _init_hash_algorithm(self, hash_algorithm=None):
+        """Set the hash algorithm of this cache manager.
+
+        Algorithms other than the default are stored in the cache
+        dir. Raises :exc:`ValueError` if `hash_algorithm` is unknown or
+        differs from the algorithm stored. Other algorithms than the
+        default cannot be set for cache dirs holding entries already.
+        """
+        if hash_algorithm is not None:
+            hashlib.new(hash_algorithm)  # raises ValueError if unknown
+        self.hash_algorithm = self._init_setting(
+            self.HASH_ALGORITHM_NAME, hash_algorithm, self.hash_algorithm,
+            'hash algorithm', empty_only=True)
+
+    def _init_setting(self, filename, value, default, title,
+                      empty_only=False):
+        """Get a setting stored in file `filename` of the cache dir.
+
+        If `value` is ``None``, the stored value (or `default`) is
+        returned. Other values are stored for new cache dirs, if they
+        differ from `default`. Raises :exc:`ValueError` if `value`
+        differs from the value stored.
+
+        With `empty_only` set, values differing from `default` can be
+        stored only in cache dirs without any entries, as existing
+        entries would become unreachable otherwise.
+        """
+        if self.cache_dir is None:
+            return default if value is None else value
+        path = os.path.join(self.cache_dir, filename)
+        stored = None
+        if os.path.isfile(path):
+            with open(path, 'r') as fd:
+                stored = fd.read().strip()
+        if value is None:
+            value = stored or default
+        elif stored is None and value != default:
+            if empty_only and self._get_bucket_dirs():
+                raise ValueError(
+                    'cache dir %s is not empty and uses %s %s' % (
+                        self.cache_dir, title, default))
+            if not self.read_only:
+                with open(path, 'w') as fd:
+                    fd.write(value)
+        elif stored not in (None, value):
+            raise ValueError(
+                'cache dir %s uses %s %s' % (self.cache_dir, title, stored))
+        return value
+
     @classmethod
     def _compose_cache_key(cls, hash_digest, bucket_key):
         """Get an official marker.
@@ -312,6 +1235,56 @@ class CacheManager(object):
             return (None, None)
         return cache_key.split('_', 1)
 
+    def _get_digest_key_path(self, digest_key):
+        """Get the path of the file mapping `digest_key` to a bucket key.
+        """
+        return os.path.join(
+            self.cache_dir, self.DIGEST_KEYS_DIR, digest_key[:2], digest_key)
+
+    def _resolve_cache_key(self, cache_key):
+        """Get the ``bucket`` scheme key for `cache_key`.
+
+        Keys of ``digest`` scheme are looked up, others returned
+        unchanged. Returns ``None`` if `cache_key` is an unknown
+        ``digest`` key.
+        """
+        if not isinstance(cache_key, str) or not RE_DIGEST_KEY.match(
+                cache_key):
+            return cache_key
+        try:
+            with open(self._get_digest_key_path(cache_key), 'r') as fd:
+                return fd.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def _get_cache_key(self, hash_digest, bucket_key, src_digest, repr_key):
+        """Get the cache key of a representation in our key scheme.
+
+        With ``digest`` scheme, the mapping of the key to the bucket
+        key is stored (if possible).
+        """
+        cache_key = self._compose_cache_key(hash_digest, bucket_key)
+        if self.key_scheme != 'digest':
+            return cache_key
+        digest_key = get_digest_key(src_digest, repr_key)
+        path = self._get_digest_key_path(digest_key)
+        if self.read_only or self._resolve_cache_key(digest_key) == (
+                cache_key):
+            return digest_key
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:                    # pragma: no cover
+                pass  # created by someone else in the meantime
+        # write to a temporary file first, readers never see
+        # incomplete keys
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.', suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(cache_key)
+        os.rename(tmp_path, path)
+        return digest_key
+
     def _get_bucket_path(self, hash_digest):
         """Get a bucket in which a source with 'hash_digest' would be stored.
 
@@ -325,11 +1298,22 @@ class CacheManager(object):
         bucket_path = os.path.join(self.cache_dir, *dirs)
         return bucket_path
 
-    @classmethod
-    def get_hash(cls, path):
+    @property
+    def digest_algorithms(self):
+        """The hash algorithms needed to store or look up sources.
+        """
+        return (self.hash_algorithm, BUCKET_DIGEST_ALGORITHM)
+
+    @_hybridmethod
+    def get_hash(self, path):
         """Get the hash of a file stored in ``path``.
 
-        Currently we compute the MD5 digest.
+        We compute the digest with the :attr:`hash_algorithm` of this
+        cache manager. The digest needed by buckets is computed in the
+        same pass, see :func:`get_file_digests`.
+
+        Can also be called on the class, like in former versions. We
+        use the default :attr:`hash_algorithm` (MD5) then.
 
         Note for derived classes, that the hash digest computed by
         this method should give only chars that can easily be
@@ -337,28 +1321,72 @@ class CacheManager(object):
         (which can occur in Base64 encoded strings) could make things
         difficult.
         """
-        hash_value = md5()
-        with open(path, 'rb') as bin_file:
-            # read file in chunks of 512 bytes as md5 processes chunks
-            # of 128 bytes and filesystems like chunks of 512 bytes
-            for chunk in iter(lambda: bin_file.read(512), b''):
-                hash_value.update(chunk)
-        return hash_value.hexdigest()
+        if isinstance(self, type):
+            return get_file_digest(path, self.hash_algorithm)
+        return get_file_digests(path, self.digest_algorithms)[
+            self.hash_algorithm]
 
     def get_cached_file(self, cache_key):
         """Get the representation stored for `cache_key`.
 
         Returns the path to a file represented by `cache_key` or
         ``None`` if no such representation is stored in cache already.
+
+        This lookup does not create or read any bucket. It costs a
+        single directory listing (plus marking the representation as
+        used, if the cache manager is not read-only). Keys of
+        ``digest`` scheme cost an additional read of a small file.
         """
-        hash_digest, bucket_key = self._dissolve_cache_key(cache_key)
+        hash_digest, bucket_key = self._dissolve_cache_key(
+            self._resolve_cache_key(cache_key))
         if hash_digest is None:
             return None
-        bucket_path = self._get_bucket_path(hash_digest)
-        if bucket_path is None or not os.path.exists(bucket_path):
+        if not (RE_HASH_DIGEST.match(hash_digest) and
+                RE_BUCKET_KEY.match(bucket_key)):
+            return None
+        src_num, repr_num = bucket_key.split('_')
+        repr_dir = os.path.join(
+            self._get_bucket_path(hash_digest), 'repr', src_num, repr_num)
+        try:
+            name = _get_repr_name(os.listdir(repr_dir))
+        except OSError:
+            return None
+        if name is None:
+            return None
+        if not self.read_only:
+            try:
+                os.utime(repr_dir, None)  # mark as used
+            except OSError:                     # pragma: no cover
+                pass
+        return os.path.join(repr_dir, name)
+
+    def get_digest(self, cache_key):
+        """Get the SHA-256 digest of the representation for `cache_key`.
+
+        The digest identifies the contents of the representation and
+        is the same in all processes. It is recorded when the
+        representation is stored (and in the index, if there is one),
+        so that we do not have to read the representation or its
+        bucket again.
+
+        Returns ``None`` if no such representation is stored or no
+        digest was recorded for it (representations stored by older
+        versions).
+        """
+        hash_digest, bucket_key = self._dissolve_cache_key(
+            self._resolve_cache_key(cache_key))
+        if hash_digest is None:
+            return None
+        if not (RE_HASH_DIGEST.match(hash_digest) and
+                RE_BUCKET_KEY.match(bucket_key)):
             return None
-        bucket = Bucket(bucket_path)
-        return bucket.get_representation(bucket_key)
+        if self.index is not None:
+            digest = self.index.get_digest(hash_digest, bucket_key)
+            if digest is not None:
+                return digest
+        return _read_repr_digest(os.path.join(
+            self._get_bucket_path(hash_digest), 'repr',
+            *bucket_key.split('_')))
 
     def get_cached_file_by_source(self, source_path, repr_key=''):
         """Get the representation stored for a source file and a key.
@@ -383,17 +1411,79 @@ class CacheManager(object):
                   ``cache_key`` cannot be determined otherwise.
 
         """
-        hash_digest = self.get_hash(source_path)
-        bucket = Bucket(self._get_bucket_path(hash_digest))
-        src_num = bucket.get_stored_source_num(source_path)
-        if src_num is None:
+        with digest_scope():  # hash the source only once
+            hash_digest = self.get_hash(source_path)
+            return self._get_cached_file_by_digests(
+                hash_digest, get_file_digest(source_path), repr_key,
+                source_path)
+
+    def get_cached_file_by_digests(self, digests, repr_key=''):
+        """Get the representation stored for source digests and a key.
+
+        Like :meth:`get_cached_file_by_source` but the source is given
+        by its `digests` only, a dict mapping hash algorithm names to
+        hex digests. It must contain digests for all
+        :attr:`digest_algorithms` of this cache manager.
+
+        Lets remote clients ask for documents without sending the
+        source. In `paranoid` mode we cannot compare sources byte by
+        byte and therefore never find anything.
+
+        Returns ``(<path>, <cache_key>)`` or ``(None, None)``.
+        """
+        if self.paranoid:
             return None, None
-        repr_num = bucket.get_stored_repr_num(src_num, repr_key)
-        if repr_num is None:
+        if [x for x in self.digest_algorithms if not digests.get(x)]:
             return None, None
-        bucket_key = '%s_%s' % (src_num, repr_num)
-        cache_key = self._compose_cache_key(hash_digest, bucket_key)
-        return bucket.get_representation(bucket_key), cache_key
+        hash_digest = digests[self.hash_algorithm]
+        if not RE_HASH_DIGEST.match(hash_digest):
+            return None, None
+        return self._get_cached_file_by_digests(
+            hash_digest, digests[BUCKET_DIGEST_ALGORITHM], repr_key)
+
+    def _get_cached_file_by_digests(self, hash_digest, src_digest,
+                                    repr_key='', source_path=None):
+        """Get the representation for a source and key.
+
+        The source is given by its `hash_digest` (determining the
+        bucket), its bucket digest `src_digest`, and, optionally, its
+        `source_path`.
+        """
+        if self.key_scheme == 'digest' and not self.paranoid:
+            # maybe we can construct the path directly
+            digest_key = get_digest_key(src_digest, repr_key)
+            path = self.get_cached_file(digest_key)
+            if path is not None:
+                return path, digest_key
+        bucket_path = self._get_bucket_path(hash_digest)
+        if not os.path.isdir(bucket_path):
+            return None, None  # do not create empty buckets
+        if self.index is not None and isinstance(repr_key, str):
+            bucket_keys = self.index.find(
+                hash_digest, get_key_digest(repr_key))
+            if not bucket_keys:
+                return None, None
+        bucket = Bucket(bucket_path, self.paranoid, self.read_only)
+        src_num = bucket.get_stored_source_num(
+            source_path, digest=src_digest)
+        if src_num is None:
+            return None, None
+        if self.index is not None and isinstance(repr_key, str):
+            bucket_keys = [  # others are hash collisions
+                x for x in bucket_keys if x.split('_')[0] == str(src_num)]
+        else:
+            repr_num = bucket.get_stored_repr_num(src_num, repr_key)
+            if repr_num is None:
+                return None, None
+            bucket_keys = ['%s_%s' % (src_num, repr_num)]
+        for bucket_key in bucket_keys:
+            path = bucket.get_representation(bucket_key)
+            if path is None:
+                continue  # removed meanwhile
+            bucket.touch(bucket_key)
+            return path, self._get_cache_key(
+                hash_digest, bucket_key, src_digest, repr_key)
+        return None, None
 
     def register_doc(self, source_path, to_cache, repr_key=''):
         """Store a representation of file found in `source_path` which
@@ -406,19 +1496,391 @@ class CacheManager(object):
         Returns a marker string which can be used in connection with
         the appropriate cache manager methods to retrieve the
         representation later on.
+
+        Raises :exc:`IOError` if the cache manager is read-only.
+        """
+        self._check_writable()
+        with digest_scope():  # hash the source only once
+            hash_digest = self.get_hash(source_path)
+            src_digest = get_file_digest(source_path)
+            with self._bucket_locked(hash_digest):
+                bucket = Bucket(
+                    self._get_bucket_path(hash_digest), self.paranoid)
+                bucket_key = bucket.store_representation(
+                    source_path, to_cache, repr_key=repr_key)
+            if self.sidecars:
+                repr_path = bucket.get_representation(bucket_key)
+                if is_compressible(repr_path):
+                    write_sidecars(repr_path)
+            if self.index is not None:
+                self._index_entry(bucket, bucket_key)
+            return self._get_cache_key(
+                hash_digest, bucket_key, src_digest, repr_key)
+
+    def _index_entry(self, bucket, bucket_key):
+        """Add the representation `bucket_key` of `bucket` to index.
+        """
+        src_num, repr_num = bucket_key.split('_')
+        key_path = os.path.join(bucket.keysdir, src_num, '%s.key' % repr_num)
+        with open(key_path, 'rb') as fd:
+            key_digest = get_key_digest(fd.read())
+        self.index.add(
+            os.path.basename(bucket.path), bucket_key, key_digest,
+            bucket.get_representation(bucket_key),
+            bucket.get_representation_digest(bucket_key))
+
+    def _check_writable(self):
+        """Raise :exc:`IOError` if this cache manager is read-only.
+        """
+        if self.read_only:
+            raise IOError('cache is read-only: %s' % self.cache_dir)
+
+    def rebuild_index(self):
+        """Build the index from scratch out of all buckets.
+
+        Used to index caches created without an index. Returns the
+        number of entries indexed.
+        """
+        self._check_writable()
+        if self.index is None:
+            self.index = CacheIndex(
+                os.path.join(self.cache_dir, self.INDEX_NAME))
+        self.index.clear()
+        num = 0
+        for path in self._get_bucket_paths():
+            bucket = Bucket(path, self.paranoid, self.read_only)
+            for bucket_key in bucket.keys():
+                self._index_entry(bucket, bucket_key)
+                num += 1
+        return num
+
+    def stats(self):
+        """Get the number and size of representations stored.
+
+        Returns a dict with keys ``entries`` and ``size`` (in
+        bytes). Sizes of sources are not included.
+        """
+        if self.index is not None:
+            return self.index.stats()
+        result = dict(entries=0, size=0)
+        for path in self._get_bucket_paths():
+            bucket = Bucket(path, self.paranoid, self.read_only)
+            for bucket_key, last_access, size in bucket.get_entries():
+                result['entries'] += 1
+                result['size'] += size
+        return result
+
+    @contextmanager
+    def locked(self, source_path, repr_key=''):
+        """A context manager to serialize work on a source and key.
+
+        Only one thread (or process) at a time can hold the lock for a
+        given source file contents and `repr_key`, a string. Others
+        wait until the lock is released.
+
+        This way, concurrent requests for the same representation can
+        wait for the first one to finish and then get the result from
+        cache instead of computing it again.
+
+        Threads of the same process are synchronized by regular
+        locks. Other processes are synchronized by file locks, stored
+        in the ``.locks`` subdir of the cache dir. File locks are
+        not available on non-POSIX systems. Lock files are removed
+        when the lock is released.
+        """
+        self._check_writable()
+        with self._locked(self.get_hash(source_path), repr_key):
+            yield
+
+    @contextmanager
+    def _locked(self, hash_digest, repr_key=''):
+        """A context manager to lock a source hash and `repr_key`.
+
+        See :meth:`locked`.
+        """
+        if isinstance(repr_key, str):
+            repr_key = repr_key.encode('utf-8')
+        with self._lock_file('%s_%s.lock' % (
+                hash_digest, md5(repr_key).hexdigest())):
+            yield
+
+    @contextmanager
+    def _bucket_locked(self, hash_digest):
+        """A context manager to lock the bucket for `hash_digest`.
+
+        Bucket data is read, modified, and written only while holding
+        this lock. Other locks (see :meth:`locked`) must be taken
+        before this one, never while holding it.
         """
-        md5_digest = self.get_hash(source_path)
-        bucket = Bucket(self._get_bucket_path(md5_digest))
-        bucket_key = bucket.store_representation(
-            source_path, to_cache, repr_key=repr_key)
-        return self._compose_cache_key(md5_digest, bucket_key)
+        with self._lock_file('%s.lock' % hash_digest):
+            yield
+
+    @contextmanager
+    def _lock_file(self, name):
+        """A context manager to lock `name` in the ``.locks`` subdir.
+
+        Locks threads of this process and other processes. See
+        :meth:`locked`.
+        """
+        lock_dir = os.path.join(self.cache_dir, '.locks')
+        if not os.path.isdir(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError:                    # pragma: no cover
+                pass  # created by someone else in the meantime
+        lock_path = os.path.join(lock_dir, name)
+        with _inflight_lock:
+            entry = _inflight.setdefault(lock_path, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                fd = self._open_lock_file(lock_path)
+                try:
+                    yield
+                finally:
+                    # remove the lock file while we still hold the lock
+                    try:
+                        os.unlink(lock_path)
+                    except OSError:            # pragma: no cover
+                        pass
+                    if fcntl is not None:
+                        fcntl.flock(fd, fcntl.LOCK_UN)
+                    fd.close()
+        finally:
+            with _inflight_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del _inflight[lock_path]
+
+    def _open_lock_file(self, lock_path):
+        """Open and lock the file in `lock_path`.
+
+        As lock files are removed after use, the file we got a lock
+        for might have been removed meanwhile by the former holder. In
+        that case we try again with a fresh file.
+        """
+        while True:
+            fd = open(lock_path, 'a')
+            if fcntl is None:
+                return fd
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(
+                        fd.fileno()).st_ino:
+                    return fd
+            except OSError:
+                pass  # removed by former holder
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            fd.close()
+
+    def _get_bucket_dirs(self):
+        """Get the names of the toplevel bucket dirs in cache dir.
+
+        Other files and dirs in cache dir start with a dot.
+        """
+        return [x for x in os.listdir(self.cache_dir)
+                if not x.startswith('.')]
+
+    def _get_bucket_paths(self):
+        """Get a list of paths of all buckets in cache.
+        """
+        glob_expr = self.cache_dir + ('/*' * (self.level + 1))
+        return glob.glob(glob_expr)
 
     def keys(self):
         """Get a list of all cache keys currently available.
         """
-        glob_expr = self.cache_dir + ('/*' * (self.level + 1))
-        for path in glob.glob(glob_expr):
+        if self.index is not None:
+            for key in self.index.keys():
+                yield key
+            return
+        for path in self._get_bucket_paths():
             md5_hash = os.path.basename(path)
-            bucket = Bucket(path)
+            bucket = Bucket(path, self.paranoid, self.read_only)
             for bucket_key in bucket.keys():
                 yield '%s_%s' % (md5_hash, bucket_key)
+
+    def evict(self):
+        """Remove representations to meet the limits of this cache.
+
+        Representations not used for more than `max_age` seconds are
+        removed. Afterwards least recently used representations are
+        removed until the cache holds no more than `max_entries`
+        representations and `max_size` bytes. Sources without any
+        representation left are removed as well.
+
+        Each representation is removed while holding the same lock as
+        conversions for it (see :meth:`locked`). Representations used
+        while eviction runs are kept. This way evictions can run while
+        the cache is in use.
+
+        Returns a list of the cache keys removed.
+        """
+        self._check_writable()
+        entries, total_size, sources = [], 0, {}
+        for path in self._get_bucket_paths():
+            bucket = Bucket(path, self.paranoid, self.read_only)
+            if bucket.get_orphaned_sources():
+                with self._bucket_locked(os.path.basename(path)):
+                    bucket = Bucket(path, self.paranoid, self.read_only)
+                    for src_num in bucket.get_orphaned_sources():
+                        bucket.remove_source(src_num)
+            for bucket_key, last_access, size in bucket.get_entries():
+                src_num = bucket_key.split('_')[0]
+                if (path, src_num) not in sources:
+                    # [<SOURCE SIZE>, <NUMBER OF REPRESENTATIONS>]
+                    sources[(path, src_num)] = [
+                        bucket.get_source_size(src_num), 0]
+                    total_size += sources[(path, src_num)][0]
+                sources[(path, src_num)][1] += 1
+                entries.append((last_access, path, bucket_key, size))
+                total_size += size
+        entries.sort()
+        num_entries, now, removed = len(entries), time.time(), []
+        for last_access, path, bucket_key, size in entries:
+            if not (
+                    (self.max_age is not None and
+                     now - last_access > self.max_age) or
+                    (self.max_entries is not None and
+                     num_entries > self.max_entries) or
+                    (self.max_size is not None and
+                     total_size > self.max_size)):
+                break  # all remaining entries are newer
+            if not self._evict_entry(path, bucket_key, last_access):
+                continue
+            source = sources[(path, bucket_key.split('_')[0])]
+            source[1] -= 1
+            total_size -= size
+            if not source[1]:
+                total_size -= source[0]  # source was removed as well
+            num_entries -= 1
+            hash_digest = os.path.basename(path)
+            removed.append(self._compose_cache_key(hash_digest, bucket_key))
+        return removed
+
+    def _remove_digest_key(self, digest_key, cache_key):
+        """Remove ``digest`` key `digest_key` of `cache_key`.
+
+        The key is kept if it points to another representation.
+        """
+        if self._resolve_cache_key(digest_key) != cache_key:
+            return
+        try:
+            os.unlink(self._get_digest_key_path(digest_key))
+        except OSError:                         # pragma: no cover
+            pass  # removed in the meantime
+
+    def _evict_entry(self, bucket_path, bucket_key, last_access):
+        """Remove representation `bucket_key` from bucket in `bucket_path`.
+
+        The representation is kept if it was used after
+        `last_access`. Its ``digest`` key, if any, is removed as
+        well. Returns ``True`` if it was removed.
+
+        The bucket is read only after getting the locks, so that we
+        do not write back data changed by others in the meantime.
+        """
+        src_num, repr_num = bucket_key.split('_')
+        key_path = os.path.join(
+            bucket_path, 'keys', src_num, '%s.key' % repr_num)
+        repr_key = ''
+        if os.path.isfile(key_path):
+            with open(key_path, 'r') as fd:
+                repr_key = fd.read()
+        hash_digest = os.path.basename(bucket_path)
+        with self._locked(hash_digest, repr_key), self._bucket_locked(
+                hash_digest):
+            bucket = Bucket(bucket_path, self.paranoid, self.read_only)
+            repr_dir = os.path.join(bucket.resultdir, src_num, repr_num)
+            if not os.path.isdir(repr_dir):
+                return False
+            if os.path.getmtime(repr_dir) > last_access:
+                return False  # used in the meantime
+            digest_key = None
+            if self.key_scheme == 'digest':
+                src_digest = bucket.get_source_digest(src_num)
+                if src_digest is not None:
+                    digest_key = get_digest_key(src_digest, repr_key)
+            bucket.remove_representation(bucket_key)
+            if self.index is not None:
+                self.index.remove(hash_digest, bucket_key)
+            if digest_key is not None:
+                self._remove_digest_key(digest_key, self._compose_cache_key(
+                    hash_digest, bucket_key))
+        return True
+
+
+class CacheJanitor(threading.Thread):
+    """A thread that runs evictions of a cache manager regularly.
+
+    Calls :meth:`CacheManager.evict` of `cache_manager` every
+    `interval` seconds until :meth:`stop` is called. Janitors are
+    daemon threads, i.e. they do not keep a process alive.
+    """
+    def __init__(self, cache_manager, interval=600):
+        super(CacheJanitor, self).__init__(name='CacheJanitor')
+        self.daemon = True
+        self.cache_manager = cache_manager
+        self.interval = float(interval)
+        self._stopped = threading.Event()
+
+    def run(self):
+        logger = logging.getLogger('ulif.openoffice')
+        while not self._stopped.wait(self.interval):
+            try:
+                removed = self.cache_manager.evict()
+            except Exception:                   # pragma: no cover
+                logger.exception('Cache eviction failed')
+                continue
+            if removed:
+                logger.info('Removed %s entries from cache %s' % (
+                    len(removed), self.cache_manager.cache_dir))
+
+    def stop(self):
+        """Stop the janitor.
+        """
+        self._stopped.set()
+
+
+def start_cache_janitor(cache_manager, interval=600):
+    """Start a :class:`CacheJanitor` for `cache_manager`.
+
+    Nothing is started, if the cache manager has no limits set. Returns
+    the janitor started or ``None``.
+    """
+    if (cache_manager.max_size, cache_manager.max_entries,
+            cache_manager.max_age) == (None, None, None):
+        return None
+    janitor = CacheJanitor(cache_manager, interval=interval)
+    janitor.start()
+    return janitor
+
+
+def main(args=None):
+    """Remove entries from a cache dir to meet the given limits.
+    """
+    parser = argparse.ArgumentParser()
+    if args is None:                                    # pragma: no cover
+        args = sys.argv[1:]
+    else:
+        parser.prog = 'ooocache'
+    parser.description = "A tool to limit the size of a document cache."
+    parser.add_argument('cachedir', metavar='CACHEDIR',
+                        help='Path to a cache directory')
+    parser.add_argument('--max-size', type=string_to_bytes,
+                        help='Maximum size of cache, like "500M"')
+    parser.add_argument('--max-entries', type=int,
+                        help='Maximum number of cached documents')
+    parser.add_argument('--max-age', type=int,
+                        help='Seconds to keep unused documents')
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='Create or rebuild an index of the cache')
+    options = parser.parse_args(args)
+    cache_manager = CacheManager(
+        options.cachedir, max_size=options.max_size,
+        max_entries=options.max_entries, max_age=options.max_age)
+    if options.rebuild_index:
+        num = cache_manager.rebuild_index()
+        print("Indexed %s entries" % num)
+    removed = cache_manager.evict()
+    print("Removed %s entries from cache" % len(removed))
@@ -20,16 +20,120 @@
 Client API to access all functionality via programmatic calls.
 """
 import argparse
+import math
+import mimetypes
 import os
 import shutil
 import sys
 import tempfile
-from ulif.openoffice.cachemanager import CacheManager, get_marker
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from io import BytesIO
+try:
+    from urllib2 import urlopen, Request, HTTPError  # Python 2.x
+    from urllib import urlencode
+except ImportError:                                  # pragma: no cover
+    from urllib.request import urlopen, Request     # Python 3.x
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode
+try:
+    import queue                                     # Python 3.x
+except ImportError:                                  # pragma: no cover
+    import Queue as queue                            # Python 2.x
+from ulif.openoffice.cachemanager import (
+    BUCKET_DIGEST_ALGORITHM, CacheManager, digest_scope, get_file_digests,
+    get_marker, remember_file_digests)
 from ulif.openoffice.options import Options
 from ulif.openoffice.processor import MetaProcessor
 
 
-def convert_doc(src_doc, options, cache_dir):
+class Overloaded(Exception):
+    """Raised if a conversion cannot be admitted.
+
+    `retry_after` is the number of seconds after which a retry might
+    succeed.
+    """
+    def __init__(self, retry_after):
+        super(Overloaded, self).__init__(
+            'too many conversions, retry after %s seconds' % retry_after)
+        self.retry_after = retry_after
+
+
+class AdmissionControl(object):
+    """Limit the number of conversions running at the same time.
+
+    At most `max_running` conversions are admitted at a time. Up to
+    `max_waiting` further conversions wait for a free slot. Beyond
+    that, conversions are refused with :class:`Overloaded`
+    immediately. Both values can be given as strings (as read from
+    paste ini files). If `max_running` is ``None``, all conversions
+    are admitted.
+    """
+    #: Number of recent conversions to estimate conversion times.
+    history_size = 20
+
+    #: Conversion time (in seconds) assumed if there is no history.
+    default_duration = 10
+
+    def __init__(self, max_running=None, max_waiting=0):
+        if max_running in (None, ''):
+            max_running = None
+        else:
+            max_running = max(int(max_running), 1)
+        self.max_running = max_running
+        self.max_waiting = int(max_waiting or 0)
+        self.running = 0
+        self.waiting = 0
+        self._durations = deque(maxlen=self.history_size)
+        self._cond = threading.Condition()
+
+    def retry_after(self):
+        """Estimate seconds until a new conversion could be admitted.
+
+        Based on the number of waiting conversions and the average
+        time of recent conversions.
+        """
+        durations = list(self._durations) or [self.default_duration]
+        average = sum(durations) / float(len(durations))
+        slots = self.max_running or 1
+        return max(int(math.ceil(average * (self.waiting + 1) / slots)), 1)
+
+    @contextmanager
+    def admitted(self):
+        """A context manager that runs its body as an admitted conversion.
+
+        Waits for a free slot if necessary. Raises :class:`Overloaded`
+        if too many conversions are waiting already.
+        """
+        if self.max_running is None:
+            yield
+            return
+        with self._cond:
+            if self.running >= self.max_running:
+                if self.waiting >= self.max_waiting:
+                    raise Overloaded(self.retry_after())
+                self.waiting += 1
+                try:
+                    while self.running >= self.max_running:
+                        self._cond.wait()
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.running -= 1
+                self._durations.append(time.time() - start)
+                self._cond.notify()
+
+
+def convert_doc(src_doc, options, cache_dir, read_only=False,
+                source_digests=None, admission=None, cache_manager=None):
     """Convert `src_doc` according to the other parameters.
 
     `src_doc` is the path to the source document. `options` is a dict
@@ -42,9 +146,20 @@ def convert_doc(src_doc, options, cache_dir):
     :class:`ulif.openoffice.processor.MetaProcessor` with `options` as
     parameters.
 
-    Afterwards the conversion result is stored in cache (if
+    If caching is enabled, we look up the cache first. If a
+    representation of `src_doc` with the same `options` was stored
+    before, a copy of it is returned immediately, without any
+    conversion. The metadata then contain a ``cached`` entry set to
+    ``True``.
+
+    Otherwise the conversion result is stored in cache (if
     allowed/possible) for speedup of upcoming requests.
 
+    Concurrent requests to convert the same document with the same
+    options (in this process or in other processes sharing the same
+    `cache_dir`) are not run in parallel: they wait for the first one
+    to finish and then deliver its result from cache.
+
     Returns a triple:
 
       ``(<PATH>, <CACHE_KEY>, <METADATA>)``
@@ -57,36 +172,250 @@ def convert_doc(src_doc, options, cache_dir):
 
     If errors happen or caching is disabled, ``<CACHE_KEY>`` is
     ``None``.
+
+    With `read_only` set, the cache is only looked up but never
+    modified. Documents not found in cache are converted without
+    being stored.
+
+    `source_digests` can contain the digests of `src_doc` if they are
+    known already (see
+    :func:`ulif.openoffice.cachemanager.write_hashed`). The source is
+    then not read again for cache lookup or storage.
+
+    `admission` can be an :class:`AdmissionControl` instance limiting
+    the number of concurrent conversions. Documents found in cache
+    are delivered without asking it. If the conversion is not
+    admitted, :class:`Overloaded` is raised.
+
+    `cache_manager` can be a
+    :class:`ulif.openoffice.cachemanager.CacheManager` to use instead
+    of a new one for `cache_dir`, for instance to keep its settings
+    (like `sidecars`). Its `read_only` flag replaces `read_only` then.
     """
-    result_path = None
-    cache_key = None
     repr_key = get_marker(options)  # Create unique marker out of options
-    metadata = dict(error=False)
+    if admission is None:
+        admission = AdmissionControl()
+    if cache_manager is not None:
+        read_only = cache_manager.read_only
+    elif cache_dir:
+        cache_manager = CacheManager(cache_dir, read_only=read_only)
+    if cache_manager is None:
+        with admission.admitted():
+            result_path, metadata = _process_doc(src_doc, options)
+        return result_path, None, metadata
+
+    # Sources are hashed once for all cache operations of this call
+    with digest_scope():
+        if source_digests:
+            remember_file_digests(src_doc, source_digests)
+
+        if read_only:
+            result = _get_cached_copy(cache_manager, src_doc, repr_key)
+            if result is not None:
+                return result
+            with admission.admitted():
+                result_path, metadata = _process_doc(src_doc, options)
+            return result_path, None, metadata
+
+        cache_key = None
+        # Identical requests running concurrently wait for the first one
+        # and then get its result from cache.
+        with cache_manager.locked(src_doc, repr_key):
+            result = _get_cached_copy(cache_manager, src_doc, repr_key)
+            if result is not None:
+                return result
 
-    # Generate result
+            with admission.admitted():
+                result_path, metadata = _process_doc(src_doc, options)
+            error_state = metadata.get('error', False)
+            if not error_state and result_path is not None:
+                # Cache away generated doc
+                cache_key = cache_manager.register_doc(
+                    src_doc, result_path, repr_key)
+        return result_path, cache_key, metadata
+
+
+def convert_docs(src_docs, options, cache_dir, workers=4,
+                 source_digests=None, **kw):
+    """Convert the documents in `src_docs` concurrently.
+
+    `src_docs` is a list of paths to source documents, which are all
+    converted with the same `options` by :func:`convert_doc`. Up to
+    `workers` conversions run at the same time. `source_digests`, if
+    given, is a list of the digests of `src_docs` in the same
+    order. Other keywords are passed to :func:`convert_doc`.
+
+    This is a generator, yielding a tuple
+
+      ``(<SRC_DOC>, <PATH>, <CACHE_KEY>, <METADATA>)``
+
+    for each document as soon as its conversion is done. Failing
+    conversions do not stop the others; their metadata tell about
+    the error instead.
+
+    If the generator is closed before all results were delivered,
+    conversions not started yet are cancelled and running ones
+    waited for. Results not delivered are removed.
+    """
+    jobs, results = queue.Queue(), queue.Queue()
+
+    def work():
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            src_doc, digests = job
+            try:
+                result = convert_doc(
+                    src_doc, options, cache_dir, source_digests=digests,
+                    **kw)
+            except Exception as exc:
+                result = (None, None, {'error': True, 'error-descr': (
+                    str(exc) or exc.__class__.__name__)})
+            results.put((src_doc, ) + tuple(result))
+
+    if source_digests is None:
+        source_digests = [None] * len(src_docs)
+    for job in zip(src_docs, source_digests):
+        jobs.put(job)
+    threads = []
+    for num in range(max(min(int(workers), len(src_docs)), 1)):
+        jobs.put(None)
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        for src_doc in src_docs:
+            yield results.get()
+    finally:
+        # cancel jobs not started yet and wait for running ones
+        try:
+            while True:
+                jobs.get_nowait()
+        except queue.Empty:
+            pass
+        for thread in threads:
+            jobs.put(None)
+        for thread in threads:
+            thread.join()
+        while not results.empty():
+            result_path = results.get_nowait()[1]
+            if result_path is not None:
+                shutil.rmtree(
+                    os.path.dirname(result_path), ignore_errors=True)
+
+
+def _get_cached_copy(cache_manager, src_doc, repr_key):
+    """Get a copy of the representation of `src_doc` cached for `repr_key`.
+
+    Returns a triple as described in :func:`convert_doc` or ``None``
+    if no such representation is cached.
+    """
+    cached_path, cache_key = cache_manager.get_cached_file_by_source(
+        src_doc, repr_key)
+    if cached_path is None:
+        return None
+    # Deliver a copy, so that callers can handle it freely
+    result_path = os.path.join(
+        tempfile.mkdtemp(), os.path.basename(cached_path))
+    shutil.copy2(cached_path, result_path)
+    return result_path, cache_key, dict(error=False, cached=True)
+
+
+def _process_doc(src_doc, options):
+    """Run the processors defined in `options` over a copy of `src_doc`.
+
+    Returns a tuple ``(<PATH>, <METADATA>)`` as delivered by
+    :meth:`ulif.openoffice.processor.MetaProcessor.process`.
+    """
     input_copy_dir = tempfile.mkdtemp()
     input_copy = os.path.join(input_copy_dir, os.path.basename(src_doc))
     shutil.copy2(src_doc, input_copy)
     try:
         proc = MetaProcessor(options=options)  # Removes original doc
-        result_path, metadata = proc.process(input_copy)
+        return proc.process(input_copy)
     except Exception as exc:
         shutil.rmtree(input_copy_dir)
         raise exc
 
-    error_state = metadata.get('error', False)
-    if cache_dir and not error_state and result_path is not None:
-        # Cache away generated doc
-        cache_key = CacheManager(cache_dir).register_doc(
-            src_doc, result_path, repr_key)
-    return result_path, cache_key, metadata
+
+class _MultipartBody(object):
+    """A request body read from a sequence of byte strings and files.
+
+    Lets us send documents without reading them into memory at once.
+    `length` is the overall number of bytes.
+    """
+    def __init__(self, parts, length):
+        self.parts = deque([
+            BytesIO(part) if isinstance(part, bytes) else part
+            for part in parts])
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        result = b''
+        while self.parts and (size < 0 or len(result) < size):
+            chunk = self.parts[0].read(
+                size - len(result) if size >= 0 else -1)
+            if not chunk:
+                self.parts.popleft()
+            result += chunk
+        return result
+
+
+def _quote_filename(filename):
+    """Escape `filename` for use in a quoted header parameter.
+
+    Quotes and line breaks are percent-encoded like browsers do.
+    """
+    return filename.replace('"', '%22').replace(
+        '\r', '%0D').replace('\n', '%0A')
+
+
+def _encode_multipart(fields, filename, file_obj):
+    """Encode form `fields` and a document as `multipart/form-data`.
+
+    The document is sent as field ``doc``. Returns the content type
+    (including the boundary) and the request body. The body is a
+    file-like object reading `file_obj` only while it is sent.
+    """
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in fields:
+        lines.extend([
+            '--%s' % boundary,
+            'Content-Disposition: form-data; name="%s"' % name,
+            '', '%s' % value])
+    lines.extend([
+        '--%s' % boundary,
+        'Content-Disposition: form-data; name="doc"; filename="%s"' % (
+            _quote_filename(filename)),
+        'Content-Type: application/octet-stream', '', ''])
+    head = '\r\n'.join(lines).encode('utf-8')
+    tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+    size = os.fstat(file_obj.fileno()).st_size - file_obj.tell()
+    body = _MultipartBody(
+        [head, file_obj, tail], len(head) + size + len(tail))
+    return 'multipart/form-data; boundary=%s' % boundary, body
 
 
 class Client(object):
     """A client to trigger document conversions.
+
+    If `url` is given, documents are converted by the RESTful
+    document converter (see :mod:`ulif.openoffice.wsgi`) running
+    there, instead of locally. Before a document is uploaded, we ask
+    the server by digest whether it has a matching document in cache
+    already. If so, we only fetch the result.
     """
-    def __init__(self, cache_dir=None):
+    def __init__(self, cache_dir=None, url=None):
         self.cache_dir = cache_dir
+        self.url = url and url.rstrip('/')
+        self.digest_algorithms = (
+            CacheManager.hash_algorithm, BUCKET_DIGEST_ALGORITHM)
         self.cache_manager = None
         if self.cache_dir is not None:
             self.cache_manager = CacheManager(self.cache_dir)
@@ -95,10 +424,75 @@ class Client(object):
         """Convert `src_doc_path` according to `options`.
 
         Calls :func:`convert_doc` internally and returns the result
-        given by this function.
+        given by this function. If a server `url` was set, the
+        conversion is done by the server and we return a triple like
+        :func:`convert_doc` as well.
         """
+        if self.url is not None:
+            return self._convert_remote(src_doc_path, options)
         return convert_doc(src_doc_path, options, self.cache_dir)
 
+    def _convert_remote(self, src_doc_path, options):
+        """Convert `src_doc_path` with the server at :attr:`url`.
+        """
+        fields = sorted(options.items())
+        metadata = dict(error=False, cached=True)
+        try:
+            location = self._lookup(src_doc_path, fields)
+            resp = urlopen(location)
+        except HTTPError as err:
+            if err.code != 404:
+                raise
+            # not in cache: upload the document
+            metadata = dict(error=False)
+            with open(src_doc_path, 'rb') as fd:
+                content_type, body = _encode_multipart(
+                    fields, os.path.basename(src_doc_path), fd)
+                resp = urlopen(Request(
+                    '%s/docs' % self.url, data=body,
+                    headers={'Content-Type': content_type,
+                             'Content-Length': '%s' % len(body)}))
+            location = resp.info()['Location']
+        cache_key = location and location.split('/')[-1] or None
+        basename = os.path.splitext(os.path.basename(src_doc_path))[0]
+        ext = mimetypes.guess_extension(
+            resp.info()['Content-Type'].split(';')[0].strip()) or ''
+        result_path = os.path.join(tempfile.mkdtemp(), basename + ext)
+        with open(result_path, 'wb') as fd:
+            shutil.copyfileobj(resp, fd)
+        resp.close()
+        return result_path, cache_key, metadata
+
+    def _lookup(self, src_doc_path, fields):
+        """Ask the server at :attr:`url` for a converted document.
+
+        Returns the location of the document found. Raises
+        :exc:`HTTPError` if nothing was found.
+
+        The server tells in ``X-Digest-Algorithms`` which digests it
+        needs. If we did not send all of them, we remember the
+        algorithms in :attr:`digest_algorithms` and ask again.
+        """
+        while True:
+            algorithms = self.digest_algorithms
+            digests = get_file_digests(src_doc_path, algorithms)
+            params = [('digest.%s' % name, value)
+                      for name, value in sorted(digests.items())] + fields
+            try:
+                resp = urlopen('%s/docs/lookup?%s' % (
+                    self.url, urlencode(params)))
+            except HTTPError as err:
+                wanted = tuple((err.info().get(
+                    'X-Digest-Algorithms') or '').split())
+                if err.code != 404 or not wanted or set(wanted).issubset(
+                        algorithms):
+                    raise
+                self.digest_algorithms = wanted
+                continue
+            location = resp.info()['Location']
+            resp.close()
+            return location
+
     def get_cached(self, cache_key):
         """Get the document from cache stored under `cache_key`.
 
@@ -19,14 +19,26 @@
 """
 A convert office docs.
 """
+import json
 import logging
 import shlex
+import socket
 import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from multiprocessing import Lock
 from subprocess import Popen
 
 mutex = Lock()
 
+#: Template of connection strings to contact LibreOffice listeners.
+#: Expects a hostname and a port number.
+CONNECTION_URL = 'socket,host=%s,port=%d;urp;StarOffice.ComponentContext'
+
+#: The connection string used if no other is given.
+DEFAULT_URL = CONNECTION_URL % ('localhost', 2002)
+
 
 def threadsafe(func):
     """A decorator for functions to run threadsafe.
@@ -45,12 +57,219 @@ def threadsafe(func):
     return safe_func
 
 
-@threadsafe
+class Listener(object):
+    """A single LibreOffice listener, reachable via connection `url`.
+
+    Each listener converts one document at a time. Access is guarded
+    by a lock of its own, so that different listeners can work in
+    parallel.
+
+    A listener can be part of several pools. It then notifies all of
+    them when it becomes available.
+    """
+    def __init__(self, url=DEFAULT_URL):
+        self.url = url
+        self.lock = threading.Lock()
+        #: Number of conversions done by this listener.
+        self.served = 0
+        #: Seconds this listener spent on conversions so far.
+        self.busy_time = 0.0
+        #: Time the current conversion started.
+        self.started = None
+        #: Conditions of the pools this listener belongs to.
+        self.conditions = []
+
+    def __repr__(self):
+        return '<Listener %s>' % self.url
+
+
+class ListenerPool(object):
+    """A pool of LibreOffice listeners.
+
+    `urls` is a sequence of connection strings, one for each listener
+    (i.e. running soffice instance) in the pool.
+
+    Callers get a listener with :meth:`acquire` and must give it back
+    with :meth:`release` afterwards. Or they use the :meth:`listener`
+    context manager, which does both. If all listeners are busy,
+    callers are queued until one of the listeners becomes available.
+
+    Among available listeners we pick the least busy one, i.e. the
+    one that spent the least time on conversions so far.
+
+    Pass `listeners` to build a pool from existing :class:`Listener`
+    instances, otherwise new ones are created for `urls`.
+    """
+    def __init__(self, urls=(DEFAULT_URL, ), listeners=None):
+        if listeners is None:
+            listeners = [Listener(url) for url in urls]
+        self.listeners = list(listeners)
+        self._cond = threading.Condition()
+        for listener in self.listeners:
+            listener.conditions.append(self._cond)
+        #: Number of callers currently waiting for a listener.
+        self.waiting = 0
+
+    def __len__(self):
+        return len(self.listeners)
+
+    def acquire(self):
+        """Get a free listener.
+
+        Blocks until a listener is available. The listener returned is
+        locked and must be released with :meth:`release`.
+        """
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    for listener in sorted(
+                            self.listeners, key=lambda x: x.busy_time):
+                        if listener.lock.acquire(False):
+                            listener.started = time.time()
+                            return listener
+                    self._cond.wait()
+            finally:
+                self.waiting -= 1
+
+    def release(self, listener):
+        """Give back a `listener` retrieved by :meth:`acquire`.
+
+        All pools the listener belongs to are notified.
+        """
+        listener.served += 1
+        listener.busy_time += time.time() - listener.started
+        listener.lock.release()
+        # Waiters check for free listeners while holding the condition
+        # of their pool, so none of them misses this release.
+        for cond in listener.conditions:
+            with cond:
+                cond.notify()
+
+    @contextmanager
+    def listener(self):
+        """A context manager providing a locked listener.
+        """
+        listener = self.acquire()
+        try:
+            yield listener
+        finally:
+            self.release(listener)
+
+
+_pools = {}
+_listeners = {}
+_pools_lock = threading.Lock()
+
+
+def get_listener_pool(urls=None):
+    """Get the listener pool for listeners reachable under `urls`.
+
+    `urls` is a sequence of connection strings. If none is given, we
+    get a pool with only a listener at :data:`DEFAULT_URL`.
+
+    Pools are shared process-wide: the same set of `urls` will always
+    give the same pool, whatever the order of `urls`. Listeners are
+    shared as well: pools with overlapping `urls` use the same
+    :class:`Listener` for each url. This way we can create pools from
+    request options and still make sure, that each listener handles
+    only one document at a time.
+    """
+    if not urls:
+        urls = (DEFAULT_URL, )
+    key = tuple(sorted(set(urls)))
+    with _pools_lock:
+        if key not in _pools:
+            for url in key:
+                _listeners.setdefault(url, Listener(url))
+            _pools[key] = ListenerPool(
+                key, listeners=[_listeners[url] for url in key])
+        return _pools[key]
+
+
+class UnoconvBackend(object):
+    """A converter backend that runs `unoconv` in a subprocess.
+
+    Each conversion starts a new `unoconv` process, which connects to
+    the listener, converts and terminates afterwards.
+
+    `executable` - path to the unoconv executable to use. If none is
+      given the executable is looked up in the current system path.
+    """
+    def __init__(self, executable='unoconv'):
+        self.executable = executable
+
+    def convert(self, url, out_format, path, out_dir, filter_props=(),
+                template=None, timeout=5, doctype='document'):
+        """Convert the document in `path` and put the result in `out_dir`.
+
+        See :func:`convert` for the meaning of parameters.
+
+        Returns a tuple ``(<STATUS>, <OUTPUT>)`` where ``<STATUS>`` is
+        zero if everything went okay and ``<OUTPUT>`` contains any
+        messages of the backend.
+        """
+        logger = logging.getLogger('ulif.openoffice.convert')
+        cmd = '%s -c %s -f %s -o %s' % (
+            self.executable, url, out_format, out_dir)
+        cmd += ' -d %s' % (doctype,)
+        if template is not None:
+            cmd += ' -t %s' % (template,)
+        for filter_prop in filter_props:
+            cmd += ' -e %s=%s' % (filter_prop[0], str(filter_prop[1]))
+        cmd += " " + path
+        logger.info('Execute cmd: %s' % cmd)
+        return exec_cmd(cmd)
+
+
+class WorkerBackend(object):
+    """A converter backend that sends jobs to a long-running worker.
+
+    The worker (see :mod:`ulif.openoffice.worker`) listens on a local
+    UNIX socket at `socket_path` and keeps its connections to
+    LibreOffice listeners open between conversions. This saves the
+    costs of starting a new `unoconv` process for each document.
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def convert(self, url, out_format, path, out_dir, filter_props=(),
+                template=None, timeout=5, doctype='document'):
+        """Convert the document in `path` and put the result in `out_dir`.
+
+        See :meth:`UnoconvBackend.convert` for details.
+
+        If the worker cannot be contacted within `timeout` seconds, we
+        return a status different from zero.
+        """
+        logger = logging.getLogger('ulif.openoffice.convert')
+        job = dict(
+            url=url, out_format=out_format, path=path, out_dir=out_dir,
+            filter_props=[list(x) for x in filter_props],
+            template=template, doctype=doctype)
+        logger.info('Send job to worker at %s: %s' % (self.socket_path, job))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(self.socket_path)
+            sock.settimeout(None)  # conversions may take some time
+            sock.sendall(json.dumps(job).encode('utf-8') + b'\n')
+            reply = sock.makefile('rb').readline()
+        except (IOError, OSError) as err:
+            return 1, 'cannot contact worker: %s' % err
+        finally:
+            sock.close()
+        if not reply:
+            return 1, 'no reply from worker'
+        result = json.loads(reply.decode('utf-8'))
+        return result['status'], result['output']
+
+
 def convert(
-        url="socket,host=localhost,port=2002;urp;StarOffice.ComponentContext",
-        out_format='text', path=None, out_dir=None, filter_props=(),
-        template=None, timeout=5, doctype='document', executable='unoconv'):
-    """Convert some document using `unoconv`.
+        url=None, out_format='text', path=None, out_dir=None,
+        filter_props=(), template=None, timeout=5, doctype='document',
+        executable='unoconv', pool=None, backend=None):
+    """Convert some document using `unoconv` or another backend.
 
     Converts the document given in `path` to `out_format` and return a
     tuple containing status (0 if everything worked okay) as well as a
@@ -60,7 +279,9 @@ def convert(
     given and exists). It is the caller's responsibility to remove
     this directory after use.
 
-    `url` - connection string passed as `-c` parameter.
+    `url` - connection string passed as `-c` parameter. Ignored, if a
+      `pool` is given. If neither `url` nor `pool` is given, we use
+      :data:`DEFAULT_URL`.
 
     `out_format` - destination format as string. Must be one of the
        formats provided by `unoconv --show`.
@@ -90,24 +311,33 @@ def convert(
 
     `executable` - path to the unoconv executable to use. If none is
       given the executable is looked up in the current system path.
+      Ignored, if a `backend` is given.
+
+    `pool` - a :class:`ListenerPool` to pick a listener from. If none
+      is given, we use the (shared) pool for `url`. The conversion
+      waits until a listener of the pool is available. Conversions
+      that use different listeners run in parallel.
+
+    `backend` - the converter backend that does the real work. If
+      none is given, we use an :class:`UnoconvBackend`, i.e. run
+      `unoconv`. See also :class:`WorkerBackend`.
     """
     if not path:
         return None, None
     logger = logging.getLogger('ulif.openoffice.convert')
+    if pool is None:
+        pool = get_listener_pool([url or DEFAULT_URL])
+    if backend is None:
+        backend = UnoconvBackend(executable)
     new_dir = out_dir
     if new_dir is None:
         new_dir = tempfile.mkdtemp()
     logger.debug('Created dir: %s' % new_dir)
-    cmd = '%s -c %s -f %s -o %s' % (
-        executable, url, out_format, new_dir)
-    cmd += ' -d %s' % (doctype,)
-    if template is not None:
-        cmd += ' -t %s' % (template,)
-    for filter_prop in filter_props:
-        cmd += ' -e %s=%s' % (filter_prop[0], str(filter_prop[1]))
-    cmd += " " + path
-    logger.info('Execute cmd: %s' % cmd)
-    status, out = exec_cmd(cmd)
+    with pool.listener() as listener:
+        status, out = backend.convert(
+            listener.url, out_format, path, new_dir,
+            filter_props=filter_props, template=template, timeout=timeout,
+            doctype=doctype)
     logger.info('Cmd result: %s' % status)
     logger.debug('Cmd output:\n%s\n' % (out,))
     return status, new_dir
@@ -20,19 +20,17 @@
 Helpers for trivial jobs.
 """
 import base64
-import cssutils
 import logging
 import os
 import re
 import shutil
 import tempfile
+import threading
 import zipfile
-from bs4 import BeautifulSoup, UnicodeDammit
 try:
     from cStringIO import StringIO  # Python 2.x
 except ImportError:                 # pragma: no cover
     from io import StringIO         # Python 3.x
-from pkg_resources import iter_entry_points
 try:
     from urlparse import urlparse         # Python 2.x
 except ImportError:                       # pragma: no cover
@@ -146,6 +144,36 @@ def copy_to_secure_location(src):
     return dst
 
 
+def move_to_secure_location(src):
+    """Move `src` to a temporary location.
+
+    If `src` is a file, the complete directory containing this file
+    will be moved. If `src` is a directory this directory will be
+    moved.
+
+    Returns the path of the new directory.
+
+    Different to :func:`copy_to_secure_location` the original
+    directory is gone afterwards. Where possible, the directory is
+    simply renamed, which is cheap, regardless of the directory
+    size. If that fails (for instance because the new location
+    resides in a different filesystem), the directory tree is copied
+    and the original removed.
+    """
+    if os.path.isfile(src):
+        src = os.path.dirname(src)
+    src = os.path.abspath(src)
+    assert src not in ['/', '/tmp']  # Safety belt
+    dst = tempfile.mkdtemp()
+    try:
+        # replaces the empty `dst` dir on POSIX systems
+        os.rename(src, dst)
+    except OSError:
+        copytree(src, dst)
+        shutil.rmtree(src)
+    return dst
+
+
 def get_entry_points(group):
     """Get all entry point plugins registered for group `group`.
 
@@ -153,10 +181,22 @@ def get_entry_points(group):
     key and ``<PLUGIN>`` as value where ``<NAME>`` is the name under
     which the respective plugin was registered with setuptools and
     ``<PLUGIN>`` is the registered component itself.
+
+    Entry points are looked up with :mod:`importlib.metadata` where
+    available, as importing :mod:`pkg_resources` is expensive.
     """
-    return dict(
-        [(x.name, x.load())
-         for x in iter_entry_points(group=group)])
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:                                # pragma: no cover
+        from pkg_resources import iter_entry_points    # Python < 3.8
+        found = iter_entry_points(group=group)
+    else:
+        found = entry_points()
+        if hasattr(found, 'select'):
+            found = found.select(group=group)
+        else:                                          # pragma: no cover
+            found = found.get(group, [])               # Python < 3.10
+    return dict([(x.name, x.load()) for x in found])
 
 
 def unzip(path, dst_dir):
@@ -291,7 +331,20 @@ def extract_css(html_input, basename='sample.html', prettify_html=False):
     # create HTML massage that removes CDATA and HTML comments in styles
     for fix, m in CDATA_MASSAGE:
         html_input = fix.sub(m, html_input)
+    from bs4 import BeautifulSoup, UnicodeDammit
     soup = BeautifulSoup(html_input, 'html.parser')
+    css = _extract_css_from_soup(soup, basename)
+    if prettify_html:
+        return soup.prettify(), css
+    return UnicodeDammit(str(soup)).markup, css
+
+
+def _extract_css_from_soup(soup, basename):
+    """Replace all styles in `soup` with a single link to a CSS file.
+
+    `soup` is modified in place. Returns the CSS code found or
+    ``None``. See :func:`extract_css` for details.
+    """
     css = '\n'.join([style.text for style in soup.findAll('style')])
     if '<style>' in css:
         css = css.replace('<style>', '\n')
@@ -328,9 +381,7 @@ def extract_css(html_input, basename='sample.html', prettify_html=False):
             style.extract()
     if css == '':
         css = None
-    if prettify_html:
-        return soup.prettify(), css
-    return UnicodeDammit(str(soup)).markup, css
+    return css
 
 
 RE_HEAD_NUM = re.compile('(<h[1-6][^>]*>\s*)(([\d\.]+)+)([^\d])',
@@ -377,6 +428,11 @@ def cleanup_html(html_input, basename,
     return html_input, img_name_map
 
 
+#: Lock guarding the global state of `cssutils` (its log and
+#: serializer) while cleaning CSS.
+CSS_LOCK = threading.Lock()
+
+
 def cleanup_css(css_input, minified=True):
     """Cleanup CSS code delivered in `css_input`, a string.
 
@@ -390,26 +446,42 @@ def cleanup_css(css_input, minified=True):
     to ``False``.
 
     We expect and return texts, not bytestreams.
+
+    This function is thread-safe: each call uses its own parser, log
+    and serializer. As `cssutils` still routes logging and
+    serializing through module globals, these are installed via the
+    public `cssutils` API while :data:`CSS_LOCK` is held and reset
+    afterwards to the previous serializer and the default
+    ``CSSUTILS`` logger.
     """
-    # Set up a local logger for warnings and errors
+    import cssutils
+    # Set up a local logger for warnings and errors. It is not
+    # registered with `logging`, so it is garbage collected after
+    # use and does not pass any records to other handlers.
     local_log = StringIO()
     handler = logging.StreamHandler(local_log)
     handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
-    handler.propagate = False
-    handler.setLevel(logging.WARNING)
-    logger = logging.getLogger()
+    logger = logging.Logger('ulif.openoffice.cssutils', logging.WARNING)
+    logger.propagate = False
     logger.addHandler(handler)
 
-    cssutils.log.setLog(logger)
-    cssutils.ser.prefs.useDefaults()
+    prefs = cssutils.serialize.Preferences()
     if minified is True:
-        cssutils.ser.prefs.useMinified()
+        prefs.useMinified()
+    serializer = cssutils.serialize.CSSSerializer(prefs=prefs)
 
-    sheet = cssutils.parseString(css_input)
-
-    local_log.flush()
-    encoding = sheet.encoding or 'utf-8'
-    css_text = sheet.cssText.decode(encoding)
+    with CSS_LOCK:
+        old_ser = cssutils.ser
+        parser = cssutils.CSSParser(log=logger)
+        cssutils.setSerializer(serializer)
+        try:
+            sheet = parser.parseString(css_input)
+            encoding = sheet.encoding or 'utf-8'
+            css_text = sheet.cssText.decode(encoding)
+        finally:
+            cssutils.log.setLog(logging.getLogger('CSSUTILS'))
+            cssutils.setSerializer(old_ser)
+    handler.flush()
     return css_text, local_log.getvalue()
 
 
@@ -444,7 +516,18 @@ def rename_html_img_links(html_input, basename):
     I.e. you will get unicode snippets under Python 2.x and text
     (or `str`) under Python 3.x.
     """
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html_input, 'html.parser')
+    img_map = _rename_img_links_in_soup(soup, basename)
+    return soup.decode(), img_map
+
+
+def _rename_img_links_in_soup(soup, basename):
+    """Rename all ``<img>`` tag ``src`` attributes in `soup`.
+
+    `soup` is modified in place. Returns a mapping from old filenames
+    to new ones. See :func:`rename_html_img_links` for details.
+    """
     img_tags = soup.findAll('img')
     img_map = {}
     num = 1
@@ -469,7 +552,7 @@ def rename_html_img_links(html_input, basename):
         num += 1
         tag['src'] = new_src
         img_map[src] = new_src
-    return soup.decode(), img_map
+    return img_map
 
 
 RE_SDFIELD_OPEN = re.compile('<sdfield([^>]*)>', re.M + re.S + re.I)
@@ -489,6 +572,66 @@ def rename_sdfield_tags(html_input):
         RE_SDFIELD_CLOSE, lambda match: '</span>', html_input)
 
 
+RE_HEAD_NUM_TEXT = re.compile('^(\\s*)([\\d\\.]+)(.*)$', re.M + re.S)
+
+
+def cleanup_html_css(html_input, basename, fix_head_nums=True,
+                     fix_img_links=True, fix_sdfields=True,
+                     prettify_html=False):
+    """Clean up HTML code and extract its styles in one go.
+
+    Does the work of :func:`cleanup_html` and :func:`extract_css`
+    (see there for the meaning of the parameters), but parses
+    `html_input` only once and also serializes the result only once.
+
+    Returns a tuple ``(<HTML_OUTPUT>, <CSS-CODE>, <IMG_NAME_MAP>)``.
+    The CSS code returned is not cleaned up yet. Use
+    :func:`cleanup_css` for that.
+    """
+    for fix, m in CDATA_MASSAGE:
+        html_input = fix.sub(m, html_input)
+    from bs4 import BeautifulSoup, UnicodeDammit
+    soup = BeautifulSoup(html_input, 'html.parser')
+    img_name_map = {}
+    if fix_img_links is True:
+        img_name_map = _rename_img_links_in_soup(soup, basename)
+    if fix_sdfields is True:
+        for tag in soup.findAll('sdfield'):
+            tag.name = 'span'
+            attrs = dict(tag.attrs)
+            tag.attrs = {'class': 'sdfield'}
+            tag.attrs.update(attrs)
+    if fix_head_nums is True:
+        for tag in soup.findAll(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
+            _wrap_head_num(soup, tag)
+    css = _extract_css_from_soup(soup, basename)
+    if prettify_html:
+        return soup.prettify(), css, img_name_map
+    return UnicodeDammit(str(soup)).markup, css, img_name_map
+
+
+def _wrap_head_num(soup, tag):
+    """Wrap a leading heading number of heading `tag` in a span tag.
+    """
+    from bs4 import Comment, NavigableString
+    if not tag.contents:
+        return
+    text = tag.contents[0]
+    if not isinstance(text, NavigableString) or isinstance(text, Comment):
+        return
+    match = RE_HEAD_NUM_TEXT.match(text)
+    if match is None:
+        return
+    span = soup.new_tag('span')
+    span['class'] = 'u-o-headnum'
+    span.string = match.group(2)
+    text.replace_with(span)
+    if match.group(1):
+        span.insert_before(match.group(1))
+    if match.group(3):
+        span.insert_after(match.group(3))
+
+
 def base64url_encode(string):
     """Get a base64url encoding of string.
 
@@ -583,6 +726,59 @@ def string_to_stringtuple(string, strict=False):
     return tuple(result)
 
 
+def string_to_listeners(string):
+    """Convert a string into a tuple of ``(<HOST>, <PORT>)`` tuples.
+
+    The input string is expected to contain comma-separated
+    ``<HOST>:<PORT>`` values, each naming a LibreOffice listener. If
+    the port is omitted, we assume the default port ``2002``.
+
+       >>> string_to_listeners('localhost:2002, otherhost:2003')
+       (('localhost', 2002), ('otherhost', 2003))
+
+    Empty strings or ``None`` result in an empty tuple. Values that
+    cannot be parsed raise a :exc:`ValueError`.
+    """
+    result = []
+    for item in string_to_stringtuple(string):
+        host, sep, port = item.partition(':')
+        host = host.strip()
+        if not host:
+            raise ValueError('Not a valid listener: %s' % item)
+        if not sep:
+            port = 2002
+        result.append((host, int(port)))
+    return tuple(result)
+
+
+#: Multipliers for size suffixes accepted by `string_to_bytes`.
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def string_to_bytes(string):
+    """Convert a size given as string into a number of bytes.
+
+    Sizes can be plain numbers or numbers with one of the suffixes
+    ``K``, ``M``, or ``G`` (case does not matter):
+
+       >>> string_to_bytes('512M')
+       536870912
+
+    Empty strings or ``None`` result in ``None``. Integers are returned
+    unchanged. Values that cannot be parsed raise a :exc:`ValueError`.
+    """
+    if string is None or isinstance(string, int):
+        return string
+    string = string.strip().upper()
+    if not string:
+        return None
+    unit = string[-1] if string[-1] in SIZE_UNITS else ''
+    number = string[:len(string) - len(unit)].strip()
+    if not number.isdigit():
+        raise ValueError('Not a valid size: %s' % string)
+    return int(number) * SIZE_UNITS[unit]
+
+
 def filelike_cmp(file1, file2, chunksize=512):
     """Compare `file1` and `file2`.
 
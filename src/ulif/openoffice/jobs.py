@@ -0,0 +1,230 @@
+#
+# jobs.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+Background conversion jobs.
+
+A :class:`JobQueue` runs conversions in a fixed number of worker
+threads, so that long conversions do not have to block a request
+until they are done.
+
+Each job lives in a directory of its own below the job dir. The
+directory holds a copy of the source document and a file
+``job.json`` with the state of the job::
+
+  <JOB_DIR>/
+     <JOB_ID>/
+        job.json
+        <SOURCE_DOC>
+
+As the state of all jobs is kept on disk, jobs queued or running
+when a process stops are queued again by the next :class:`JobQueue`
+working on the same job dir.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+try:
+    import queue                # Python 3.x
+except ImportError:             # pragma: no cover
+    import Queue as queue       # Python 2.x
+from ulif.openoffice.client import convert_doc
+
+#: States of jobs.
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+#: Name of files holding job states.
+JOB_FILE = 'job.json'
+
+#: Regular expression job ids must match.
+RE_JOB_ID = re.compile('^[0-9a-f]{32}$')
+
+
+class JobQueue(object):
+    """A queue of conversion jobs stored in `job_dir`.
+
+    Jobs are run by `workers` threads, each converting one document
+    at a time via :func:`ulif.openoffice.client.convert_doc` and
+    storing results in the cache at `cache_dir`. Results of jobs are
+    available from cache only, therefore `cache_dir` is required.
+
+    Finished jobs are kept `max_age` seconds and removed afterwards.
+
+    `cache_manager` can be a
+    :class:`ulif.openoffice.cachemanager.CacheManager` for `cache_dir`
+    used for all conversions.
+
+    A job dir must not be shared by several processes: each queue
+    runs all unfinished jobs it finds on startup.
+    """
+    def __init__(self, job_dir, cache_dir, workers=2, max_age=86400,
+                 cache_manager=None):
+        self.job_dir = os.path.abspath(job_dir)
+        self.cache_dir = cache_dir
+        self.cache_manager = cache_manager
+        self.max_age = float(max_age)
+        self._queue = queue.Queue()
+        self._last_purge = 0
+        self._stopped = threading.Event()
+        if not os.path.isdir(self.job_dir):
+            os.makedirs(self.job_dir)
+        self._recover()
+        self._threads = []
+        for num in range(int(workers)):
+            thread = threading.Thread(
+                target=self._work, name='JobWorker-%s' % num)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _get_path(self, job_id, *parts):
+        return os.path.join(self.job_dir, job_id, *parts)
+
+    def _write_state(self, job_id, data):
+        # write to a temporary file first, so that readers never see
+        # incomplete states.
+        path = self._get_path(job_id, JOB_FILE)
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(data, fd)
+        os.rename(path + '.tmp', path)
+
+    def get(self, job_id):
+        """Get the state of job `job_id`.
+
+        Returns a dict with (at least) keys ``id``, ``state`` (one of
+        :data:`QUEUED`, :data:`RUNNING`, :data:`DONE`, or
+        :data:`FAILED`), and ``created``. Done jobs provide a
+        ``cache_key``, failed ones an ``error`` message.
+
+        Returns ``None`` if no such job exists.
+        """
+        if not RE_JOB_ID.match(job_id or ''):
+            return None
+        try:
+            with open(self._get_path(job_id, JOB_FILE), 'r') as fd:
+                return json.load(fd)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def submit(self, src_path, options, source_digests=None):
+        """Queue conversion of `src_path` with `options`.
+
+        The source document is moved into the job dir. `source_digests`
+        are passed to :func:`ulif.openoffice.client.convert_doc`.
+
+        Returns the id of the new job.
+        """
+        self.purge()
+        job_id = uuid.uuid4().hex
+        os.mkdir(self._get_path(job_id))
+        filename = os.path.basename(src_path)
+        shutil.move(src_path, self._get_path(job_id, filename))
+        self._write_state(job_id, dict(
+            id=job_id, state=QUEUED, created=time.time(), source=filename,
+            options=options, digests=source_digests))
+        self._queue.put(job_id)
+        return job_id
+
+    def purge(self):
+        """Remove finished jobs older than `max_age` seconds.
+
+        Runs at most once a minute.
+        """
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        for job_id in os.listdir(self.job_dir):
+            data = self.get(job_id)
+            if data is None or data['state'] not in (DONE, FAILED):
+                continue
+            if now - data.get('finished', now) > self.max_age:
+                shutil.rmtree(self._get_path(job_id), ignore_errors=True)
+
+    def _recover(self):
+        # queue again all jobs that were not finished
+        unfinished = []
+        for job_id in os.listdir(self.job_dir):
+            data = self.get(job_id)
+            if data is not None and data['state'] in (QUEUED, RUNNING):
+                unfinished.append((data['created'], job_id, data))
+        for created, job_id, data in sorted(unfinished):
+            data['state'] = QUEUED
+            self._write_state(job_id, data)
+            self._queue.put(job_id)
+        self.purge()
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            if self._stopped.is_set():
+                break
+            self.run_job(job_id)
+
+    def run_job(self, job_id):
+        """Run the job `job_id`.
+
+        Called by the worker threads. The source of the job is removed
+        afterwards.
+        """
+        logger = logging.getLogger('ulif.openoffice.jobs')
+        data = self.get(job_id)
+        if data is None:
+            return
+        data.update(state=RUNNING, started=time.time())
+        self._write_state(job_id, data)
+        src_path = self._get_path(job_id, data['source'])
+        try:
+            result_path, cache_key, metadata = convert_doc(
+                src_path, data['options'], self.cache_dir,
+                source_digests=data.get('digests'),
+                cache_manager=self.cache_manager)
+        except Exception as err:
+            logger.exception('Job %s failed' % job_id)
+            data.update(state=FAILED, error='%s' % err)
+        else:
+            if result_path is not None:
+                # the result is in cache now
+                shutil.rmtree(
+                    os.path.dirname(result_path), ignore_errors=True)
+            if metadata.get('error') or cache_key is None:
+                data.update(state=FAILED, error=metadata.get(
+                    'error-descr', 'conversion failed'))
+            else:
+                data.update(state=DONE, cache_key=cache_key)
+        data['finished'] = time.time()
+        self._write_state(job_id, data)
+        if os.path.exists(src_path):
+            os.unlink(src_path)
+
+    def stop(self):
+        """Stop all workers once the current jobs are done.
+
+        Jobs still queued are run by the next queue using the same job
+        dir.
+        """
+        self._stopped.set()
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
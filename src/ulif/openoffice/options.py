@@ -20,8 +20,9 @@
 Components to configure processors.
 """
 import re
-from argparse import ArgumentParser
-from ulif.openoffice.helpers import get_entry_points
+import threading
+from argparse import ArgumentParser, ArgumentTypeError
+from ulif.openoffice.helpers import basestring, get_entry_points
 
 #: Regular expression to check short argument names like ``-opt``.
 RE_SHORT_NAME = re.compile('^-[a-zA-Z0-9][a-zA-Z0-9\-_]*$')
@@ -51,8 +52,14 @@ class Argument(object):
     each option (whether long or short) should begin with the
     processor prefix: ``-myproc-myopt, --myproc-myoption`` for
     example to avoid clashes with other processors options.
+
+    Set `affects_output` to ``False`` for options that do not change
+    the documents created, like the host to contact for
+    conversions. These options are not part of the
+    :func:`canonical_options` used to find docs in cache.
     """
-    def __init__(self, short_name, long_name=None, **kw):
+    def __init__(self, short_name, long_name=None, affects_output=True,
+                 **kw):
         if not RE_SHORT_NAME.match(short_name):
             raise ValueError(
                 'Argument short names must have format `-proc-name`')
@@ -61,8 +68,20 @@ class Argument(object):
                 'Argument long names musts have format `--proc-name`')
         self.short_name = short_name
         self.long_name = long_name
+        self.affects_output = affects_output
         self.keywords = kw
 
+    @property
+    def dest(self):
+        """The key of this argument in :class:`Options`.
+
+        Like with argparse, this is the long name (or the short name,
+        if no long name is set) without leading dashes and with all
+        other dashes turned into underscores.
+        """
+        return (self.long_name or self.short_name).lstrip('-').replace(
+            '-', '_')
+
     @property
     def default_string(self):
         """Get a string representation of the default value.
@@ -74,6 +93,30 @@ class Argument(object):
             return ', '.join(value)
         return str(value)
 
+    def convert(self, value):
+        """Convert `value` as an argument parser would do.
+
+        `value` is converted by the `type` of this argument (if any)
+        and checked against its `choices` (if any). Raises
+        :exc:`ArgumentParserError` if `value` is invalid.
+        """
+        name = '/'.join([x for x in (self.short_name, self.long_name) if x])
+        type_func = self.keywords.get('type')
+        if type_func is not None:
+            try:
+                value = type_func(value)
+            except (ArgumentTypeError, TypeError, ValueError):
+                raise ArgumentParserError(
+                    'argument %s: invalid %s value: %r' % (
+                        name, getattr(type_func, '__name__', type_func),
+                        value))
+        choices = self.keywords.get('choices')
+        if choices is not None and value not in choices:
+            raise ArgumentParserError(
+                'argument %s: invalid choice: %r (choose from %s)' % (
+                    name, value, ', '.join([repr(x) for x in choices])))
+        return value
+
 
 class ArgumentParserError(Exception):
     """An error raised if argument parsing fails.
@@ -94,6 +137,142 @@ class ExceptionalArgumentParser(ArgumentParser):
         raise ArgumentParserError(message)
 
 
+def _get_spelling(key):
+    # `key` without dashes and underscores
+    return key.replace('-', '').replace('_', '')
+
+
+class ProcessorRegistry(object):
+    """The processors registered for `group` and their options.
+
+    Processors are looked up as entry points once, when first
+    needed. Along with them we keep the :class:`Argument` of each
+    processor option, an argument parser knowing all of them, and
+    the default values. All this is shared by the whole process.
+
+    Call :meth:`invalidate` to look up processors again, for instance
+    after new plugins were installed.
+    """
+    def __init__(self, group='ulif.openoffice.processors'):
+        self.group = group
+        self._lock = threading.RLock()
+        self._schema = None
+
+    def _get_schema(self):
+        schema = self._schema
+        if schema is None:
+            with self._lock:
+                if self._schema is None:
+                    self._schema = self._build_schema()
+                schema = self._schema
+        return schema
+
+    def _build_schema(self):
+        # Argument types are not called here but only after the
+        # schema is set, as they might ask the registry themselves
+        # (like `processor_order`).
+        processors = get_entry_points(self.group)
+        parser = ExceptionalArgumentParser()
+        arguments, names = dict(), dict()
+        for proc in processors.values():
+            for arg in proc.args:
+                parser.add_argument(
+                    arg.short_name, arg.long_name, **arg.keywords)
+                arguments[arg.short_name[1:]] = arg
+                for name in (arg.short_name, arg.long_name):
+                    if name:
+                        names[name[1:]] = arg
+        return dict(
+            processors=processors, parser=parser, arguments=arguments,
+            names=names, defaults=None,
+            spellings=dict([(_get_spelling(key), key) for key in names]))
+
+    def _get_argument(self, schema, key):
+        # get the argument for `key` like argparse would do for an
+        # option ``-<key>``: short and long names (with one dash
+        # less) and their unique prefixes are accepted.
+        arg = schema['names'].get(key)
+        if arg is not None or not key:
+            return arg
+        args = set([arg for name, arg in schema['names'].items()
+                    if name.startswith(key)])
+        if len(args) > 1:
+            raise ArgumentParserError(
+                'ambiguous option: -%s could match %s' % (key, ', '.join(
+                    sorted([arg.short_name for arg in args]))))
+        return args and args.pop() or None
+
+    def invalidate(self):
+        """Forget all processors and options looked up so far.
+        """
+        with self._lock:
+            self._schema = None
+
+    @property
+    def processors(self):
+        """A dict mapping processor names to processor classes.
+        """
+        return dict(self._get_schema()['processors'])
+
+    @property
+    def arguments(self):
+        """A dict mapping string keys to :class:`Argument` instances.
+
+        See :attr:`Options.string_keys` for string keys.
+        """
+        return dict(self._get_schema()['arguments'])
+
+    @property
+    def defaults(self):
+        """A dict with the default values of all processor options.
+        """
+        schema = self._get_schema()
+        defaults = schema['defaults']
+        if defaults is None:
+            defaults = schema['defaults'] = vars(
+                schema['parser'].parse_known_args([])[0])
+        return dict(defaults)
+
+    def parse(self, string_dict):
+        """Parse the string values in `string_dict`.
+
+        Keys of `string_dict` are string keys of processor options,
+        values are converted by the respective :class:`Argument`. Like
+        with argument parsers, long names with one leading dash (like
+        ``-oocp-output-format``) and unique prefixes of names are
+        accepted as keys as well.
+
+        Returns a dict with options as keys and converted values as
+        values, like in :class:`Options`. Unknown keys are ignored,
+        except if they differ from a known one in dashes or
+        underscores only (a typo, most probably). These, ambiguous
+        prefixes, and invalid values raise :exc:`ArgumentParserError`.
+        """
+        schema = self._get_schema()
+        result = dict()
+        for key, value in string_dict.items():
+            arg = self._get_argument(schema, key)
+            if arg is None:
+                known = schema['spellings'].get(_get_spelling(key))
+                if known is not None:
+                    raise ArgumentParserError(
+                        'unrecognized arguments: -%s (did you mean -%s?)' % (
+                            key, known))
+                continue
+            if 'action' in arg.keywords or 'nargs' in arg.keywords:
+                # too complex for us, ask the parser
+                namespace, trash = schema['parser'].parse_known_args(
+                    (arg.short_name, value))
+                result[arg.dest] = getattr(namespace, arg.dest)
+                continue
+            result[arg.dest] = arg.convert(value)
+        return result
+
+
+#: The process-wide registry of processors.
+registry = ProcessorRegistry()
+
+
 class Options(dict):
     """Options are dicts that automatically set processor options.
 
@@ -131,7 +310,7 @@ class Options(dict):
         respective prefix). Values are the classes implementing the
         respective processor.
         """
-        return get_entry_points('ulif.openoffice.processors')
+        return registry.processors
 
     @property
     def string_keys(self):
@@ -152,28 +331,24 @@ class Options(dict):
              'html-cleaner-fix-sd-fields',
              'meta-procord',
              'oocp-host',
+             'oocp-listeners',
              'oocp-out-fmt',
              'oocp-pdf-tagged',
              'oocp-pdf-version',
-             'oocp-port']
+             'oocp-port',
+             'oocp-worker']
 
         So, you can create an `Options` dict with overridden defaults
         for instance by passing in something like
         ``string_dict={'oocp-out-fmt': 'pdf'}``.
         """
-        result = []
-        for proc in self.avail_procs.values():
-            result.extend([x.short_name[1:] for x in proc.args])
-        return sorted(result)
+        return sorted(registry.arguments)
 
     def __init__(self, val_dict=None, string_dict=None):
         super(Options, self).__init__()
-        args = []
+        self.update(registry.defaults)
         if string_dict is not None:
-            args = dict_to_argtuple(string_dict)
-        parser = self.get_arg_parser()
-        defaults, trash = parser.parse_known_args(args)
-        self.update(vars(defaults))
+            self.update(registry.parse(string_dict))
         if val_dict is not None:
             self.update(val_dict)
 
@@ -196,3 +371,39 @@ class Options(dict):
                 parser.add_argument(
                     arg.short_name, arg.long_name, **arg.keywords)
         return parser
+
+
+def canonical_options(options):
+    """Get the options in `options` that affect output, normalized.
+
+    `options` can be an :class:`Options` instance or a dict of
+    string values as accepted by :class:`Options` as `string_dict`.
+
+    Returns a sorted list of ``(<NAME>, <VALUE>)`` tuples for all
+    processor options with `affects_output` set (see
+    :class:`Argument`). Names are given as in :class:`Options`, values
+    are converted by the `type` of the respective argument if they
+    are strings and lists turned into tuples. So, option sets that
+    lead to the same output, give the same result::
+
+      >>> canonical_options({'oocp-pdf-tagged': 'yes'}) == (
+      ...     canonical_options({'oocp-pdf-tagged': '1', 'oocp-port': '1'}))
+      True
+
+    Unknown options are ignored while invalid values of known ones
+    raise :exc:`ArgumentParserError`.
+    """
+    if not isinstance(options, Options):
+        options = Options(string_dict=options)
+    result = dict()
+    for proc in options.avail_procs.values():
+        for arg in proc.args:
+            if not arg.affects_output or arg.dest not in options:
+                continue
+            value = options[arg.dest]
+            if isinstance(value, basestring) and 'type' in arg.keywords:
+                value = arg.convert(value)
+            if isinstance(value, list):
+                value = tuple(value)
+            result[arg.dest] = value
+    return sorted(result.items())
@@ -40,13 +40,15 @@ import codecs
 import os
 import shutil
 import tempfile
-from ulif.openoffice.convert import convert
+from ulif.openoffice.convert import (
+    convert, get_listener_pool, CONNECTION_URL, WorkerBackend)
 from ulif.openoffice.helpers import (
-    copy_to_secure_location, get_entry_points, zip, unzip, remove_file_dir,
-    extract_css, cleanup_html, cleanup_css, rename_sdfield_tags,
-    string_to_stringtuple)
+    move_to_secure_location, zip, unzip, remove_file_dir,
+    extract_css, cleanup_html, cleanup_css, cleanup_html_css,
+    rename_sdfield_tags,
+    string_to_stringtuple, string_to_listeners)
 from ulif.openoffice.helpers import strict_string_to_bool as boolean
-from ulif.openoffice.options import Argument, Options
+from ulif.openoffice.options import Argument, Options, registry
 
 
 #: The default order, processors are run.
@@ -55,7 +57,7 @@ DEFAULT_PROCORDER = 'unzip,oocp,tidy,html_cleaner,css_cleaner,zip'
 
 def processor_order(string):
     proc_tuple = string_to_stringtuple(string)
-    proc_names = get_entry_points('ulif.openoffice.processors').keys()
+    proc_names = registry.processors.keys()
     for name in proc_tuple:
         if name not in proc_names:
             raise ValueError('Only values in %r are allowed.' % proc_names)
@@ -149,7 +151,7 @@ class MetaProcessor(BaseProcessor):
 
     @property
     def avail_procs(self):
-        return get_entry_points('ulif.openoffice.processors')
+        return registry.processors
 
     def __init__(self, options={}):
         from ulif.openoffice.options import Options
@@ -186,6 +188,11 @@ class MetaProcessor(BaseProcessor):
 
         .. note:: after each processing, the (then old) input is
                   removed.
+
+        Processors are expected to take over the directory of their
+        input, i.e. to move (rename) it or to modify it in place,
+        instead of copying it. This way, documents are not copied
+        again and again while passing the pipeline.
         """
         metadata = metadata.copy()
         pipeline = self._build_pipeline()
@@ -268,14 +275,31 @@ class OOConvProcessor(BaseProcessor):
                  ),
         Argument('-oocp-host', '--oocp-hostname',
                  default='localhost',
+                 affects_output=False,
                  help='Host to contact for LibreOffice document '
                  'conversion. Default: "localhost"'
                  ),
         Argument('-oocp-port', '--oocp-port', type=int,
                  default=2002,
+                 affects_output=False,
                  help='Port of host to contact for LibreOffice document '
                  'conversion. Default: 2002',
                  ),
+        Argument('-oocp-listeners', '--oocp-listeners',
+                 type=string_to_listeners, default=None,
+                 affects_output=False,
+                 metavar='HOST:PORT_LIST',
+                 help='Comma-separated list of LibreOffice listeners to '
+                 'distribute conversions over. Overrides hostname and '
+                 'port if set. Default: none',
+                 ),
+        Argument('-oocp-worker', '--oocp-worker-socket',
+                 default=None, metavar='PATH',
+                 affects_output=False,
+                 help='Path to the UNIX socket of a running `oooworker`. '
+                 'If set, conversions are passed to this worker instead '
+                 'of starting `unoconv` for each document. Default: none',
+                 ),
         ]
 
     def _get_filter_props(self):
@@ -287,21 +311,31 @@ class OOConvProcessor(BaseProcessor):
             props.append(("UseTaggedPDF", pdf_tagged))
         return props
 
+    def _get_pool(self):
+        listeners = self.options['oocp_listeners']
+        if not listeners:
+            listeners = (
+                (self.options['oocp_hostname'], self.options['oocp_port']), )
+        return get_listener_pool(
+            [CONNECTION_URL % (host, port) for host, port in listeners])
+
+    def _get_backend(self):
+        socket_path = self.options['oocp_worker_socket']
+        if not socket_path:
+            return None  # use the default (unoconv)
+        return WorkerBackend(socket_path)
+
     def process(self, path, metadata):
         basename = os.path.basename(path)
         src = os.path.join(
-            copy_to_secure_location(path), basename)
-        if os.path.isfile(path):
-            path = os.path.dirname(path)
-        shutil.rmtree(path)
+            move_to_secure_location(path), basename)
         extension = self.options['oocp_output_format']
         filter_name = self.formats[extension]
-        url = 'socket,host=%s,port=%d;urp;StarOffice.ComponentContext' % (
-            self.options['oocp_hostname'], self.options['oocp_port'])
 
         filter_props = self._get_filter_props()
         status, result_path = convert(
-            url=url,
+            pool=self._get_pool(),
+            backend=self._get_backend(),
             out_format=filter_name,
             filter_props=filter_props,
             path=src,
@@ -389,9 +423,8 @@ class Tidy(BaseProcessor):
             return path, metadata
         basename = os.path.basename(path)
         src_path = os.path.join(
-            copy_to_secure_location(path), basename)
+            move_to_secure_location(path), basename)
         src_dir = os.path.dirname(src_path)
-        remove_file_dir(path)
 
         # Remove <SDFIELD> tags if any
         cleaned_html = rename_sdfield_tags(
@@ -441,8 +474,7 @@ class CSSCleaner(BaseProcessor):
             return path, metadata
         basename = os.path.basename(path)
         src_path = os.path.join(
-            copy_to_secure_location(path), basename)
-        remove_file_dir(path)
+            move_to_secure_location(path), basename)
 
         new_html, css = extract_css(
             open(src_path, 'rb').read().decode('utf-8'), basename,
@@ -502,9 +534,8 @@ class HTMLCleaner(BaseProcessor):
             return path, metadata
         basename = os.path.basename(path)
         src_path = os.path.join(
-            copy_to_secure_location(path), basename)
+            move_to_secure_location(path), basename)
         src_dir = os.path.dirname(src_path)
-        remove_file_dir(path)
         new_html, img_name_map = cleanup_html(
             codecs.open(src_path, 'r', 'utf-8').read(),
             basename,
@@ -532,6 +563,57 @@ class HTMLCleaner(BaseProcessor):
         return
 
 
+class HTMLCSSCleaner(HTMLCleaner):
+    """A processor doing the work of :class:`HTMLCleaner` and
+    :class:`CSSCleaner` in one go.
+
+    Different to running both processors one after another, the HTML
+    input is parsed and written only once, which saves a lot of time
+    with big documents. To use it, replace both processors in the
+    processor order with this one, for instance:
+    ``unzip,oocp,tidy,html_css_cleaner,zip``.
+
+    This processor provides no options of its own. Instead it
+    respects the options of :class:`HTMLCleaner` and
+    :class:`CSSCleaner`.
+
+    This processor requires HTML/XHTML input.
+    """
+    prefix = 'html_css_cleaner'
+
+    args = []
+
+    def process(self, path, metadata):
+        ext = os.path.splitext(path)[1]
+        if ext not in self.supported_extensions:
+            return path, metadata
+        basename = os.path.basename(path)
+        src_path = os.path.join(
+            move_to_secure_location(path), basename)
+        src_dir = os.path.dirname(src_path)
+        new_html, css, img_name_map = cleanup_html_css(
+            codecs.open(src_path, 'r', 'utf-8').read(),
+            basename,
+            fix_head_nums=self.options['html_cleaner_fix_heading_numbers'],
+            fix_img_links=self.options['html_cleaner_fix_image_links'],
+            fix_sdfields=self.options['html_cleaner_fix_sd_fields'],
+            prettify_html=self.options['css_cleaner_prettify_html'],
+            )
+        if css is not None:
+            css, errors = cleanup_css(
+                css, minified=self.options['css_cleaner_minified'])
+            css_file = os.path.splitext(src_path)[0] + '.css'
+            with open(css_file, 'wb') as fd:
+                fd.write(css.encode('utf-8'))
+        if not isinstance(new_html, bytes):
+            new_html = new_html.encode('utf-8')
+        with open(src_path, 'wb') as fd:
+            fd.write(new_html)
+        # Rename images
+        self.rename_img_files(src_dir, img_name_map)
+        return src_path, metadata
+
+
 class Error(BaseProcessor):
     """A processor that returns an error message.
 
@@ -0,0 +1,261 @@
+#
+# worker.py
+#
+# Copyright (C) 2015 Uli Fouquet
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+"""
+A long-running conversion worker.
+
+The worker listens on a local UNIX socket for conversion jobs and
+keeps its connections to LibreOffice listeners open between
+jobs. Compared to calling `unoconv` for each document, this saves
+the startup costs of a new Python process and of a new UNO
+connection for every conversion.
+
+Jobs and replies are single lines of JSON. A job is a dict with the
+keys ``url``, ``out_format``, ``path``, ``out_dir``,
+``filter_props``, ``template`` and ``doctype`` (see
+:func:`ulif.openoffice.convert.convert` for their meaning). The
+reply is a dict with keys ``status`` (zero on success) and
+``output``.
+
+Clients normally use :class:`ulif.openoffice.convert.WorkerBackend`
+to talk to a worker.
+
+The worker reads and writes any paths it is told to. Therefore its
+socket is accessible for the user running the worker only.
+"""
+import argparse
+import json
+import logging
+import os
+import stat
+import sys
+import threading
+try:
+    import socketserver                  # Python 3.x
+except ImportError:                      # pragma: no cover
+    import SocketServer as socketserver  # Python 2.x
+
+#: Export filters by doctype and output format (as passed to unoconv).
+FILTERS = {
+    'document': {
+        'pdf': 'writer_pdf_Export',
+        'html': 'HTML (StarWriter)',
+        'xhtml': 'XHTML Writer File',
+        'text': 'Text (encoded)',
+        },
+    'graphics': {
+        'pdf': 'draw_pdf_Export',
+        'html': 'draw_html_Export',
+        },
+    'presentation': {
+        'pdf': 'impress_pdf_Export',
+        'html': 'impress_html_Export',
+        },
+    'spreadsheet': {
+        'pdf': 'calc_pdf_Export',
+        'html': 'HTML (StarCalc)',
+        },
+    }
+
+#: Filename extensions of generated docs by output format.
+EXTENSIONS = {
+    'pdf': 'pdf',
+    'html': 'html',
+    'xhtml': 'html',
+    'text': 'txt',
+    }
+
+
+def get_default_socket_path():
+    """Get the default path of the worker socket.
+
+    This is ``oooworker.sock`` in the per-user runtime dir
+    (``$XDG_RUNTIME_DIR``) if set, or ``.oooworker.sock`` in the home
+    dir of the current user otherwise.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'oooworker.sock')
+    return os.path.join(os.path.expanduser('~'), '.oooworker.sock')
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Handle a single conversion job.
+
+    Reads a job, passes it to the ``converter`` of the server and
+    sends back the result.
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            job = json.loads(line.decode('utf-8'))
+            status, output = self.server.converter(**job)
+        except Exception as exc:
+            status, output = 1, '%s: %s' % (exc.__class__.__name__, exc)
+        if isinstance(output, bytes):
+            output = output.decode('utf-8', 'replace')
+        reply = json.dumps(dict(status=status, output=output))
+        self.wfile.write(reply.encode('utf-8') + b'\n')
+
+
+class WorkerServer(socketserver.ThreadingMixIn,
+                   socketserver.UnixStreamServer):
+    """A server for conversion jobs listening on `socket_path`.
+
+    `converter` is a callable that accepts the keywords of a job and
+    returns a tuple ``(<STATUS>, <OUTPUT>)``. By default we use an
+    :class:`UnoConverter`.
+
+    The socket is created with permissions ``0600``, so that only
+    the user running the worker can send jobs.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, converter=None):
+        if converter is None:
+            converter = UnoConverter()
+        self.converter = converter
+        socketserver.UnixStreamServer.__init__(self, socket_path, JobHandler)
+
+    def server_bind(self):
+        # create the socket file with restricted permissions right
+        # away, so that nobody else can connect in between.
+        old_umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.server_address, stat.S_IRUSR | stat.S_IWUSR)
+
+
+class UnoConverter(object):
+    """Convert docs via UNO, reusing connections to listeners.
+
+    Connections (desktops) are cached per connection url. As a
+    LibreOffice listener can handle only one document at a time,
+    conversions on the same url are serialized. Broken connections
+    are dropped and built up again on the next job.
+    """
+    def __init__(self):
+        self._desktops = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _get_lock(self, url):
+        with self._lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    def _get_desktop(self, url):
+        if url not in self._desktops:
+            import uno  # only available with LibreOffice python
+            local_ctx = uno.getComponentContext()
+            resolver = local_ctx.ServiceManager.createInstanceWithContext(
+                "com.sun.star.bridge.UnoUrlResolver", local_ctx)
+            ctx = resolver.resolve("uno:%s" % url)
+            self._desktops[url] = ctx.ServiceManager.createInstanceWithContext(
+                "com.sun.star.frame.Desktop", ctx)
+        return self._desktops[url]
+
+    def _props(self, **kw):
+        from com.sun.star.beans import PropertyValue
+        result = []
+        for key, value in sorted(kw.items()):
+            prop = PropertyValue()
+            prop.Name, prop.Value = key, value
+            result.append(prop)
+        return tuple(result)
+
+    def _filter_data(self, filter_props):
+        import uno
+        data = {}
+        for key, value in filter_props:
+            value = str(value)
+            if value.isdigit():
+                value = int(value)
+            elif value.lower() in ('true', 'false'):
+                value = value.lower() == 'true'
+            data[key] = value
+        return uno.Any(
+            "[]com.sun.star.beans.PropertyValue", self._props(**data))
+
+    def __call__(self, url, out_format, path, out_dir, filter_props=(),
+                 template=None, doctype='document'):
+        import uno
+        filter_name = FILTERS.get(doctype, {}).get(out_format)
+        if filter_name is None:
+            return 1, 'unsupported format: %s (%s)' % (out_format, doctype)
+        if not os.path.isfile(path):
+            return 1, 'no such file: %s' % path
+        base = os.path.splitext(os.path.basename(path))[0]
+        out_path = os.path.join(
+            out_dir, '%s.%s' % (base, EXTENSIONS[out_format]))
+        export = dict(FilterName=filter_name, Overwrite=True)
+        if out_format == 'text':
+            export['FilterOptions'] = 'UTF8'
+        if filter_props:
+            export['FilterData'] = self._filter_data(filter_props)
+        with self._get_lock(url):
+            try:
+                desktop = self._get_desktop(url)
+                doc = desktop.loadComponentFromURL(
+                    uno.systemPathToFileUrl(os.path.abspath(path)),
+                    "_blank", 0, self._props(Hidden=True))
+                try:
+                    if template is not None:
+                        doc.StyleFamilies.loadStylesFromURL(
+                            uno.systemPathToFileUrl(
+                                os.path.abspath(template)),
+                            self._props(OverwriteStyles=True))
+                    doc.storeToURL(
+                        uno.systemPathToFileUrl(out_path),
+                        self._props(**export))
+                finally:
+                    doc.close(True)
+            except Exception as exc:
+                self._desktops.pop(url, None)
+                return 1, '%s: %s' % (exc.__class__.__name__, exc)
+        return 0, ''
+
+
+def main(argv=None):
+    """Run a worker.
+    """
+    if argv is None:                                    # pragma: no cover
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(prog='oooworker')
+    parser.description = (
+        "Run a worker converting office documents via LibreOffice.")
+    parser.add_argument(
+        '--socket', default=get_default_socket_path(), metavar='PATH',
+        help='Path of UNIX socket to listen on. Default: %(default)s')
+    options = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if os.path.exists(options.socket):
+        if not stat.S_ISSOCK(os.stat(options.socket).st_mode):
+            parser.error('not a socket: %s' % options.socket)
+        os.unlink(options.socket)  # stale socket of previous run
+    server = WorkerServer(options.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:                           # pragma: no cover
+        pass
+    finally:
+        server.server_close()
+        os.unlink(options.socket)
@@ -19,16 +19,30 @@
 """
 RESTful WSGI app
 """
+import io
+import json
 import os
 import mimetypes
+import re
+import shutil
+import sys
 import tempfile
+import zipfile
+import zlib
+from contextlib import closing
 from routes import Mapper
 from routes.util import URLGenerator
 from webob import Response, exc
 from webob.dec import wsgify
-from ulif.openoffice.cachemanager import CacheManager
-from ulif.openoffice.client import convert_doc
-from ulif.openoffice.helpers import basestring
+from ulif.openoffice.cachemanager import (
+    CacheManager, SIDECAR_EXTENSIONS, get_marker, is_compressible,
+    start_cache_janitor, write_hashed)
+from ulif.openoffice.client import (
+    AdmissionControl, Overloaded, convert_doc, convert_docs)
+from ulif.openoffice.helpers import (
+    basestring, string_to_bool, string_to_bytes)
+from ulif.openoffice.jobs import DONE, JobQueue, RE_JOB_ID
+from ulif.openoffice.options import ArgumentParserError
 
 
 mydocs = {}
@@ -42,27 +56,33 @@ def get_mimetype(filename):
     return type or 'application/octet-stream'
 
 
+#: Size of chunks read when serving files without `wsgi.file_wrapper`.
+CHUNK_SIZE = 64 * 1024
+
+
 class FileIterable(object):
     """A webob compatible file iterable.
 
     `start` and `stop` tell where to start/stop reading. This iterable
-    reads files in chunks to reduce memory load when reading large
-    files.
+    reads files in chunks of `chunk_size` bytes to reduce memory load
+    when reading large files.
 
     Supports streaming ranges.
 
     Cf. http://docs.webob.org/en/latest/file-example.html
     """
-    def __init__(self, filename, start=0, stop=None):
+    def __init__(self, filename, start=0, stop=None, chunk_size=None):
         self.filename = filename
         self.start = start
         self.stop = stop
+        self.chunk_size = chunk_size
 
     def __iter__(self):
-        return FileIterator(self.filename, self.start, self.stop)
+        return FileIterator(
+            self.filename, self.start, self.stop, self.chunk_size)
 
     def app_iter_range(self, start, stop):
-        return self.__class__(self.filename, start, stop)
+        return self.__class__(self.filename, start, stop, self.chunk_size)
 
 
 class FileIterator(object):
@@ -75,10 +95,12 @@ class FileIterator(object):
     Cf. http://docs.webob.org/en/latest/file-example.html
     """
     #: Size of chunks read when processing files.
-    chunk_size = 4096
+    chunk_size = CHUNK_SIZE
 
-    def __init__(self, filename, start=0, stop=None):
+    def __init__(self, filename, start=0, stop=None, chunk_size=None):
         self.filename = filename
+        if chunk_size:
+            self.chunk_size = int(chunk_size)
         self.fileobj = open(self.filename, 'rb')
         if start:
             self.fileobj.seek(start)
@@ -92,9 +114,11 @@ class FileIterator(object):
 
     def next(self):
         if self.length is not None and self.length <= 0:
+            self.fileobj.close()
             raise StopIteration
         chunk = self.fileobj.read(self.chunk_size)
         if not chunk:
+            self.fileobj.close()
             raise StopIteration
         if self.length is not None:
             self.length -= len(chunk)
@@ -106,18 +130,327 @@ class FileIterator(object):
     __next__ = next  # py3 compat
 
 
-def make_response(filename):
-    res = Response(content_type=get_mimetype(filename))
-    res.app_iter = FileIterable(filename)
-    res.content_length = os.path.getsize(filename)
+#: Regular expression matching parameters in `Content-Disposition`
+#: headers of multipart bodies.
+RE_HEADER_PARAM = re.compile(r';\s*([\w\-]+)\s*=\s*(?:"([^"]*)"|([^;\s]*))')
+
+
+class UploadTooLarge(Exception):
+    """Raised if an upload exceeds the maximum size allowed.
+    """
+
+
+class MultipartReader(object):
+    """Read `multipart/form-data` bodies part by part from `stream`.
+
+    Never reads more than `length` bytes from `stream` (or up to its
+    end, if `length` is ``None``), and at most `chunk_size` bytes at
+    once. Bodies larger than `max_size` bytes
+    (if set) raise :exc:`UploadTooLarge` as soon as the limit is
+    exceeded.
+
+    Call :meth:`next_part` to get the headers of the next part and
+    then :meth:`read` to read its body like from a file. Memory use
+    is bounded by `chunk_size` and does not depend on the size of
+    the parts. Malformed bodies raise :exc:`ValueError`.
+    """
+    #: Maximum size of the headers of a part.
+    max_header_size = 16 * 1024
+
+    def __init__(self, stream, boundary, length, max_size=None,
+                 chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.remaining = length
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.received = 0
+        self._delimiter = b'\r\n--' + boundary.encode('latin-1')
+        # the first delimiter is not preceded by a line break
+        self._buf = b'\r\n'
+
+    def _fill(self):
+        # read more data into buffer. Returns `False` at end of data.
+        size = self.chunk_size
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                return False
+            size = min(size, self.remaining)
+        data = self.stream.read(size)
+        if not data:
+            self.remaining = 0
+            return False
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self.received += len(data)
+        if self.max_size is not None and self.received > self.max_size:
+            raise UploadTooLarge(
+                'upload exceeds %s bytes' % self.max_size)
+        self._buf += data
+        return True
+
+    def next_part(self):
+        """Skip to the next part and get its headers.
+
+        Returns a dict mapping lowercase header names to values or
+        ``None`` if there are no more parts.
+        """
+        while True:
+            index = self._buf.find(self._delimiter)
+            if index >= 0:
+                self._buf = self._buf[index + len(self._delimiter):]
+                break
+            self._buf = self._buf[-len(self._delimiter):]
+            if not self._fill():
+                raise ValueError('missing multipart boundary')
+        while len(self._buf) < 2:
+            if not self._fill():
+                raise ValueError('unexpected end of multipart data')
+        if self._buf.startswith(b'--'):
+            return None  # closing delimiter
+        while b'\r\n\r\n' not in self._buf:
+            if len(self._buf) > self.max_header_size:
+                raise ValueError('multipart headers too long')
+            if not self._fill():
+                raise ValueError('unexpected end of multipart data')
+        head, self._buf = self._buf.split(b'\r\n\r\n', 1)
+        headers = dict()
+        for line in head.decode('utf-8', 'replace').split('\r\n')[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def read(self, size=-1):
+        """Read up to `size` bytes of the body of the current part.
+
+        Reads the whole body if `size` is negative. Returns an empty
+        string at the end of the part.
+        """
+        while True:
+            index = self._buf.find(self._delimiter)
+            complete = index >= 0
+            if not complete:
+                index = max(len(self._buf) - len(self._delimiter) + 1, 0)
+            if complete or (size >= 0 and index >= size):
+                if size >= 0:
+                    index = min(index, size)
+                data, self._buf = self._buf[:index], self._buf[index:]
+                return data
+            if not self._fill():
+                raise ValueError('unexpected end of multipart data')
+
+
+def get_header_params(value):
+    """Get the parameters of header `value` as a dict.
+
+    For instance ``form-data; name="doc"; filename="a.txt"`` gives
+    ``{'name': 'doc', 'filename': 'a.txt'}``.
+    """
+    return dict([(name.lower(), quoted or plain) for name, quoted, plain
+                 in RE_HEADER_PARAM.findall(value)])
+
+
+def get_upload_filename(filename):
+    """Get a filename safe to store an upload named `filename`.
+
+    Directory parts (also Windows-style ones) are dropped. Names we
+    cannot use as filenames (like empty ones or ``..``) give
+    ``upload``.
+    """
+    filename = os.path.basename((filename or '').replace('\\', '/'))
+    if filename in ('', '.', '..'):
+        return 'upload'
+    return filename
+
+
+def parse_cache_control(value):
+    """Parse `Cache-Control` settings per output format.
+
+    `value` is a string with entries ``<EXTENSION>: <CACHE-CONTROL>``
+    separated by newlines or semicolons, like::
+
+      pdf: public, max-age=86400; html: no-cache; *: max-age=3600
+
+    where ``*`` sets the default for all other formats.
+
+    Returns a dict mapping (lowercase) filename extensions to
+    `Cache-Control` values.
+    """
+    result = dict()
+    for entry in (value or '').replace(';', '\n').split('\n'):
+        if ':' not in entry:
+            continue
+        ext, cache_control = entry.split(':', 1)
+        result[ext.strip().lstrip('.').lower()] = cache_control.strip()
+    return result
+
+
+def get_accepted_encoding(req, encodings):
+    """Get the first of `encodings` accepted by the client of `req`.
+
+    `encodings` is a list of content encodings like ``['br',
+    'gzip']``, preferred ones first. Clients must send an
+    ``Accept-Encoding`` header to get any of them. Returns ``None``
+    if none is acceptable.
+    """
+    if 'Accept-Encoding' not in req.headers:
+        return None
+    accept = req.accept_encoding
+    if hasattr(accept, 'acceptable_offers'):     # WebOb >= 1.8
+        offers = accept.acceptable_offers(encodings)
+        return offers and offers[0][0] or None
+    return accept.best_match(encodings)         # pragma: no cover
+
+
+def make_response(filename, req=None, chunk_size=None, etag=None,
+                  cache_control=None):
+    """Get a response serving the file `filename`.
+
+    If the WSGI server provides a `wsgi.file_wrapper` (as many servers
+    do, often sending files via `sendfile()`) and no range is
+    requested in `req`, the server is asked to deliver the file
+    itself. Otherwise we read the file in chunks of `chunk_size`
+    bytes (default: :data:`CHUNK_SIZE`).
+
+    `etag` should identify the contents of `filename`, a digest for
+    instance. If none is given, we build one from modification time
+    and size of the file. `cache_control` is set as `Cache-Control`
+    header.
+
+    Conditional requests (``If-None-Match``, ``If-Modified-Since``)
+    are answered with ``304 Not Modified`` by webob then.
+
+    If compressed copies of `filename` (sidecars, see
+    :func:`ulif.openoffice.cachemanager.write_sidecars`) exist, we
+    deliver one of them if the client accepts its encoding.
+    """
+    res = Response(content_type=get_mimetype(filename),
+                   conditional_response=True)
+    path = filename
+    encodings = [name for name, ext in SIDECAR_EXTENSIONS.items()
+                 if os.path.isfile(filename + ext)]
+    if encodings:
+        res.vary = ('Accept-Encoding', )
+        encoding = req is not None and get_accepted_encoding(
+            req, encodings)
+        if encoding:
+            path = filename + SIDECAR_EXTENSIONS[encoding]
+            res.content_encoding = encoding
+            if etag is not None:
+                etag = '%s-%s' % (etag, encoding)
+    file_wrapper = None
+    if req is not None and not req.range:
+        file_wrapper = req.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        res.app_iter = file_wrapper(
+            open(path, 'rb'), int(chunk_size or CHUNK_SIZE))
+    else:
+        res.app_iter = FileIterable(path, chunk_size=chunk_size)
+    res.content_length = os.path.getsize(path)
     res.last_modified = os.path.getmtime(filename)
-    res.etag = '%s-%s-%s' % (
-        os.path.getmtime(filename),
-        os.path.getsize(filename),
-        hash(filename))
+    if etag is None:
+        etag = '%s-%s' % (os.path.getmtime(path), os.path.getsize(path))
+    res.etag = etag
+    if cache_control:
+        res.headers['Cache-Control'] = cache_control
     return res
 
 
+def is_not_modified(req, resp):
+    """Tell whether the client sending `req` has `resp` already.
+
+    Checks the ``If-None-Match`` and ``If-Modified-Since`` headers of
+    `req` against the ETag and last modification time of `resp`.
+    """
+    if req.if_none_match:
+        return resp.etag in req.if_none_match
+    if req.if_modified_since and resp.last_modified:
+        return resp.last_modified <= req.if_modified_since
+    return False
+
+
+#: Whether :mod:`zipfile` can write to unseekable streams (Python >= 3.5).
+ZIP_STREAMING = sys.version_info >= (3, 5)
+
+#: Name of the manifest in ZIP files of batch results.
+BATCH_MANIFEST = 'manifest.ndjson'
+
+
+class ZipStream(object):
+    """An unseekable file-like object collecting data written by
+    :class:`zipfile.ZipFile`.
+
+    Written data is fetched piecewise with :meth:`pop`, so that ZIP
+    files can be sent while they are created.
+    """
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._offset = 0
+
+    def write(self, data):
+        self._buffer.write(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset + self._buffer.tell()
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """Get the data written since the last call.
+        """
+        data = self._buffer.getvalue()
+        self._offset += len(data)
+        self._buffer = io.BytesIO()
+        return data
+
+
+def iter_ndjson(results):
+    """Iterate over `results` as lines of JSON.
+
+    `results` is a generator of ``(<ENTRY>, <PATH>)`` tuples as
+    created by :meth:`RESTfulDocConverter._iter_batch`. It is closed
+    when we are done or closed ourselves.
+    """
+    with closing(results):
+        for entry, path in results:
+            yield (json.dumps(entry, sort_keys=True) + '\n').encode('utf-8')
+
+
+def iter_zip(results):
+    """Iterate over a ZIP file containing `results`.
+
+    `results` is a generator of ``(<ENTRY>, <PATH>)`` tuples as
+    created by :meth:`RESTfulDocConverter._iter_batch`. Each file
+    `path` is added to the ZIP file as soon as it is available, under
+    a name stored as ``filename`` in its `entry`. All entries are
+    added as :data:`BATCH_MANIFEST` at the end. `results` is closed
+    when we are done or closed ourselves.
+    """
+    stream, names, manifest = ZipStream(), set(), []
+    with closing(results), zipfile.ZipFile(
+            stream, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for entry, path in results:
+            if path is not None:
+                stem = os.path.splitext(entry['name'])[0]
+                ext = os.path.splitext(path)[1]
+                name, num = stem + ext, 1
+                while name in names or name == BATCH_MANIFEST:
+                    name, num = '%s-%s%s' % (stem, num, ext), num + 1
+                names.add(name)
+                entry['filename'] = name
+                compress_type = zipfile.ZIP_STORED
+                if is_compressible(path):
+                    compress_type = zipfile.ZIP_DEFLATED
+                zf.write(path, name, compress_type)
+            manifest.append(entry)
+            yield stream.pop()
+        zf.writestr(BATCH_MANIFEST, ''.join(
+            [json.dumps(x, sort_keys=True) + '\n' for x in manifest]))
+    yield stream.pop()
+
+
 class RESTfulDocConverter(object):
     """A WSGI app that caches and converts office documents via LibreOffice.
 
@@ -130,21 +463,157 @@ class RESTfulDocConverter(object):
         Path to a directory, where cached files can be stored. The
         directory is created if it does not exist.
 
+    - `listeners`:
+        Comma-separated list of ``<HOST>:<PORT>`` LibreOffice
+        listeners to distribute conversions over. Used for all
+        requests that do not set the ``oocp-listeners`` option
+        themselves.
+
+    - `cache_max_size`, `cache_max_entries`, `cache_max_age`:
+        Limits of the cache (see
+        :class:`ulif.openoffice.cachemanager.CacheManager`). If any
+        of them is set, a janitor thread removes least recently used
+        documents from cache every `cache_janitor_interval` seconds
+        (default: 600).
+
+    - `cache_read_only`:
+        If set to ``yes``, the cache is only looked up but never
+        modified. Meant for web nodes serving a cache that is filled
+        elsewhere (and maybe mounted read-only).
+
+    - `cache_hash_algorithm`:
+        Hash algorithm for new cache dirs, like ``sha256`` or
+        ``blake2b``. Default: ``md5``.
+
+    - `cache_key_scheme`:
+        Scheme of cache keys for new cache dirs. With ``digest``, keys
+        of documents are derived from the SHA-256 digests of source
+        and options only (see
+        :func:`ulif.openoffice.cachemanager.get_digest_key`), so that
+        they are the same on all nodes and clients can compute them
+        without asking. Default: ``bucket``.
+
+    - `job_dir`:
+        Path to a directory where asynchronous conversion jobs are
+        stored (see :class:`ulif.openoffice.jobs.JobQueue`). If set
+        (and a writable cache is configured), clients can ``POST``
+        docs with ``async=1``. They then get ``202 Accepted`` and the
+        location of a job immediately. ``GET`` on the job location
+        tells the state of the job and redirects to the result when
+        done. Without a job dir, ``async`` is ignored.
+
+    - `job_workers`:
+        Number of asynchronous jobs to run at the same time. Default:
+        2.
+
+    - `job_max_age`:
+        Seconds to keep finished jobs. Default: 86400 (one day).
+
+    - `max_conversions`:
+        Number of conversions to run at the same time. Default:
+        unlimited. Requests that find their document in cache are
+        not counted.
+
+    - `max_waiting`:
+        Number of conversions that may wait for one of the
+        `max_conversions` slots. Further requests are answered with
+        ``503 Service Unavailable`` and a ``Retry-After`` header
+        estimated from recent conversion times. Default: 0.
+
+    - `chunk_size`:
+        Size of chunks (in bytes) read when delivering documents and
+        the WSGI server provides no `wsgi.file_wrapper`. Default:
+        65536.
+
+    - `cache_control`:
+        `Cache-Control` headers of cached documents by format, like
+        ``pdf: public, max-age=86400; *: no-cache``. See
+        :func:`parse_cache_control`. Default: no `Cache-Control`
+        headers.
+
+    - `max_upload_size`:
+        Maximum size of uploads (request bodies) in bytes, like
+        ``100M``. Larger uploads are refused with ``413 Request Entity
+        Too Large``, if possible before they are received. Default:
+        unlimited.
+
+    - `cache_sidecars`:
+        If set to ``yes``, compressed copies of HTML, text and other
+        compressible documents are stored in cache. Clients accepting
+        ``gzip`` (or ``br``, if the `brotli` package is installed)
+        encodings get these copies. Default: ``no``.
+
+    - `batch_workers`:
+        Number of documents of a batch (see below) converted at the
+        same time. Default: 4.
+
+    Cached documents are delivered with their SHA-256 digest as
+    ETag. Clients that send a matching ``If-None-Match`` header (or
+    an ``If-Modified-Since`` header not older than the document) get
+    ``304 Not Modified``, also when posting documents.
+
+    Many documents can be converted with the same options in one
+    request by posting them to ``/docs/batch``, either as several
+    ``doc`` fields of a ``multipart/form-data`` body or as a ZIP file
+    (content type ``application/zip``, options then go into the query
+    string). Results are streamed back as they are done, as a ZIP
+    file with a manifest (``format=zip``, the default, requires Python
+    >= 3.5) or as lines of JSON (``format=ndjson``), one per
+    document. Failing documents are reported there without failing
+    the batch.
+
     """
     # cf: https://routes.readthedocs.io/en/latest/restful.html
     #     http://www.ianbicking.org/blog/2010/03/12/a-webob-app-example/
     map = Mapper()
+    map.connect('lookup', '/docs/lookup', action='lookup',
+                conditions=dict(method=['GET', 'HEAD']))
+    map.connect('batch', '/docs/batch', action='batch',
+                conditions=dict(method=['POST']))
     map.resource('doc', 'docs')
 
     #: A cache manager instance.
     cache_manager = None
+
+    #: Maximum size of form fields (except the document) in bytes.
+    max_field_size = 64 * 1024
     template_dir = os.path.join(os.path.dirname(__file__), 'templates')
 
-    def __init__(self, cache_dir=None):
+    def __init__(self, cache_dir=None, listeners=None, cache_max_size=None,
+                 cache_max_entries=None, cache_max_age=None,
+                 cache_janitor_interval=600, cache_read_only=False,
+                 cache_hash_algorithm=None, cache_key_scheme=None,
+                 job_dir=None, job_workers=2,
+                 job_max_age=86400, max_conversions=None, max_waiting=0,
+                 chunk_size=CHUNK_SIZE, cache_control=None,
+                 cache_sidecars=False, max_upload_size=None,
+                 batch_workers=4):
         self.cache_dir = cache_dir
+        self.listeners = listeners
+        self.batch_workers = int(batch_workers)
+        self.chunk_size = int(chunk_size)
+        self.cache_control = parse_cache_control(cache_control)
+        self.max_upload_size = string_to_bytes(max_upload_size)
+        self.cache_read_only = string_to_bool(cache_read_only) or False
         self.cache_manager = None
+        self.cache_janitor = None
         if self.cache_dir is not None:
-            self.cache_manager = CacheManager(self.cache_dir)
+            self.cache_manager = CacheManager(
+                self.cache_dir, max_size=cache_max_size,
+                max_entries=cache_max_entries, max_age=cache_max_age,
+                read_only=self.cache_read_only,
+                hash_algorithm=cache_hash_algorithm,
+                key_scheme=cache_key_scheme,
+                sidecars=string_to_bool(cache_sidecars) or False)
+            if not self.cache_read_only:
+                self.cache_janitor = start_cache_janitor(
+                    self.cache_manager, interval=cache_janitor_interval)
+        self.admission = AdmissionControl(max_conversions, max_waiting)
+        self.job_queue = None
+        if job_dir and self.cache_manager and not self.cache_read_only:
+            self.job_queue = JobQueue(
+                job_dir, self.cache_dir, workers=job_workers,
+                max_age=job_max_age, cache_manager=self.cache_manager)
 
     def _url(self, req, *args, **kw):
         """Generate an URL pointing to some REST service.
@@ -171,34 +640,315 @@ class RESTfulDocConverter(object):
         # get index of all docs
         return Response(str(mydocs.keys()))
 
-    def create(self, req):
-        # post a new doc
-        options = dict([(name, val) for name, val in req.params.items()
-                        if name not in ('CREATE', 'doc', 'docid')])
-        if 'out_fmt' in req.params.keys():
+    def _get_options(self, req, params=None):
+        """Get conversion options from request `req`.
+
+        Options are taken from `params` (a dict) if given, from the
+        request parameters otherwise.
+        """
+        if params is None:
+            params = req.params
+        options = dict([(name, val) for name, val in params.items()
+                        if name not in (
+                            'CREATE', 'doc', 'docid', 'async', 'format') and
+                        not name.startswith('digest.')])
+        if 'out_fmt' in params.keys():
             options['oocp-out-fmt'] = options['out_fmt']
             del options['out_fmt']
-        if 'CREATE' in req.params.keys():
+        if 'CREATE' in params.keys():
             if options.get('oocp-out-fmt', 'html') == 'pdf':
                 options['meta-procord'] = 'unzip,oocp,zip'
-        doc = req.POST['doc']
-        # write doc to filesystem
+        if self.listeners:
+            options.setdefault('oocp-listeners', self.listeners)
+        return options
+
+    def lookup(self, req):
+        # find a doc in cache by source digests and options
+        #
+        # Source digests are passed as ``digest.<ALGORITHM>``
+        # parameters, all other parameters are options as with
+        # `create`. If a document is found, we answer with its
+        # location and cache key. Clients then do not have to upload
+        # the source.
+        #
+        # Not found responses tell the digest algorithms we need in
+        # ``X-Digest-Algorithms``.
+        if self.cache_manager is None:
+            return exc.HTTPNotFound()
+        digests = dict([(name[7:], val) for name, val in req.params.items()
+                        if name.startswith('digest.')])
+        try:
+            marker = get_marker(self._get_options(req))
+        except ArgumentParserError as err:
+            return exc.HTTPBadRequest('%s' % err)
+        result_path, cache_key = self.cache_manager.get_cached_file_by_digests(
+            digests, marker)
+        if result_path is None:
+            return exc.HTTPNotFound(headers={
+                'X-Digest-Algorithms': ' '.join(sorted(set(
+                    self.cache_manager.digest_algorithms)))})
+        resp = Response(cache_key, content_type='text/plain')
+        resp.location = self._url(req, 'doc', id=cache_key, qualified=True)
+        return resp
+
+    def _read_upload(self, req, tmp_dir, multiple=False):
+        """Read the multipart body of `req` while it is received.
+
+        The document (field ``doc``) is written into `tmp_dir` and
+        hashed as needed by the cache on the fly. Other fields are
+        returned together with the query parameters of `req`.
+
+        If `multiple` is set, all documents uploaded are stored, each
+        in a numbered subdir of `tmp_dir`.
+
+        Returns a tuple ``(<PARAMS>, <SOURCE_PATH>, <DIGESTS>)``.
+        With `multiple` set, ``<SOURCE_PATH>`` and ``<DIGESTS>`` are
+        lists. Raises :exc:`UploadTooLarge` or :exc:`ValueError` on
+        bad uploads.
+        """
+        boundary = get_header_params(
+            req.headers.get('Content-Type', '')).get('boundary')
+        if req.content_type != 'multipart/form-data' or not boundary:
+            raise ValueError('not a multipart/form-data body')
+        algorithms = ()
+        if self.cache_manager is not None:
+            algorithms = self.cache_manager.digest_algorithms
+        reader = MultipartReader(
+            req.body_file_raw, boundary, req.content_length,
+            max_size=self.max_upload_size, chunk_size=self.chunk_size)
+        params = dict(req.GET.items())
+        src_paths, digests = [], []
+        while True:
+            headers = reader.next_part()
+            if headers is None:
+                break
+            disposition = get_header_params(
+                headers.get('content-disposition', ''))
+            name = disposition.get('name')
+            if name == 'doc' and src_paths and not multiple:
+                continue  # only one doc expected
+            if name == 'doc' and disposition.get('filename'):
+                filename = get_upload_filename(disposition['filename'])
+                doc_dir = tmp_dir
+                if multiple:
+                    doc_dir = os.path.join(tmp_dir, str(len(src_paths)))
+                    os.mkdir(doc_dir)
+                src_paths.append(os.path.join(doc_dir, filename))
+                digests.append(write_hashed(
+                    reader, src_paths[-1], algorithms, self.chunk_size))
+            elif name:
+                value = reader.read(self.max_field_size + 1)
+                if len(value) > self.max_field_size:
+                    raise ValueError('field too large: %s' % name)
+                params[name] = value.decode('utf-8')
+        if not src_paths:
+            raise ValueError('no document uploaded')
+        if multiple:
+            return params, src_paths, digests
+        return params, src_paths[0], digests[0]
+
+    def _read_zip_upload(self, req, tmp_dir):
+        """Read the ZIP file sent as body of `req`.
+
+        The ZIP file is stored in `tmp_dir` while it is received. The
+        documents contained are then extracted, each into a numbered
+        subdir of `tmp_dir`, and hashed as needed by the cache. Paths
+        inside the ZIP file are ignored.
+
+        Returns a tuple ``(<PARAMS>, <SOURCE_PATHS>, <DIGESTS>)`` like
+        :meth:`_read_upload` with `multiple` set. Raises
+        :exc:`UploadTooLarge` if the ZIP file or its contents exceed
+        `max_upload_size` and :exc:`ValueError` on bad uploads.
+        """
+        algorithms = ()
+        if self.cache_manager is not None:
+            algorithms = self.cache_manager.digest_algorithms
+        zip_path = os.path.join(tmp_dir, 'upload.zip')
+        remaining, size = req.content_length, 0
+        with open(zip_path, 'wb') as fd:
+            while remaining is None or remaining > 0:
+                chunk = req.body_file_raw.read(
+                    self.chunk_size if remaining is None else
+                    min(remaining, self.chunk_size))
+                if not chunk:
+                    break
+                size += len(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+                if self.max_upload_size is not None and (
+                        size > self.max_upload_size):
+                    raise UploadTooLarge()
+                fd.write(chunk)
+        try:
+            zf = zipfile.ZipFile(zip_path)
+        except zipfile.BadZipfile:
+            raise ValueError('not a ZIP file')
+        src_paths, digests = [], []
+        with zf:
+            infos = [info for info in zf.infolist() if os.path.basename(
+                info.filename.replace('\\', '/'))]
+            if self.max_upload_size is not None and sum(
+                    [info.file_size for info in infos]) > (
+                        self.max_upload_size):
+                raise UploadTooLarge()
+            for info in infos:
+                doc_dir = os.path.join(tmp_dir, str(len(src_paths)))
+                os.mkdir(doc_dir)
+                src_paths.append(os.path.join(
+                    doc_dir, get_upload_filename(info.filename)))
+                try:
+                    member = zf.open(info)
+                    try:
+                        digests.append(write_hashed(
+                            member, src_paths[-1], algorithms,
+                            self.chunk_size))
+                    finally:
+                        member.close()
+                except (zipfile.BadZipfile, zlib.error, RuntimeError,
+                        NotImplementedError) as err:
+                    # corrupt, encrypted, or unsupported members
+                    raise ValueError('cannot extract %s: %s' % (
+                        info.filename, err))
+        os.unlink(zip_path)
+        if not src_paths:
+            raise ValueError('no document uploaded')
+        return dict(req.GET.items()), src_paths, digests
+
+    def _check_length(self, req):
+        # get an error response if the body of `req` cannot be read
+        if req.content_length is None and not req.environ.get(
+                'wsgi.input_terminated'):
+            # we cannot tell where the body ends
+            return exc.HTTPLengthRequired()
+        if None not in (self.max_upload_size, req.content_length) and (
+                req.content_length > self.max_upload_size):
+            return exc.HTTPRequestEntityTooLarge()
+        return None
+
+    def _upload_error(self, err):
+        # get an error response for a bad upload
+        if isinstance(err, UploadTooLarge):
+            return exc.HTTPRequestEntityTooLarge()
+        return exc.HTTPBadRequest('%s' % err)
+
+    def create(self, req):
+        # post a new doc
+        error = self._check_length(req)
+        if error is not None:
+            return error
+        # write doc to filesystem while receiving it, computing
+        # digests needed by cache
         tmp_dir = tempfile.mkdtemp()
-        src_path = os.path.join(tmp_dir, doc.filename)
-        with open(src_path, 'wb') as f:
-            for chunk in iter(lambda: doc.file.read(8 * 1024), b''):
-                f.write(chunk)
+        try:
+            params, src_path, digests = self._read_upload(req, tmp_dir)
+        except (UploadTooLarge, ValueError) as err:
+            shutil.rmtree(tmp_dir)
+            return self._upload_error(err)
+        options = self._get_options(req, params)
+        if self.job_queue and string_to_bool(params.get('async')):
+            # convert in background
+            job_id = self.job_queue.submit(src_path, options, digests)
+            os.rmdir(tmp_dir)
+            resp = self._job_response(req, self.job_queue.get(job_id))
+            resp.status = '202 Accepted'
+            resp.location = self._url(req, 'doc', id=job_id, qualified=True)
+            return resp
         # do the conversion
-        result_path, id_tag, metadata = convert_doc(
-            src_path, options, self.cache_dir)
+        try:
+            result_path, id_tag, metadata = convert_doc(
+                src_path, options, self.cache_dir, source_digests=digests,
+                admission=self.admission, cache_manager=self.cache_manager)
+        except Overloaded as err:
+            shutil.rmtree(tmp_dir)
+            return exc.HTTPServiceUnavailable(
+                headers={'Retry-After': str(err.retry_after)})
         # deliver the created file
-        resp = make_response(result_path)
-        if id_tag is not None:
-            # we can only signal new resources if cache is enabled
-            resp.status = '201 Created'
-            resp.location = self._url(req, 'doc', id=id_tag, qualified=True)
+        if id_tag is None:
+            return make_response(result_path, req, self.chunk_size)
+        # we can only signal new resources if cache is enabled
+        resp = self._make_cached_response(req, result_path, id_tag)
+        resp.location = self._url(req, 'doc', id=id_tag, qualified=True)
+        if is_not_modified(req, resp):
+            if hasattr(resp.app_iter, 'close'):
+                resp.app_iter.close()  # do not leak file handles
+            not_modified = exc.HTTPNotModified()
+            not_modified.etag = resp.etag
+            not_modified.location = resp.location
+            return not_modified
+        resp.status = '201 Created'
         return resp
 
+    def batch(self, req):
+        # convert many docs with the same options
+        error = self._check_length(req)
+        if error is not None:
+            return error
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            if req.content_type in (
+                    'application/zip', 'application/x-zip-compressed'):
+                params, src_paths, digests = self._read_zip_upload(
+                    req, tmp_dir)
+            else:
+                params, src_paths, digests = self._read_upload(
+                    req, tmp_dir, multiple=True)
+            fmt = params.get('format', 'zip')
+            if fmt not in ('zip', 'ndjson') or (
+                    fmt == 'zip' and not ZIP_STREAMING):
+                raise ValueError('unsupported format: %s' % fmt)
+        except (UploadTooLarge, ValueError) as err:
+            shutil.rmtree(tmp_dir)
+            return self._upload_error(err)
+        results = self._iter_batch(
+            req, src_paths, digests, self._get_options(req, params), tmp_dir)
+        if fmt == 'ndjson':
+            return Response(
+                app_iter=iter_ndjson(results), charset='utf-8',
+                content_type='application/x-ndjson')
+        return Response(
+            app_iter=iter_zip(results), content_type='application/zip')
+
+    def _iter_batch(self, req, src_paths, digests, options, tmp_dir):
+        """Convert the docs in `src_paths` with `options`.
+
+        Yields a tuple ``(<ENTRY>, <PATH>)`` for each doc as soon as
+        it is converted, where `entry` is a dict describing the
+        result and `path` is the path of the result document or
+        ``None`` if the conversion failed. Results and `tmp_dir` are
+        removed afterwards, also if the client goes away early.
+        """
+        results = convert_docs(
+            src_paths, options, self.cache_dir, workers=self.batch_workers,
+            source_digests=digests, admission=self.admission,
+            cache_manager=self.cache_manager)
+        try:
+            for src_path, result_path, cache_key, metadata in results:
+                entry = dict(metadata, name=os.path.basename(src_path))
+                if cache_key is not None:
+                    entry['cache_key'] = cache_key
+                    entry['location'] = self._url(
+                        req, 'doc', id=cache_key, qualified=True)
+                try:
+                    yield entry, (
+                        None if metadata.get('error') else result_path)
+                finally:
+                    if result_path is not None:
+                        shutil.rmtree(
+                            os.path.dirname(result_path), ignore_errors=True)
+        finally:
+            results.close()  # wait for conversions still using tmp_dir
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _make_cached_response(self, req, path, cache_key):
+        """Get a response serving the document `path` cached for `cache_key`.
+        """
+        ext = os.path.splitext(path)[1].lstrip('.').lower()
+        return make_response(
+            path, req, self.chunk_size,
+            etag=self.cache_manager.get_digest(cache_key),
+            cache_control=self.cache_control.get(
+                ext, self.cache_control.get('*')))
+
     def new(self, req):
         # get a form to create a new doc
         template = open(
@@ -221,10 +971,30 @@ class RESTfulDocConverter(object):
     def show(self, req):
         # show a doc
         doc_id = req.path.split('/')[-1]
+        if self.job_queue and RE_JOB_ID.match(doc_id):
+            return self._show_job(req, doc_id)
         result_path = self.cache_manager.get_cached_file(doc_id)
         if result_path is None:
             return exc.HTTPNotFound()
-        return make_response(result_path)
+        return self._make_cached_response(req, result_path, doc_id)
+
+    def _job_response(self, req, job):
+        # describe `job` in JSON
+        info = dict([(name, job.get(name)) for name in (
+            'id', 'state', 'created', 'started', 'finished', 'error')
+            if job.get(name) is not None])
+        return Response(json.dumps(info), content_type='application/json',
+                        charset='utf-8', cache_control='no-cache')
+
+    def _show_job(self, req, job_id):
+        # tell the state of a job or redirect to its result
+        job = self.job_queue.get(job_id)
+        if job is None:
+            return exc.HTTPNotFound()
+        if job['state'] == DONE:
+            return exc.HTTPSeeOther(location=self._url(
+                req, 'doc', id=job['cache_key'], qualified=True))
+        return self._job_response(req, job)
 
 
 docconverter_app = RESTfulDocConverter
@@ -24,7 +24,10 @@ Components to convert documents via XML-RPC.
 """
 from webob import Response, exc
 from webob.dec import wsgify
-from ulif.openoffice.client import Client, convert_doc
+from ulif.openoffice.cachemanager import (
+    CacheManager, get_marker, start_cache_janitor)
+from ulif.openoffice.client import (
+    AdmissionControl, Client, Overloaded, convert_doc)
 try:
     from SimpleXMLRPCServer import SimpleXMLRPCDispatcher  # Python 2.x
 except ImportError:                                        # pragma: no cover
@@ -39,8 +42,28 @@ class WSGIXMLRPCApplication(object):
     not fiddle around with raw HTTP.
 
     The passed in `cache_dir` is used only if set.
+
+    `listeners` is an optional comma-separated list of
+    ``<HOST>:<PORT>`` LibreOffice listeners to distribute conversions
+    over, if not set by the options of a request.
+
+    `cache_max_size`, `cache_max_entries`, and `cache_max_age` limit
+    the cache (if set). A janitor thread then removes least recently
+    used documents from cache every `cache_janitor_interval` seconds.
+    `cache_hash_algorithm` sets the hash algorithm of new cache dirs,
+    `cache_key_scheme` their scheme of cache keys (``bucket`` or
+    ``digest``).
+
+    `max_conversions` limits the number of conversions running at the
+    same time, `max_waiting` the number of conversions waiting for
+    them. Further calls get ``503 Service Unavailable`` with a
+    ``Retry-After`` header. Documents found in cache are delivered
+    regardless of these limits.
     """
-    def __init__(self, cache_dir=None):
+    def __init__(self, cache_dir=None, listeners=None, cache_max_size=None,
+                 cache_max_entries=None, cache_max_age=None,
+                 cache_janitor_interval=600, cache_hash_algorithm=None,
+                 cache_key_scheme=None, max_conversions=None, max_waiting=0):
         # set up a dispatcher
         self.dispatcher = SimpleXMLRPCDispatcher(
             allow_none=True, encoding=None)
@@ -48,8 +71,20 @@ class WSGIXMLRPCApplication(object):
             self.convert_locally, 'convert_locally')
         self.dispatcher.register_function(
             self.get_cached, 'get_cached')
+        self.dispatcher.register_function(
+            self.get_cached_by_digests, 'get_cached_by_digests')
         self.dispatcher.register_introspection_functions()
         self.cache_dir = cache_dir
+        self.listeners = listeners
+        self.cache_janitor = None
+        self.admission = AdmissionControl(max_conversions, max_waiting)
+        if self.cache_dir is not None:
+            self.cache_janitor = start_cache_janitor(CacheManager(
+                self.cache_dir, max_size=cache_max_size,
+                max_entries=cache_max_entries, max_age=cache_max_age,
+                hash_algorithm=cache_hash_algorithm,
+                key_scheme=cache_key_scheme),
+                interval=cache_janitor_interval)
 
     def convert_locally(self, src_path, options):
         """Convert document in `path`.
@@ -65,10 +100,19 @@ class WSGIXMLRPCApplication(object):
         dictionary of metadata. The cache key is ``None`` if no cache
         was used.
         """
+        options = self._get_options(options)
         result_path, cache_key, metadata = convert_doc(
-            src_path, options, self.cache_dir)
+            src_path, options, self.cache_dir, admission=self.admission)
         return result_path, cache_key, metadata
 
+    def _get_options(self, options):
+        """Get `options` completed by settings of this app.
+        """
+        if self.listeners:
+            options = dict(options)
+            options.setdefault('oocp-listeners', self.listeners)
+        return options
+
     def get_cached(self, cache_key):
         """Get a cached document.
 
@@ -78,6 +122,26 @@ class WSGIXMLRPCApplication(object):
         client = Client(cache_dir=self.cache_dir)
         return client.get_cached(cache_key)
 
+    def get_cached_by_digests(self, digests, options):
+        """Get a cached document by source digests and options.
+
+        `digests` is a dict mapping hash algorithm names (like
+        ``md5``, ``sha256``) to the hex digests of a source
+        document. The `options` are the same as for
+        :meth:`convert_locally`.
+
+        Returns the path of the cached document and its cache key if
+        such a document exists. Both values are `None` otherwise.
+
+        Callers can use it to avoid conversions of documents cached
+        already.
+        """
+        if self.cache_dir is None:
+            return None, None
+        cache_manager = CacheManager(self.cache_dir)
+        return cache_manager.get_cached_file_by_digests(
+            digests, get_marker(self._get_options(options)))
+
     @wsgify
     def __call__(self, req):
         """Handles the HTTP POST request.
@@ -91,20 +155,31 @@ class WSGIXMLRPCApplication(object):
         """
         if req.method != 'POST':
             return exc.HTTPBadRequest()
+        overloaded = []
+
+        def dispatch(method, params):
+            # remember refused conversions to answer with HTTP 503
+            try:
+                return self.dispatcher._dispatch(method, params)
+            except Overloaded as err:
+                overloaded.append(err)
+                raise
+
         try:
             data = req.environ['wsgi.input'].read(req.content_length)
             response = self.dispatcher._marshaled_dispatch(
-                data, self.dispatcher._dispatch
-            ) + b'\n'
+                data, dispatch) + b'\n'
         except:                                         # pragma: no cover
             # This should only happen if the module is buggy
             # internal error, report as HTTP server error
             return exc.HTTPServerError()
-        else:
-            # got a valid XML RPC response
-            response = Response(response)
-            response.content_type = 'text/xml'
-            return response
+        if overloaded:
+            return exc.HTTPServiceUnavailable(
+                headers={'Retry-After': str(overloaded[0].retry_after)})
+        # got a valid XML RPC response
+        response = Response(response)
+        response.content_type = 'text/xml'
+        return response
 
 
 def make_xmlrpc_app(global_conf, **local_conf):
@@ -1,12 +1,30 @@
 import filecmp
+import gzip
+import hashlib
 import os
 import pytest
 import shutil
+import threading
+import time
+from io import BytesIO
 try:
     from cStringIO import StringIO  # Python 2.x
 except ImportError:                 # pragma: no cover
     from io import StringIO         # Python 3.x
-from ulif.openoffice.cachemanager import Bucket, CacheManager, get_marker
+from ulif.openoffice.cachemanager import (
+    Bucket, CacheIndex, CacheManager, CacheJanitor, digest_scope,
+    get_digest_key, get_file_digest, get_file_digests, get_key_digest,
+    get_marker, is_compressible, main, start_cache_janitor, write_hashed,
+    write_sidecars)
+from ulif.openoffice import cachemanager as cachemanager_module
+
+
+def set_last_access(cache_dir, cache_key, timestamp):
+    # set time of last access to some cached representation
+    hash_digest, src_num, repr_num = cache_key.split('_')
+    repr_dir = os.path.join(
+        cache_dir, hash_digest[:2], hash_digest, 'repr', src_num, repr_num)
+    os.utime(repr_dir, (timestamp, timestamp))
 
 
 @pytest.fixture(scope="function")
@@ -22,17 +40,157 @@ def cache_env(request, tmpdir):
 
 class TestHelpers(object):
 
+    def test_get_file_digests(self, tmpdir):
+        # we can get several digests of a file at once
+        path = tmpdir / "src.txt"
+        path.write(b'x' * 3000000, mode='wb')
+        result = get_file_digests(str(path), ('md5', 'sha256'))
+        assert result == {
+            'md5': hashlib.md5(b'x' * 3000000).hexdigest(),
+            'sha256': hashlib.sha256(b'x' * 3000000).hexdigest()}
+        assert get_file_digest(str(path), 'md5') == result['md5']
+
+    def test_get_file_digests_memoized(self, tmpdir, monkeypatch):
+        # digests are computed only once per file version
+        path = tmpdir / "src.txt"
+        path.write('foo')
+        opened = []
+        orig_open = cachemanager_module.io.open
+
+        def fake_open(*args, **kw):
+            opened.append(args[0])
+            return orig_open(*args, **kw)
+
+        monkeypatch.setattr(cachemanager_module.io, 'open', fake_open)
+        with digest_scope():
+            digest1 = get_file_digest(str(path))
+            with digest_scope():
+                assert get_file_digest(str(path)) == digest1
+            assert len(opened) == 1
+            # modified files are hashed again
+            path.write('foobar')
+            path.setmtime(path.mtime() + 10)
+            assert get_file_digest(str(path)) != digest1
+            assert len(opened) == 2
+        # outside of scopes nothing is remembered
+        path.write('barfoo')  # same size, maybe same mtime
+        assert get_file_digest(str(path)) == hashlib.sha256(
+            b'barfoo').hexdigest()
+        assert get_file_digest(str(path)) == hashlib.sha256(
+            b'barfoo').hexdigest()
+        assert len(opened) == 4
+
+    def test_write_hashed(self, tmpdir, monkeypatch):
+        # we can write files and get their digests on the fly
+        path = str(tmpdir / "dst.txt")
+        result = write_hashed(
+            BytesIO(b'foo'), path, ('md5', 'sha256'), chunksize=2)
+        assert open(path, 'rb').read() == b'foo'
+        assert result == {'md5': hashlib.md5(b'foo').hexdigest(),
+                          'sha256': hashlib.sha256(b'foo').hexdigest()}
+        # digests are remembered inside digest scopes
+        with digest_scope():
+            write_hashed(BytesIO(b'foo'), path, ('md5', 'sha256'))
+            monkeypatch.setattr(cachemanager_module.io, 'open', None)
+            assert get_file_digests(path, ('md5', 'sha256')) == result
+
+    def test_get_key_digest(self):
+        # we can get digests of strings and file-like objects
+        digest = get_key_digest('foo')
+        assert len(digest) == 64
+        assert get_key_digest(b'foo') == digest
+        file_like = StringIO('foo')
+        assert get_key_digest(file_like) == digest
+        assert file_like.read() == 'foo'  # file was rewound
+
     def test_get_marker(self):
         # Make sure, sorted dicts get the same marker
         result1 = get_marker()
         result2 = get_marker(options={})
-        result3 = get_marker(options={'b': '0', 'a': '1'})
-        result4 = get_marker(options={'a': '1', 'b': '0'})
-        assert result1 == 'W10'
-        assert result2 == 'W10'
+        result3 = get_marker(
+            options={'oocp-out-fmt': 'pdf', 'oocp-pdf-tagged': 'yes'})
+        result4 = get_marker(
+            options={'oocp-pdf-tagged': 'yes', 'oocp-out-fmt': 'pdf'})
+        assert result1 == result2
         assert result3 == result4
         assert result2 != result3
 
+    def test_get_marker_canonical(self):
+        # options that do not change output do not change markers
+        marker = get_marker({'oocp-out-fmt': 'pdf', 'oocp-pdf-tagged': 'yes'})
+        assert marker == get_marker({
+            'oocp-out-fmt': 'pdf', 'oocp-pdf-tagged': 'true',
+            'oocp-host': 'otherhost', 'oocp-port': '2003',
+            'oocp-listeners': 'host1:2002,host2:2002', 'unknown': 'foo'})
+        # explicitly set defaults do not either
+        assert get_marker({}) == get_marker({'oocp-out-fmt': 'html'})
+
+
+class TestSidecars(object):
+
+    def test_is_compressible(self):
+        # we can tell which files are worth compressing
+        assert is_compressible('sample.html') is True
+        assert is_compressible('sample.txt') is True
+        assert is_compressible('sample.pdf') is False
+        assert is_compressible('sample') is False
+
+    def test_write_sidecars(self, tmpdir):
+        # we can write compressed copies of files
+        path = tmpdir / "sample.html"
+        path.write(b'<p>Hello!</p>' * 100)
+        assert write_sidecars(str(path), ['gzip']) == ['gzip']
+        with gzip.open(str(path) + '.gz', 'rb') as fd:
+            assert fd.read() == b'<p>Hello!</p>' * 100
+        # results do not depend on time of creation
+        first = (tmpdir / "sample.html.gz").read_binary()
+        write_sidecars(str(path), ['gzip'])
+        assert (tmpdir / "sample.html.gz").read_binary() == first
+        assert sorted(os.listdir(str(tmpdir))) == [
+            'sample.html', 'sample.html.gz']
+
+    def test_write_sidecars_no_gain(self, tmpdir):
+        # compressed copies not smaller than originals are not kept
+        path = tmpdir / "sample.html"
+        path.write(b'Hi')
+        assert write_sidecars(str(path), ['gzip']) == []
+        assert os.listdir(str(tmpdir)) == ['sample.html']
+
+    def test_register_doc(self, tmpdir):
+        # cache managers can store sidecars with representations
+        cm = CacheManager(str(tmpdir / "cache"), sidecars=True)
+        (tmpdir / "src.txt").write("Source")
+        (tmpdir / "result.html").write("<p>Result!</p>" * 100)
+        key = cm.register_doc(
+            str(tmpdir / "src.txt"), str(tmpdir / "result.html"))
+        path = cm.get_cached_file(key)
+        assert path.endswith('result.html')
+        assert os.path.isfile(path + '.gz')
+        assert cm.get_digest(key) == get_file_digest(path)
+        assert cm.get_cached_file_by_source(
+            str(tmpdir / "src.txt"))[0] == path
+        # sidecars count for cache size
+        assert cm.stats()['size'] > os.path.getsize(path)
+
+    def test_register_doc_dot_name(self, tmpdir):
+        # representations named like hidden files are found
+        cm = CacheManager(
+            str(tmpdir / "cache"), sidecars=True, use_index=True)
+        (tmpdir / "src.txt").write("Source")
+        (tmpdir / ".result.html").write("<p>Result!</p>" * 100)
+        key = cm.register_doc(
+            str(tmpdir / "src.txt"), str(tmpdir / ".result.html"))
+        path = cm.get_cached_file(key)
+        assert path.endswith('/.result.html')
+        assert os.path.isfile(path + '.gz')
+        assert cm.get_cached_file_by_source(
+            str(tmpdir / "src.txt"))[0] == path
+        # representations may even look like sidecars
+        (tmpdir / "result.gz").write("Result")
+        key = cm.register_doc(
+            str(tmpdir / "src.txt"), str(tmpdir / "result.gz"), 'foo')
+        assert cm.get_cached_file(key).endswith('/result.gz')
+
 
 class TestCacheBucket(object):
     # Tests for CacheBucket
@@ -93,6 +251,81 @@ class TestCacheBucket(object):
         assert bucket.get_stored_source_num(str(src1)) == 1
         assert bucket.get_stored_source_num(str(src2)) == 2
 
+    def test_get_stored_source_num_digests(self, cache_env):
+        # digests of stored sources are kept in bucket data
+        bucket = Bucket(str(cache_env.join("cache")))
+        src1 = str(cache_env / "src1.txt")
+        bucket.store_representation(src1, str(cache_env / "result1.txt"))
+        assert bucket.data['digests']['sources'] == {
+            'source_1': get_file_digest(src1)}
+        assert bucket.data['names']['sources'] == {
+            get_file_digest(src1): 'source_1'}
+        # buckets without digests (created by older versions) are
+        # still searched, but not modified by lookups
+        data = bucket.data
+        del data['digests'], data['names']
+        bucket = Bucket(str(cache_env.join("cache")))
+        bucket.data = data
+        assert bucket.get_stored_source_num(src1) == 1
+        assert 'digests' not in bucket.data
+        # missing digests are recorded when storing
+        bucket.store_representation(
+            src1, str(cache_env / "result1.txt"), 'foo')
+        assert bucket.data['digests']['sources'] == {
+            'source_1': get_file_digest(src1)}
+        assert bucket.data['digests'][os.path.join('keys', '1')] == {
+            '1.key': get_key_digest(''), '2.key': get_key_digest('foo')}
+
+    def test_get_source_digest(self, cache_env):
+        # we can get digests of stored sources
+        bucket = Bucket(str(cache_env.join("cache")))
+        src1 = str(cache_env / "src1.txt")
+        bucket.store_representation(src1, str(cache_env / "result1.txt"))
+        assert bucket.get_source_digest(1) == get_file_digest(src1)
+        assert bucket.get_source_digest(2) is None
+        # sources stored by older versions are hashed
+        bucket._drop_digests('sources')
+        assert bucket.get_source_digest(1) == get_file_digest(src1)
+
+    def test_remove_drops_digests(self, cache_env):
+        # digests of removed files are dropped from bucket data
+        bucket = Bucket(str(cache_env.join("cache")))
+        src1 = str(cache_env / "src1.txt")
+        bucket.store_representation(src1, str(cache_env / "result1.txt"))
+        bucket.store_representation(
+            src1, str(cache_env / "result1.txt"), 'foo')
+        bucket.remove_representation('1_1')
+        assert bucket.data['names'][os.path.join('keys', '1')] == {
+            get_key_digest('foo'): '2.key'}
+        assert os.path.join('repr', '1', '1') not in bucket.data['digests']
+        bucket.remove_representation('1_2')
+        assert bucket.data['digests']['sources'] == {}
+        assert bucket.get_stored_source_num(src1) is None
+
+    def test_get_stored_source_num_paranoid(self, cache_env):
+        # in paranoid mode we compare contents byte by byte
+        bucket = Bucket(str(cache_env.join("cache")))
+        src1 = str(cache_env / "src1.txt")
+        bucket.store_representation(src1, str(cache_env / "result1.txt"))
+        # change stored source behind the back of the bucket
+        with open(os.path.join(bucket.srcdir, 'source_1'), 'w') as fd:
+            fd.write('manipulated')
+        assert bucket.get_stored_source_num(src1) == 1
+        bucket = Bucket(str(cache_env.join("cache")), paranoid=True)
+        assert bucket.get_stored_source_num(src1) is None
+
+    def test_get_stored_repr_num_paranoid(self, cache_env):
+        # in paranoid mode keys are compared byte by byte
+        bucket = Bucket(str(cache_env.join("cache")), paranoid=True)
+        bucket.store_representation(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"),
+            repr_key='foo')
+        assert bucket.get_stored_repr_num(1, 'foo') == 1
+        assert bucket.get_stored_repr_num(1, StringIO('foo')) == 1
+        with open(os.path.join(bucket.keysdir, '1', '1.key'), 'w') as fd:
+            fd.write('bar')
+        assert bucket.get_stored_repr_num(1, 'foo') is None
+
     def test_get_stored_repr_num(self, tmpdir):
         # we can get a representation number if the repective key is
         # stored in the bucket already.
@@ -208,6 +441,63 @@ class TestCacheBucket(object):
             str(cache_env / "result3.txt"), repr_key='baz')
         assert sorted(list(bucket.keys())) == [key1, key2, key3]
 
+    def test_get_entries(self, cache_env):
+        # we can get keys, access times and sizes of representations
+        bucket = Bucket(str(cache_env / "cache"))
+        key1 = bucket.store_representation(
+            str(cache_env / "src1.txt"),
+            str(cache_env / "result1.txt"), repr_key='foo')
+        entries = list(bucket.get_entries())
+        assert len(entries) == 1
+        assert entries[0][0] == key1
+        assert entries[0][2] == 8
+
+    def test_touch(self, cache_env):
+        # we can mark representations as used
+        bucket = Bucket(str(cache_env / "cache"))
+        key1 = bucket.store_representation(
+            str(cache_env / "src1.txt"),
+            str(cache_env / "result1.txt"), repr_key='foo')
+        repr_dir = os.path.dirname(bucket.get_representation(key1))
+        os.utime(repr_dir, (1000, 1000))
+        bucket.touch(key1)
+        assert os.path.getmtime(repr_dir) > 1000
+
+    def test_remove_representation(self, cache_env):
+        # we can remove representations. Sources are removed with the
+        # last representation
+        bucket = Bucket(str(cache_env / "cache"))
+        key1 = bucket.store_representation(
+            str(cache_env / "src1.txt"),
+            str(cache_env / "result1.txt"), repr_key='foo')
+        key2 = bucket.store_representation(
+            str(cache_env / "src1.txt"),
+            str(cache_env / "result2.txt"), repr_key='bar')
+        assert bucket.remove_representation(key1) == 8
+        assert list(bucket.keys()) == [key2]
+        assert bucket.get_stored_repr_num(1, 'foo') is None
+        assert bucket.get_source_size(1) == 8
+        assert bucket.remove_representation(key2) == 16
+        assert list(bucket.keys()) == []
+        assert os.listdir(bucket.srcdir) == []
+        assert bucket.remove_representation(key2) == 0
+        # numbers are not reused
+        key3 = bucket.store_representation(
+            str(cache_env / "src1.txt"),
+            str(cache_env / "result1.txt"), repr_key='foo')
+        assert key3 == '2_1'
+
+    def test_get_orphaned_sources(self, cache_env):
+        # we can find sources without representations
+        bucket = Bucket(str(cache_env / "cache"))
+        key1 = bucket.store_representation(
+            str(cache_env / "src1.txt"),
+            str(cache_env / "result1.txt"), repr_key='foo')
+        shutil.rmtree(os.path.dirname(bucket.get_representation(key1)))
+        # recently stored sources are not orphaned
+        assert list(bucket.get_orphaned_sources()) == []
+        assert list(bucket.get_orphaned_sources(grace_time=-1)) == [1]
+
 
 class TestCacheManager(object):
     # Tests for class `CacheManager`
@@ -376,6 +666,70 @@ class TestCacheManager(object):
         assert key3 == my_id3
         return
 
+    def test_get_digest(self, cache_env):
+        # we can get digests of cached docs without reading them again
+        cm = CacheManager(str(cache_env / "cache"))
+        key = cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        digest = get_file_digest(str(cache_env / "result1.txt"))
+        assert cm.get_digest(key) == digest
+        # the digest is stored next to the representation
+        repr_dir = os.path.dirname(cm.get_cached_file(key))
+        with open(os.path.join(repr_dir, '.digest')) as fd:
+            assert fd.read() == digest
+        assert cm.get_digest(key[:-1] + '2') is None
+        assert cm.get_digest('0' * 32 + '_1_1') is None
+        assert cm.get_digest('invalid') is None
+
+    def test_get_digest_no_hashing(self, cache_env, monkeypatch):
+        # we read neither buckets nor representations to get digests
+        cm = CacheManager(str(cache_env / "cache"))
+        key = cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        digest = get_file_digest(str(cache_env / "result1.txt"))
+        monkeypatch.setattr(cachemanager_module, 'Bucket', None)
+        monkeypatch.setattr(cachemanager_module, 'get_file_digests', None)
+        assert cm.get_digest(key) == digest
+        # entries stored by older versions have no digest
+        os.unlink(os.path.join(
+            os.path.dirname(cm.get_cached_file(key)), '.digest'))
+        assert cm.get_digest(key) is None
+
+    def test_get_cached_file_by_digests(self, cache_env):
+        # we can find docs by the digests of their sources
+        cm = CacheManager(str(cache_env / "cache"))
+        src1 = str(cache_env / "src1.txt")
+        key1 = cm.register_doc(src1, str(cache_env / "result1.txt"), 'foo')
+        digests = get_file_digests(src1, ('md5', 'sha256'))
+        path, key = cm.get_cached_file_by_digests(digests, 'foo')
+        assert key == key1
+        assert open(path).read() == 'result1\n'
+        assert cm.get_cached_file_by_digests(digests, 'bar') == (None, None)
+        # all needed digests must be given
+        assert cm.get_cached_file_by_digests(
+            dict(md5=digests['md5']), 'foo') == (None, None)
+        assert cm.get_cached_file_by_digests(
+            dict(md5=digests['md5'], sha256='123'), 'foo') == (None, None)
+        assert cm.get_cached_file_by_digests(
+            dict(md5='../..', sha256='123'), 'foo') == (None, None)
+        # paranoid cache managers must compare sources
+        cm.paranoid = True
+        assert cm.get_cached_file_by_digests(digests, 'foo') == (None, None)
+
+    def test_get_cached_file_by_digests_legacy(self, cache_env):
+        # sources stored w/o digests by older versions are not found
+        cm = CacheManager(str(cache_env / "cache"))
+        src1 = str(cache_env / "src1.txt")
+        key1 = cm.register_doc(src1, str(cache_env / "result1.txt"), 'foo')
+        bucket = Bucket(cm._get_bucket_path(key1.split('_')[0]))
+        data = bucket.data
+        del data['digests'], data['names']
+        bucket.data = data
+        digests = get_file_digests(src1, ('md5', 'sha256'))
+        assert cm.get_cached_file_by_digests(digests, 'foo') == (None, None)
+        # but we can still find them by source
+        assert cm.get_cached_file_by_source(src1, 'foo')[1] == key1
+
     def test_register_doc(self, cache_env):
         # we can register docs
         cm = CacheManager(str(cache_env / "cache"))
@@ -405,6 +759,79 @@ class TestCacheManager(object):
         assert hash3 == '443a07e0e92b7dc6b21f8be6a388f05f'
         with pytest.raises(TypeError):
             cm.get_hash()
+        # we can call get_hash() on the class as well
+        assert CacheManager.get_hash(str(cache_env / "src1.txt")) == hash1
+
+    def test_hash_algorithm(self, cache_env):
+        # we can pick other hash algorithms
+        cm = CacheManager(str(cache_env / "cache"), hash_algorithm='sha256')
+        src1 = str(cache_env / "src1.txt")
+        assert cm.get_hash(src1) == hashlib.sha256(b'source1\n').hexdigest()
+        key = cm.register_doc(src1, str(cache_env / "result1.txt"))
+        assert key.startswith(cm.get_hash(src1))
+        assert cm.get_cached_file(key) is not None
+        with pytest.raises(ValueError):
+            CacheManager(str(cache_env / "cache"), hash_algorithm='foo')
+        # the algorithm is stored in cache dir
+        assert CacheManager(
+            str(cache_env / "cache")).hash_algorithm == 'sha256'
+        with pytest.raises(ValueError):
+            CacheManager(str(cache_env / "cache"), hash_algorithm='md5')
+
+    def test_hash_algorithm_used_cache(self, cache_env):
+        # we cannot switch algorithms of caches with entries
+        cm = CacheManager(str(cache_env / "cache"))
+        cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        with pytest.raises(ValueError):
+            CacheManager(str(cache_env / "cache"), hash_algorithm='sha256')
+        assert not (cache_env / "cache" / ".hash_algorithm").exists()
+
+    def test_key_scheme_digest(self, cache_env):
+        # we can get cache keys derived from digests only
+        cm = CacheManager(str(cache_env / "cache"), key_scheme='digest')
+        src1 = str(cache_env / "src1.txt")
+        key = cm.register_doc(src1, str(cache_env / "result1.txt"), 'foo')
+        assert key == get_digest_key(
+            hashlib.sha256(b'source1\n').hexdigest(), 'foo')
+        assert cm.get_cached_file(key) == cm.get_cached_file(
+            '737b337e605199de28b3b64c674f9422_1_1')
+        assert cm.get_digest(key) == hashlib.sha256(b'result1\n').hexdigest()
+        assert cm.get_cached_file_by_source(src1, 'foo')[1] == key
+        assert cm.get_cached_file_by_source(src1, 'bar') == (None, None)
+        assert cm.get_cached_file(get_digest_key(64 * '0', 'foo')) is None
+        # the key scheme is stored in cache dir
+        assert CacheManager(str(cache_env / "cache")).key_scheme == 'digest'
+        with pytest.raises(ValueError):
+            CacheManager(str(cache_env / "cache"), key_scheme='bucket')
+        with pytest.raises(ValueError):
+            CacheManager(str(cache_env / "cache2"), key_scheme='foo')
+
+    def test_key_scheme_digest_other_cache(self, cache_env):
+        # keys are the same in other caches, whatever was stored before
+        cm1 = CacheManager(str(cache_env / "cache1"), key_scheme='digest')
+        cm2 = CacheManager(str(cache_env / "cache2"), key_scheme='digest')
+        src1 = str(cache_env / "src1.txt")
+        result1 = str(cache_env / "result1.txt")
+        cm1.register_doc(str(cache_env / "src2.txt"), result1, 'foo')
+        cm1.register_doc(src1, result1, 'bar')
+        assert cm1.register_doc(src1, result1, 'foo') == cm2.register_doc(
+            src1, result1, 'foo')
+
+    def test_key_scheme_digest_evict(self, cache_env, monkeypatch):
+        # keys of evicted docs are removed
+        cache_dir = str(cache_env / "cache")
+        cm = CacheManager(cache_dir, key_scheme='digest', max_entries=1)
+        key1 = cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        set_last_access(cache_dir, cm._resolve_cache_key(key1), 1000)
+        key2 = cm.register_doc(
+            str(cache_env / "src2.txt"), str(cache_env / "result2.txt"))
+        monkeypatch.setattr(os, 'walk', None)  # we do not scan all keys
+        assert len(cm.evict()) == 1
+        assert cm.get_cached_file(key2) is not None
+        assert not os.path.exists(cm._get_digest_key_path(key1))
+        assert os.path.exists(cm._get_digest_key_path(key2))
 
     def test_keys(self, cache_env):
         # we can get all cache keys
@@ -455,6 +882,402 @@ class TestCacheManager(object):
         ]
         assert key3 == 'd5aa51d7fb180729089d2de904f7dffe_1_1'
 
+    def test_locked(self, cache_env):
+        # only one thread at a time can lock a source/key pair
+        cm = CacheManager(str(cache_env / "cache"))
+        src1 = str(cache_env / "src1.txt")
+        src2 = str(cache_env / "src2.txt")
+        result = []
+
+        def worker():
+            with cm.locked(src1, 'foo'):
+                result.append('worker')
+
+        with cm.locked(src1, 'foo'):
+            # other sources and keys are not blocked
+            with cm.locked(src1, 'bar'):
+                pass
+            with cm.locked(src2, 'foo'):
+                pass
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join(0.2)
+            assert result == []
+        thread.join()
+        assert result == ['worker']
+
+    def test_locked_no_keys(self, cache_env):
+        # lock files do not show up as cache entries
+        cm = CacheManager(str(cache_env / "cache"))
+        with cm.locked(str(cache_env / "src1.txt"), 'foo'):
+            pass
+        assert (cache_env / "cache" / ".locks").isdir()
+        assert list(cm.keys()) == []
+
+    def test_locked_removes_lock_files(self, cache_env):
+        # lock files are removed after use
+        cm = CacheManager(str(cache_env / "cache"))
+        for key in ('foo', 'bar'):
+            with cm.locked(str(cache_env / "src1.txt"), key):
+                assert len((cache_env / "cache" / ".locks").listdir()) == 1
+        assert (cache_env / "cache" / ".locks").listdir() == []
+
+    def test_init_limits(self, tmpdir):
+        # we can set limits, also as strings
+        cm = CacheManager(
+            str(tmpdir), max_size='1K', max_entries='2', max_age='60')
+        assert cm.max_size == 1024
+        assert cm.max_entries == 2
+        assert cm.max_age == 60
+        cm = CacheManager(str(tmpdir))
+        assert cm.max_size is cm.max_entries is cm.max_age is None
+
+    def test_get_cached_file_updates_access(self, cache_env):
+        # retrieving cached files marks them as used
+        cache_dir = str(cache_env / "cache")
+        cm = CacheManager(cache_dir)
+        src1 = str(cache_env / "src1.txt")
+        key1 = cm.register_doc(src1, str(cache_env / "result1.txt"), 'foo')
+        path = cm.get_cached_file(key1)
+        set_last_access(cache_dir, key1, 1000)
+        cm.get_cached_file(key1)
+        assert os.path.getmtime(os.path.dirname(path)) > 1000
+        set_last_access(cache_dir, key1, 1000)
+        cm.get_cached_file_by_source(src1, 'foo')
+        assert os.path.getmtime(os.path.dirname(path)) > 1000
+
+    def test_evict_no_limits(self, cache_env):
+        # w/o limits nothing is removed
+        cm = CacheManager(str(cache_env / "cache"))
+        cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        assert cm.evict() == []
+        assert len(list(cm.keys())) == 1
+
+    def test_evict_max_entries(self, cache_env):
+        # least recently used entries are removed first
+        cache_dir = str(cache_env / "cache")
+        cm = CacheManager(cache_dir, max_entries=2)
+        keys = []
+        for num, (src, key) in enumerate(
+                [('src1', 'foo'), ('src2', 'foo'), ('src1', 'bar')]):
+            key = cm.register_doc(
+                str(cache_env / ("%s.txt" % src)),
+                str(cache_env / "result1.txt"), key)
+            set_last_access(cache_dir, key, 1000 + num)
+            keys.append(key)
+        set_last_access(cache_dir, keys[0], 2000)
+        assert cm.evict() == [keys[1]]
+        assert sorted(cm.keys()) == sorted([keys[0], keys[2]])
+        # the source of the removed entry is gone as well
+        assert cm.get_cached_file_by_source(
+            str(cache_env / "src2.txt"), 'foo') == (None, None)
+
+    def test_evict_concurrent_register(self, cache_env):
+        # docs stored while eviction waits for its locks are kept
+        cache_dir = str(cache_env / "cache")
+        cm = CacheManager(cache_dir, max_entries=1)
+        src1 = str(cache_env / "src1.txt")
+        key_a = cm.register_doc(src1, str(cache_env / "result1.txt"), 'a')
+        cm.register_doc(src1, str(cache_env / "result2.txt"), 'b')
+        set_last_access(cache_dir, key_a, 1000)
+        keys, orig_locked = [], cm._locked
+
+        def locked(*args):
+            if not keys:
+                keys.append(cm.register_doc(
+                    src1, str(cache_env / "result3.txt"), 'c'))
+            return orig_locked(*args)
+
+        cm._locked = locked
+        assert cm.evict() == [key_a]
+        key_d = cm.register_doc(src1, str(cache_env / "result4.txt"), 'd')
+        assert key_d != keys[0]
+        with open(cm.get_cached_file(keys[0])) as fd:
+            assert fd.read() == 'result3\n'
+        with open(cm.get_cached_file(key_d)) as fd:
+            assert fd.read() == 'result4\n'
+
+    def test_evict_max_size(self, cache_env):
+        # we remove entries until the cache is small enough
+        cache_dir = str(cache_env / "cache")
+        cm = CacheManager(cache_dir, max_size=20)
+        key1 = cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        key2 = cm.register_doc(
+            str(cache_env / "src2.txt"), str(cache_env / "result2.txt"))
+        set_last_access(cache_dir, key1, 1000)
+        # each entry consumes 16 bytes (8 source, 8 representation)
+        assert cm.evict() == [key1]
+        assert list(cm.keys()) == [key2]
+
+    def test_evict_max_age(self, cache_env):
+        # entries not used for some time are removed
+        cache_dir = str(cache_env / "cache")
+        cm = CacheManager(cache_dir, max_age=3600)
+        key1 = cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        key2 = cm.register_doc(
+            str(cache_env / "src2.txt"), str(cache_env / "result2.txt"))
+        set_last_access(cache_dir, key1, time.time() - 7200)
+        assert cm.evict() == [key1]
+        assert list(cm.keys()) == [key2]
+
+    def test_janitor(self, cache_env):
+        # janitors evict entries regularly
+        cache_dir = str(cache_env / "cache")
+        cm = CacheManager(cache_dir, max_entries=1)
+        key1 = cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        set_last_access(cache_dir, key1, 1000)
+        cm.register_doc(
+            str(cache_env / "src2.txt"), str(cache_env / "result2.txt"))
+        janitor = CacheJanitor(cm, interval=0.01)
+        janitor.start()
+        for x in range(100):
+            if len(list(cm.keys())) == 1:
+                break
+            time.sleep(0.01)
+        janitor.stop()
+        janitor.join()
+        assert len(list(cm.keys())) == 1
+
+    def test_start_cache_janitor_no_limits(self, tmpdir):
+        # w/o limits, no janitor is started
+        assert start_cache_janitor(CacheManager(str(tmpdir))) is None
+        janitor = start_cache_janitor(CacheManager(str(tmpdir), max_age=1))
+        assert janitor.is_alive()
+        janitor.stop()
+
+    def test_main(self, cache_env, capsys):
+        # we can evict entries from the commandline
+        cache_dir = str(cache_env / "cache")
+        cm = CacheManager(cache_dir)
+        cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        main([cache_dir, '--max-size', '1K'])
+        assert capsys.readouterr()[0] == "Removed 0 entries from cache\n"
+        main([cache_dir, '--max-entries', '0', '--max-size', '1'])
+        assert capsys.readouterr()[0] == "Removed 1 entries from cache\n"
+        assert list(cm.keys()) == []
+
+
+class TestCacheManagerReadOnly(object):
+    # Tests for read-only cache managers
+
+    def snapshot(self, path):
+        # get a list of all files and dirs below `path` with mtimes
+        return sorted(
+            [(str(p), p.mtime()) for p in path.visit()])
+
+    def test_no_cache_dir(self, tmpdir):
+        # read-only cache managers do not create cache dirs
+        with pytest.raises(IOError):
+            CacheManager(str(tmpdir / "cache"), read_only=True)
+
+    def test_lookups(self, cache_env):
+        # lookups do not modify anything
+        cache_dir = str(cache_env / "cache")
+        src1 = str(cache_env / "src1.txt")
+        key1 = CacheManager(cache_dir).register_doc(
+            src1, str(cache_env / "result1.txt"), 'foo')
+        before = self.snapshot(cache_env / "cache")
+        cm = CacheManager(cache_dir, read_only=True)
+        assert cm.get_cached_file(key1).endswith('result1.txt')
+        assert cm.get_cached_file_by_source(src1, 'foo')[1] == key1
+        assert cm.get_cached_file_by_source(src1, 'bar') == (None, None)
+        assert cm.get_cached_file_by_source(
+            str(cache_env / "src2.txt"), 'foo') == (None, None)
+        assert cm.get_cached_file('0123456789_1_1') is None
+        assert list(cm.keys()) == [key1]
+        assert self.snapshot(cache_env / "cache") == before
+
+    def test_no_writes(self, cache_env):
+        # we cannot store documents in read-only caches
+        cache_env.mkdir("cache")
+        cm = CacheManager(str(cache_env / "cache"), read_only=True)
+        src1 = str(cache_env / "src1.txt")
+        with pytest.raises(IOError):
+            cm.register_doc(src1, str(cache_env / "result1.txt"))
+        with pytest.raises(IOError):
+            cm.evict()
+        with pytest.raises(IOError):
+            with cm.locked(src1, 'foo'):
+                pass
+
+    def test_no_buckets_created(self, cache_env):
+        # lookups of unknown docs do not create buckets, also in
+        # regular mode
+        cm = CacheManager(str(cache_env / "cache"))
+        assert cm.get_cached_file_by_source(
+            str(cache_env / "src1.txt")) == (None, None)
+        assert cm.get_cached_file('737b337e605199de28b3b64c674f9422_1_1') \
+            is None
+        assert os.listdir(str(cache_env / "cache")) == []
+
+    def test_invalid_keys(self, cache_env):
+        # cache keys cannot point outside the cache
+        cm = CacheManager(str(cache_env / "cache"))
+        assert cm.get_cached_file('../../etc_1_1') is None
+        assert cm.get_cached_file('abc_../1') is None
+
+    def test_index(self, cache_env):
+        # indexes are used read-only
+        cache_dir = str(cache_env / "cache")
+        src1 = str(cache_env / "src1.txt")
+        key1 = CacheManager(cache_dir, use_index=True).register_doc(
+            src1, str(cache_env / "result1.txt"), 'foo')
+        cm = CacheManager(cache_dir, read_only=True)
+        assert cm.index.read_only is True
+        assert cm.get_cached_file_by_source(src1, 'foo')[1] == key1
+
+
+class TestCacheIndex(object):
+    # Tests for class `CacheIndex`
+
+    def test_add_find_remove(self, cache_env):
+        # we can add, find and remove entries
+        index = CacheIndex(str(cache_env / "index.sqlite"))
+        index.add('abc', '1_2', get_key_digest('foo'),
+                  str(cache_env / "result1.txt"))
+        assert index.find('abc', get_key_digest('foo')) == ['1_2']
+        assert index.find('abc', get_key_digest('bar')) == []
+        assert index.keys() == ['abc_1_2']
+        assert index.stats() == dict(entries=1, size=8)
+        index.remove('abc', '1_2')
+        assert index.keys() == []
+        assert index.stats() == dict(entries=0, size=0)
+
+    def test_persistent(self, cache_env):
+        # entries are stored on disk
+        index = CacheIndex(str(cache_env / "index.sqlite"))
+        index.add('abc', '1_1', get_key_digest('foo'),
+                  str(cache_env / "result1.txt"))
+        assert CacheIndex(str(cache_env / "index.sqlite")).keys() == [
+            'abc_1_1']
+
+    def test_schema_created_once(self, cache_env, monkeypatch):
+        # the schema is set up once per index and process only
+        path = str(cache_env / "index.sqlite")
+        CacheIndex(path)
+
+        def fail(*args):
+            raise AssertionError('schema created again')  # pragma: no cover
+
+        monkeypatch.setattr(CacheIndex, '_create_schema', fail)
+        monkeypatch.setattr(CacheIndex, '_connect', fail)
+        CacheIndex(path)
+
+    def test_schema_version(self, cache_env, monkeypatch):
+        # other processes see from the schema version that the schema
+        # is up to date
+        path = str(cache_env / "index.sqlite")
+        CacheIndex(path)
+        monkeypatch.setattr(
+            cachemanager_module, '_prepared_indexes', set())
+
+        def fail(*args):
+            raise AssertionError('schema created again')  # pragma: no cover
+
+        monkeypatch.setattr(CacheIndex, '_create_schema', fail)
+        CacheIndex(path)
+
+    def test_digest(self, cache_env):
+        # we can store and get digests of representations
+        index = CacheIndex(str(cache_env / "index.sqlite"))
+        index.add('abc', '1_1', get_key_digest('foo'),
+                  str(cache_env / "result1.txt"), 'deadbeef')
+        index.add('abc', '1_2', get_key_digest('bar'),
+                  str(cache_env / "result1.txt"))
+        assert index.get_digest('abc', '1_1') == 'deadbeef'
+        assert index.get_digest('abc', '1_2') is None
+        assert index.get_digest('abc', '1_3') is None
+
+    def test_old_schema(self, cache_env):
+        # indexes without digests are upgraded
+        import sqlite3
+        path = str(cache_env / "index.sqlite")
+        conn = sqlite3.connect(path)
+        conn.execute(
+            "CREATE TABLE entries (hash TEXT, src_num INTEGER, "
+            "repr_num INTEGER, key_digest TEXT, size INTEGER, mtime REAL, "
+            "content_type TEXT, PRIMARY KEY (hash, src_num, repr_num))")
+        conn.commit()
+        conn.close()
+        assert CacheIndex(path, read_only=True).get_digest(
+            'abc', '1_1') is None
+        index = CacheIndex(path)
+        index.add('abc', '1_1', get_key_digest('foo'),
+                  str(cache_env / "result1.txt"), 'deadbeef')
+        assert index.get_digest('abc', '1_1') == 'deadbeef'
+
+
+class TestCacheManagerIndexed(object):
+    # Tests for cache managers using an index
+
+    def test_init(self, cache_env):
+        # indexes are used if requested or existing
+        cache_dir = str(cache_env / "cache")
+        assert CacheManager(cache_dir).index is None
+        assert CacheManager(cache_dir, use_index=True).index is not None
+        assert CacheManager(cache_dir).index is not None
+        assert CacheManager(cache_dir, use_index=False).index is None
+
+    def test_register_and_lookup(self, cache_env):
+        # registered docs are indexed and can be found
+        cm = CacheManager(str(cache_env / "cache"), use_index=True)
+        src1 = str(cache_env / "src1.txt")
+        key1 = cm.register_doc(src1, str(cache_env / "result1.txt"), 'foo')
+        key2 = cm.register_doc(src1, str(cache_env / "result2.txt"), 'bar')
+        assert sorted(cm.keys()) == sorted([key1, key2])
+        path, key = cm.get_cached_file_by_source(src1, 'bar')
+        assert key == key2
+        assert open(path).read() == 'result2\n'
+        assert cm.get_cached_file_by_source(src1, 'baz') == (None, None)
+        assert cm.get_cached_file_by_source(
+            str(cache_env / "src2.txt"), 'foo') == (None, None)
+        assert cm.stats() == dict(entries=2, size=16)
+
+    def test_get_digest(self, cache_env):
+        # digests of representations are taken from index
+        cm = CacheManager(str(cache_env / "cache"), use_index=True)
+        key = cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        digest = get_file_digest(str(cache_env / "result1.txt"))
+        assert cm.index.get_digest(*key.split('_', 1)) == digest
+        assert cm.get_digest(key) == digest
+
+    def test_migrate(self, cache_env):
+        # existing caches are indexed when an index is requested
+        cache_dir = str(cache_env / "cache")
+        cm = CacheManager(cache_dir)
+        key1 = cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"),
+            'foo')
+        assert cm.stats() == dict(entries=1, size=8)
+        cm = CacheManager(cache_dir, use_index=True)
+        assert list(cm.keys()) == [key1]
+        assert cm.get_cached_file_by_source(
+            str(cache_env / "src1.txt"), 'foo')[1] == key1
+
+    def test_evict(self, cache_env):
+        # evicted entries are removed from index
+        cm = CacheManager(
+            str(cache_env / "cache"), use_index=True, max_entries=0)
+        cm.register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        assert len(cm.evict()) == 1
+        assert list(cm.keys()) == []
+
+    def test_main_rebuild_index(self, cache_env, capsys):
+        # we can build indexes from the commandline
+        cache_dir = str(cache_env / "cache")
+        CacheManager(cache_dir).register_doc(
+            str(cache_env / "src1.txt"), str(cache_env / "result1.txt"))
+        main([cache_dir, '--rebuild-index'])
+        assert capsys.readouterr()[0].startswith("Indexed 1 entries\n")
+        assert CacheManager(cache_dir).index is not None
+
 
 class NotHashingCacheManager(CacheManager):
     # a cache manager that always returns the same hash
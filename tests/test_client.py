@@ -2,7 +2,13 @@
 import filecmp
 import os
 import pytest
-from ulif.openoffice.client import convert_doc, Client, main
+import threading
+import time
+from ulif.openoffice import client as client_module
+from ulif.openoffice.cachemanager import CacheManager, get_marker
+from ulif.openoffice.client import (
+    _encode_multipart, convert_doc, convert_docs, AdmissionControl, Client,
+    Overloaded, main)
 from ulif.openoffice.options import ArgumentParserError
 
 
@@ -73,6 +79,215 @@ class TestConvertDoc(object):
         assert 'other.foo' not in result_list
         assert 'sample.html' in result_list
 
+    def test_cached_no_conversion(self, workdir):
+        # docs already in cache are not converted again
+        src_doc = str(workdir / 'src' / 'sample.txt')
+        workdir.join('fake.pdf').write('Fake result.')
+        options = {'oocp-out-fmt': 'pdf'}
+        cache_key = CacheManager(str(workdir / 'cache')).register_doc(
+            src_doc, str(workdir / 'fake.pdf'), get_marker(options))
+        result_path, key, metadata = convert_doc(
+            src_doc, options=options, cache_dir=str(workdir / 'cache'))
+        assert key == cache_key
+        assert metadata == {'error': False, 'cached': True}
+        assert open(result_path).read() == 'Fake result.'
+        # we get a copy, not the cached file itself
+        assert str(workdir / 'cache') not in result_path
+
+    def test_read_only(self, workdir, monkeypatch):
+        # read-only caches are looked up but not modified
+        src_doc = str(workdir / 'src' / 'sample.txt')
+        workdir.join('fake.pdf').write('Fake result.')
+        cache_dir = str(workdir / 'cache')
+        CacheManager(cache_dir).register_doc(
+            src_doc, str(workdir / 'fake.pdf'), get_marker({}))
+        (workdir / 'cache' / '.locks').remove()  # left by registering
+
+        def fake_process_doc(src_doc, options):
+            return str(workdir / 'fake.pdf'), dict(error=False)
+
+        monkeypatch.setattr(client_module, '_process_doc', fake_process_doc)
+        result_path, key, metadata = convert_doc(
+            src_doc, options={}, cache_dir=cache_dir, read_only=True)
+        assert metadata == {'error': False, 'cached': True}
+        # documents not in cache are converted but not stored
+        result_path, key, metadata = convert_doc(
+            src_doc, options={'oocp-out-fmt': 'pdf'}, cache_dir=cache_dir,
+            read_only=True)
+        assert key is None
+        assert metadata == {'error': False}
+        assert len(list(CacheManager(cache_dir).keys())) == 1
+        assert not (workdir / 'cache' / '.locks').exists()
+
+    def test_failed_conversion_cached(self, workdir, monkeypatch):
+        # failed conversions are not cached and give no cache key
+        src_doc = str(workdir / 'src' / 'sample.txt')
+
+        def fake_process_doc(src_doc, options):
+            return None, {'error': True, 'error-descr': 'bad doc'}
+
+        monkeypatch.setattr(client_module, '_process_doc', fake_process_doc)
+        result_path, key, metadata = convert_doc(
+            src_doc, options={}, cache_dir=str(workdir / 'cache'))
+        assert (result_path, key) == (None, None)
+        assert metadata['error'] is True
+
+    def test_concurrent_requests_coalesced(self, workdir, monkeypatch):
+        # identical requests running in parallel are converted only once
+        src_doc = str(workdir / 'src' / 'sample.txt')
+        calls = []
+
+        def fake_process_doc(src_doc, options):
+            calls.append(src_doc)
+            time.sleep(0.1)
+            result_dir = workdir.mkdir('result%s' % len(calls))
+            result_dir.join('sample.pdf').write('Fake result.')
+            return str(result_dir / 'sample.pdf'), dict(error=False)
+
+        monkeypatch.setattr(client_module, '_process_doc', fake_process_doc)
+        results = []
+
+        def worker():
+            results.append(convert_doc(
+                src_doc, options={}, cache_dir=str(workdir / 'cache')))
+
+        threads = [threading.Thread(target=worker) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert len(set([key for path, key, meta in results])) == 1
+        assert len([meta for path, key, meta in results
+                    if meta.get('cached') is True]) == 3
+
+
+class TestConvertDocs(object):
+
+    def test_convert_docs(self, workdir, monkeypatch):
+        # many docs are converted concurrently, failures reported inline
+        src_docs = []
+        for name in ('one.txt', 'two.txt', 'bad.txt', 'worse.txt'):
+            workdir.join('src').join(name).write('Hi from %s' % name)
+            src_docs.append(str(workdir / 'src' / name))
+
+        def fake_process_doc(src_doc, options):
+            if src_doc.endswith('bad.txt'):
+                raise ValueError('bad doc')
+            if src_doc.endswith('worse.txt'):
+                raise ValueError()
+            result_path = str(workdir.mkdtemp() / 'sample.pdf')
+            open(result_path, 'w').write('Fake result.')
+            return result_path, dict(error=False)
+
+        monkeypatch.setattr(client_module, '_process_doc', fake_process_doc)
+        results = dict([(src, (path, key, meta)) for src, path, key, meta in
+                        convert_docs(src_docs, {}, str(workdir / 'cache'))])
+        assert sorted(results) == sorted(src_docs)
+        assert results[src_docs[0]][1] != results[src_docs[1]][1]
+        assert results[src_docs[2]] == (
+            None, None, {'error': True, 'error-descr': 'bad doc'})
+        # exceptions without message are named by class
+        assert results[src_docs[3]] == (
+            None, None, {'error': True, 'error-descr': 'ValueError'})
+
+    def test_convert_docs_closed(self, workdir, monkeypatch):
+        # closing early cancels waiting jobs and waits for running ones
+        src_docs = []
+        for num in range(4):
+            workdir.join('src').join('%s.txt' % num).write('Hi %s' % num)
+            src_docs.append(str(workdir / 'src' / ('%s.txt' % num)))
+        started, results = [], []
+        running, go = threading.Event(), threading.Event()
+
+        def fake_process_doc(src_doc, options):
+            started.append(os.path.basename(src_doc))
+            if len(started) > 1:
+                running.set()
+                go.wait(10)
+            result_path = str(workdir.mkdtemp() / 'sample.pdf')
+            open(result_path, 'w').write('Fake result.')
+            results.append(result_path)
+            return result_path, dict(error=False)
+
+        monkeypatch.setattr(client_module, '_process_doc', fake_process_doc)
+        gen = convert_docs(src_docs, {}, None, workers=1)
+        assert next(gen)[1] == results[0]
+        assert running.wait(10)
+        threading.Timer(0.2, go.set).start()
+        gen.close()
+        assert started == ['0.txt', '1.txt']
+        # the result not delivered was removed
+        assert len(results) == 2
+        assert os.path.exists(results[0])
+        assert not os.path.exists(os.path.dirname(results[1]))
+
+
+class TestAdmissionControl(object):
+
+    def test_unlimited(self):
+        # by default all conversions are admitted
+        admission = AdmissionControl()
+        with admission.admitted():
+            with admission.admitted():
+                assert admission.running == 0
+
+    def test_overloaded(self):
+        # conversions beyond the limits are refused
+        admission = AdmissionControl('1')
+        with admission.admitted():
+            assert admission.running == 1
+            with pytest.raises(Overloaded) as err:
+                with admission.admitted():
+                    pass  # pragma: no cover
+        assert err.value.retry_after == admission.default_duration
+        assert admission.running == 0
+
+    def test_waiting(self):
+        # waiting conversions are admitted when slots become free
+        admission = AdmissionControl(1, max_waiting=1)
+        admitted = []
+
+        def convert():
+            with admission.admitted():
+                admitted.append(time.time())
+
+        with admission.admitted():
+            thread = threading.Thread(target=convert)
+            thread.start()
+            while admission.waiting == 0:
+                time.sleep(0.001)
+            with pytest.raises(Overloaded):
+                with admission.admitted():
+                    pass  # pragma: no cover
+            assert admitted == []
+        thread.join()
+        assert len(admitted) == 1
+
+    def test_retry_after(self):
+        # retry times are estimated from recent conversions
+        admission = AdmissionControl(2, max_waiting=2)
+        admission._durations.extend([3, 5])
+        assert admission.retry_after() == 2
+        admission.waiting = 2
+        assert admission.retry_after() == 6
+
+    def test_cache_hits_bypass(self, workdir, monkeypatch):
+        # cached docs are delivered even if no conversion is admitted
+        admission = AdmissionControl(1)
+        cm = CacheManager(str(workdir / 'cache'))
+        workdir.join('result.txt').write('Result')
+        src_doc = str(workdir / 'src' / 'sample.txt')
+        cm.register_doc(src_doc, str(workdir / 'result.txt'), get_marker({}))
+        with admission.admitted():
+            result_path, cache_key, metadata = convert_doc(
+                src_doc, {}, str(workdir / 'cache'), admission=admission)
+            assert metadata == dict(error=False, cached=True)
+            with pytest.raises(Overloaded):
+                convert_doc(
+                    src_doc, {'oocp-out-fmt': 'pdf'}, str(workdir / 'cache'),
+                    admission=admission)
+
 
 class ClientEnv(object):
     def __init__(self, workdir):
@@ -160,6 +375,95 @@ class TestClient(object):
         assert c_key == '396199333edbf40ad43e62a1c1397793_1_1'
 
 
+class TestClientRemote(object):
+    # tests for API Client talking to a RESTful converter
+
+    @pytest.fixture
+    def serve(self):
+        # a function serving RESTful converters with the given options
+        from wsgiref.simple_server import make_server, WSGIRequestHandler
+        from ulif.openoffice.wsgi import RESTfulDocConverter
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        servers = []
+
+        def serve(**kw):
+            app = RESTfulDocConverter(**kw)
+            server = make_server(
+                '127.0.0.1', 0, app, handler_class=QuietHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            servers.append(server)
+            return 'http://127.0.0.1:%s/' % server.server_port
+        yield serve
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    @pytest.fixture
+    def server_url(self, workdir, serve):
+        return serve(cache_dir=str(workdir / 'cache'))
+
+    def test_convert_cached(self, workdir, server_url, monkeypatch):
+        # docs cached on the server are not uploaded again
+        src_doc = str(workdir / 'src' / 'sample.txt')
+        workdir.join('result.pdf').write('Fake result.')
+        cm = CacheManager(str(workdir / 'cache'))
+        key = cm.register_doc(
+            src_doc, str(workdir / 'result.pdf'),
+            get_marker({'oocp-out-fmt': 'pdf'}))
+        monkeypatch.setattr(client_module, '_encode_multipart', None)
+        client = Client(url=server_url)
+        result_path, cache_key, metadata = client.convert(
+            src_doc, {'oocp-out-fmt': 'pdf'})
+        assert cache_key == key
+        assert metadata == {'error': False, 'cached': True}
+        assert result_path.endswith('/sample.pdf')
+        assert open(result_path).read() == 'Fake result.'
+
+    def test_convert_cached_other_algorithm(
+            self, workdir, serve, monkeypatch):
+        # we send the digests the server asks for
+        server_url = serve(
+            cache_dir=str(workdir / 'cache'), cache_hash_algorithm='sha1')
+        src_doc = str(workdir / 'src' / 'sample.txt')
+        workdir.join('result.pdf').write('Fake result.')
+        cm = CacheManager(str(workdir / 'cache'), hash_algorithm='sha1')
+        key = cm.register_doc(
+            src_doc, str(workdir / 'result.pdf'),
+            get_marker({'oocp-out-fmt': 'pdf'}))
+        monkeypatch.setattr(client_module, '_encode_multipart', None)
+        client = Client(url=server_url)
+        result_path, cache_key, metadata = client.convert(
+            src_doc, {'oocp-out-fmt': 'pdf'})
+        assert cache_key == key
+        assert metadata == {'error': False, 'cached': True}
+        assert client.digest_algorithms == ('sha1', 'sha256')
+
+    def test_encode_multipart(self, workdir):
+        # documents are read while sent, filenames are escaped
+        workdir.join('doc.txt').write_binary(b'x' * 100000)
+        with open(str(workdir / 'doc.txt'), 'rb') as fd:
+            content_type, body = _encode_multipart(
+                [('a', 'b')], 'my "doc"\r\n.txt', fd)
+            assert fd.tell() == 0
+            data = b''
+            chunk = body.read(8192)
+            while chunk:
+                assert len(chunk) <= 8192
+                data += chunk
+                chunk = body.read(8192)
+        boundary = content_type.split('boundary=')[1]
+        assert len(data) == len(body)
+        assert data.endswith(
+            b'x' * 100000 + ('\r\n--%s--\r\n' % boundary).encode())
+        assert b'filename="my %22doc%22%0D%0A.txt"' in data
+
+
 class TestClientMain(object):
     # tests for the client modules `main` function
 
@@ -2,11 +2,41 @@
 import os
 import pytest
 import shutil
-from ulif.openoffice.convert import convert, exec_cmd
+import socket
+import subprocess
+import sys
+import threading
+import time
+from ulif.openoffice.convert import (
+    convert, exec_cmd, get_listener_pool, ListenerPool, DEFAULT_URL,
+    UnoconvBackend, WorkerBackend)
 
 pytestmark = pytest.mark.converter
 
 
+@pytest.fixture(scope="function")
+def fake_worker(request, tmpdir):
+    """Start a fake conversion worker.
+
+    Returns the path of the socket the worker listens on.
+    """
+    socket_path = str(tmpdir / 'worker.sock')
+    script = os.path.join(os.path.dirname(__file__), 'fake_worker')
+    proc = subprocess.Popen([sys.executable, script, socket_path])
+    request.addfinalizer(proc.kill)
+    for x in range(100):
+        # the socket file exists before the worker accepts connections
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+            break
+        except (IOError, OSError):
+            time.sleep(0.05)
+        finally:
+            sock.close()
+    return socket_path
+
+
 class TestConvert(object):
 
     def test_convert_no_path(self, lo_server):
@@ -78,3 +108,133 @@ class TestConvert(object):
         assert (
             '<DIV TYPE=HEADER>' in content) or (
             '<div title="header"' in content)
+
+
+class TestListenerPool(object):
+
+    def test_default(self):
+        # by default we get a single listener at default url
+        pool = ListenerPool()
+        assert len(pool) == 1
+        assert pool.listeners[0].url == DEFAULT_URL
+
+    def test_acquire_release(self):
+        # acquired listeners are locked until released
+        pool = ListenerPool(['url1', 'url2'])
+        listener1 = pool.acquire()
+        listener2 = pool.acquire()
+        assert listener1 is not listener2
+        assert listener1.lock.locked() and listener2.lock.locked()
+        pool.release(listener1)
+        assert not listener1.lock.locked()
+        assert listener1.served == 1
+
+    def test_least_busy_preferred(self):
+        # listeners that spent less time converting are picked first
+        pool = ListenerPool(['url1', 'url2'])
+        pool.listeners[0].busy_time = 3.0
+        with pool.listener() as listener:
+            assert listener.url == 'url2'
+
+    def test_queueing(self):
+        # if all listeners are busy, callers wait
+        pool = ListenerPool(['url1'])
+        listener = pool.acquire()
+        result = []
+
+        def worker():
+            with pool.listener() as other:
+                result.append(other)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join(0.2)
+        assert result == []
+        assert pool.waiting == 1
+        pool.release(listener)
+        thread.join()
+        assert result == [listener]
+        assert pool.waiting == 0
+
+    def test_get_listener_pool(self):
+        # pools are shared for equal sets of urls
+        pool1 = get_listener_pool(['url1', 'url2'])
+        pool2 = get_listener_pool(['url2', 'url1'])
+        pool3 = get_listener_pool(['url1'])
+        assert pool1 is pool2
+        assert pool1 is not pool3
+        assert get_listener_pool() is get_listener_pool([DEFAULT_URL])
+
+    def test_get_listener_pool_shared_listeners(self):
+        # overlapping pools share listeners and their locks
+        pool1 = get_listener_pool(['url3', 'url4'])
+        pool2 = get_listener_pool(['url3'])
+        assert pool2.listeners[0] in pool1.listeners
+        listener = pool2.acquire()
+        result = []
+
+        def worker():
+            # url4 is free, url3 is busy
+            with pool1.listener() as other1:
+                with pool1.listener() as other2:
+                    result.append((other1, other2))
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join(0.2)
+        assert result == []
+        # releasing in one pool wakes up waiters of the other
+        pool2.release(listener)
+        thread.join()
+        assert listener in result[0]
+
+
+class TestBackends(object):
+
+    def test_unoconv_backend_fail(self, tmpdir):
+        # unoconv backends report the status of unoconv
+        backend = UnoconvBackend('%s %s' % (
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), 'fake_unoconv')))
+        status, output = backend.convert(
+            DEFAULT_URL, 'pdf', 'some-path', str(tmpdir))
+        assert status == 1
+
+    def test_worker_backend(self, fake_worker, tmpdir):
+        # we can convert docs with a worker
+        path = tmpdir.join('sample.txt')
+        path.write('Hi there!\n')
+        status, result_dir = convert(
+            url='url1', out_format='pdf', path=str(path),
+            backend=WorkerBackend(fake_worker))
+        assert status == 0
+        assert os.listdir(result_dir) == ['sample.pdf']
+        with open(os.path.join(result_dir, 'sample.pdf')) as fd:
+            assert fd.read() == 'converted by fake worker via url1'
+        shutil.rmtree(result_dir)
+
+    def test_worker_backend_reused(self, fake_worker, tmpdir):
+        # the same worker serves several jobs
+        path = tmpdir.join('sample.txt')
+        path.write('Hi there!\n')
+        backend = WorkerBackend(fake_worker)
+        for fmt in ('pdf', 'html'):
+            status, output = backend.convert(
+                'url1', fmt, str(path), str(tmpdir))
+            assert status == 0
+        assert sorted(os.listdir(str(tmpdir))) == [
+            'sample.html', 'sample.pdf', 'sample.txt', 'worker.sock']
+
+    def test_worker_backend_fail(self, fake_worker, tmpdir):
+        # failed conversions are reported with status != 0
+        status, output = WorkerBackend(fake_worker).convert(
+            'url1', 'pdf', 'NoT-An-ExIsTiNg-PaTH', str(tmpdir))
+        assert status == 1
+        assert output.startswith('no such file')
+
+    def test_worker_backend_no_worker(self, tmpdir):
+        # unreachable workers result in status != 0
+        status, output = WorkerBackend(str(tmpdir / 'not-a-sock')).convert(
+            'url1', 'pdf', 'some-path', str(tmpdir))
+        assert status == 1
+        assert output.startswith('cannot contact worker')
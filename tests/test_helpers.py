@@ -18,20 +18,26 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 #
 from __future__ import unicode_literals
+import logging
 import os
 import pytest
 import shutil
 import stat
+import subprocess
+import sys
+import threading
 import zipfile
 from io import StringIO, BytesIO
 from six import text_type
 from ulif.openoffice.processor import OOConvProcessor
 from ulif.openoffice.helpers import (
-    copytree, copy_to_secure_location, get_entry_points, unzip, zip,
-    remove_file_dir, extract_css, cleanup_html, cleanup_css,
+    copytree, copy_to_secure_location, move_to_secure_location,
+    get_entry_points, unzip, zip,
+    remove_file_dir, extract_css, cleanup_html, cleanup_css, cleanup_html_css,
     rename_html_img_links, rename_sdfield_tags, base64url_encode,
     base64url_decode, string_to_bool, strict_string_to_bool,
-    string_to_stringtuple, filelike_cmp, write_filelike)
+    string_to_stringtuple, string_to_listeners, string_to_bytes,
+    filelike_cmp, write_filelike)
 from ulif.openoffice.helpers import basestring as basestring_modified
 
 
@@ -275,6 +281,52 @@ class TestExtractCSS(object):
         assert result == "<span>text<span>no</span>gap</span>"
 
 
+class TestCleanupHTMLCSS(object):
+    # tests for cleanup_html_css()
+
+    def test_same_as_separate_steps(self, samples_dir):
+        # we get the same results as with cleanup_html and extract_css
+        for name in ['sample1.html', 'sample2.html', 'sample3.html',
+                     'image_sample.html']:
+            html_input = samples_dir.join(name).read_text('utf-8')
+            html1, img_map1 = cleanup_html(html_input, 'sample.html')
+            html1, css1 = extract_css(html1, 'sample.html')
+            html2, css2, img_map2 = cleanup_html_css(
+                html_input, 'sample.html')
+            assert html1 == html2
+            assert css1 == css2
+            assert img_map1 == img_map2
+
+    def test_options_respected(self, samples_dir):
+        # we can switch off single fixes
+        html_input = '<h1>1.1Heading</h1><sdfield>8</sdfield><img src="a.gif">'
+        html1, img_map1 = cleanup_html(
+            html_input, 'sample.html', fix_head_nums=False,
+            fix_img_links=False, fix_sdfields=False)
+        html1, css1 = extract_css(html1, 'sample.html')
+        html2, css2, img_map2 = cleanup_html_css(
+            html_input, 'sample.html', fix_head_nums=False,
+            fix_img_links=False, fix_sdfields=False)
+        assert html1 == html2
+        assert img_map2 == {}
+
+    def test_fixes_applied(self):
+        # all fixes are applied on the same tree
+        html_input = (
+            '<html><head><style>p {color: red}</style></head><body>'
+            '<h1>1.1Heading</h1><p><sdfield type="PAGE">8</sdfield></p>'
+            '<img src="foo.gif"></body></html>')
+        html, css, img_map = cleanup_html_css(html_input, 'sample.html')
+        if isinstance(html, bytes):
+            html = html.decode('utf-8')
+        assert '<span class="u-o-headnum">1.1</span>Heading' in html
+        assert '<span class="sdfield" type="PAGE">8</span>' in html
+        assert '<link href="sample.css"' in html
+        assert '<img src="sample_1.gif"/>' in html
+        assert 'color: red' in css
+        assert img_map == {'foo.gif': 'sample_1.gif'}
+
+
 class TestCleanupHTML(object):
     # tests for cleanup_html().
 
@@ -418,6 +470,51 @@ class TestCleanupCSS(object):
         result, errors = cleanup_css(css_input, minified=False)
         assert result == 'p {\n    foo: baz;\n    bar: baz\n    }'
 
+    def test_cleanup_css_no_global_changes(self):
+        # we do not leave handlers or settings behind
+        import cssutils
+        root_handlers = list(logging.getLogger().handlers)
+        old_ser = cssutils.ser
+        old_prefs = dict(vars(cssutils.ser.prefs))
+        for x in range(3):
+            cleanup_css('p { foo: baz; }')
+        assert logging.getLogger().handlers == root_handlers
+        assert cssutils.ser is old_ser
+        assert vars(cssutils.ser.prefs) == old_prefs
+        # cssutils logs to its default logger again
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        cssutils_logger = logging.getLogger('CSSUTILS')
+        cssutils_logger.addHandler(handler)
+        try:
+            cssutils.parseString('p { foo: baz; }')
+        finally:
+            cssutils_logger.removeHandler(handler)
+        assert len(records) == 1
+
+    def test_cleanup_css_threads(self):
+        # we can clean CSS from several threads at once
+        css_input = 'p { foo: baz ; bar: baz}'
+        results = []
+
+        def clean(minified):
+            for x in range(20):
+                results.append(
+                    (minified, cleanup_css(css_input, minified=minified)))
+        threads = [threading.Thread(target=clean, args=(x % 2 == 0, ))
+                   for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 80
+        for minified, (result, errors) in results:
+            assert result == {
+                True: 'p{foo:baz;bar:baz}',
+                False: 'p {\n    foo: baz;\n    bar: baz\n    }'}[minified]
+            assert errors.count('WARNING') == 2
+
 
 class TestRenameHTMLImgLinks(object):
     # tests for renam_html_img_links() helper.
@@ -560,11 +657,49 @@ class TestHelpers(object):
         result_path = copy_to_secure_location(str(workdir / "src"))
         assert os.path.isfile(os.path.join(result_path, 'sample.txt'))
 
+    def test_move_to_secure_location_file(self, workdir):
+        # we can move the dir of files to a secure location.
+        workdir.join("src").join("sample.txt").write("Hey there!")
+        result_path = move_to_secure_location(
+            str(workdir / "src" / "sample.txt"))
+        assert os.path.isfile(os.path.join(result_path, "sample.txt"))
+        assert not workdir.join("src").exists()
+
+    def test_move_to_secure_location_path(self, workdir):
+        # we can move dirs to a secure location
+        workdir.join("src").join("sample.txt").write("Hey there!")
+        result_path = move_to_secure_location(str(workdir / "src"))
+        assert os.path.isfile(os.path.join(result_path, 'sample.txt'))
+        assert not workdir.join("src").exists()
+
+    def test_move_to_secure_location_no_rename(self, workdir, monkeypatch):
+        # if renaming fails, we copy and remove the original
+        def failing_rename(src, dst):
+            raise OSError('Invalid cross-device link')
+        monkeypatch.setattr(os, 'rename', failing_rename)
+        workdir.join("src").join("sample.txt").write("Hey there!")
+        result_path = move_to_secure_location(str(workdir / "src"))
+        assert os.path.isfile(os.path.join(result_path, 'sample.txt'))
+        assert not workdir.join("src").exists()
+
     def test_get_entry_points(self):
         # get_entry_points really delivers our processors (maybe more)
         result = get_entry_points('ulif.openoffice.processors')
         assert result['oocp'] is OOConvProcessor
 
+    def test_import_defers_heavy_deps(self):
+        # importing our modules does not pull in cssutils, bs4, etc.
+        # This is checked in a fresh interpreter, as other tests
+        # already imported everything.
+        code = (
+            'import sys\n'
+            'import ulif.openoffice.client, ulif.openoffice.wsgi\n'
+            'import ulif.openoffice.xmlrpc\n'
+            'print(" ".join(sorted(x for x in ("cssutils", "bs4", '
+            '"pkg_resources") if x in sys.modules)))\n')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        assert output.decode('utf-8').strip() == ''
+
     def test_unzip(self, tmpdir):
         # make sure we can unzip filetrees
         zip_file = str(tmpdir / "sample.zip")
@@ -651,6 +786,29 @@ class TestHelpers(object):
         with pytest.raises(ValueError):
             string_to_stringtuple(None, strict=True)
 
+    def test_string_to_listeners(self):
+        assert string_to_listeners('foo:1') == (('foo', 1), )
+        assert string_to_listeners('foo:1, bar:2') == (
+            ('foo', 1), ('bar', 2))
+        assert string_to_listeners('foo') == (('foo', 2002), )
+        assert string_to_listeners('') == ()
+        assert string_to_listeners(None) == ()
+        with pytest.raises(ValueError):
+            string_to_listeners('foo:bar')
+        with pytest.raises(ValueError):
+            string_to_listeners(':2002')
+
+    def test_string_to_bytes(self):
+        assert string_to_bytes('100') == 100
+        assert string_to_bytes('2k') == 2048
+        assert string_to_bytes(' 3 M') == 3 * 1024 ** 2
+        assert string_to_bytes('1G') == 1024 ** 3
+        assert string_to_bytes(42) == 42
+        assert string_to_bytes('') is None
+        assert string_to_bytes(None) is None
+        with pytest.raises(ValueError):
+            string_to_bytes('1T')
+
     def test_write_filelike(self, tmpdir):
         src = tmpdir / "f1"
         src.write('content')
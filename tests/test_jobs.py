@@ -0,0 +1,107 @@
+# tests for jobs module
+import json
+import os
+import pytest
+import tempfile
+import time
+from ulif.openoffice import client as client_module
+from ulif.openoffice.jobs import JobQueue, DONE, FAILED, QUEUED, RUNNING
+
+
+def fake_process_doc(src_doc, options):
+    # 'convert' docs without LibreOffice
+    result_path = os.path.join(tempfile.mkdtemp(), 'sample.pdf')
+    with open(result_path, 'w') as fd:
+        fd.write('Fake result.')
+    if options.get('fail'):
+        return None, dict(error=True, **{'error-descr': 'bad doc'})
+    return result_path, dict(error=False)
+
+
+@pytest.fixture
+def job_env(workdir, monkeypatch):
+    monkeypatch.setattr(client_module, '_process_doc', fake_process_doc)
+    return workdir
+
+
+def wait_for(queue, job_id, states=(DONE, FAILED)):
+    for x in range(200):
+        job = queue.get(job_id)
+        if job['state'] in states:
+            return job
+        time.sleep(0.01)
+    raise AssertionError('job not finished: %s' % job)  # pragma: no cover
+
+
+class TestJobQueue(object):
+
+    def test_create(self, job_env):
+        # job dirs are created if they do not exist
+        queue = JobQueue(str(job_env / 'jobs'), str(job_env / 'cache'))
+        assert os.path.isdir(str(job_env / 'jobs'))
+        queue.stop()
+
+    def test_submit(self, job_env):
+        # submitted jobs are run in background
+        queue = JobQueue(str(job_env / 'jobs'), str(job_env / 'cache'))
+        src_path = str(job_env / 'src' / 'sample.txt')
+        job_id = queue.submit(src_path, {'oocp-out-fmt': 'pdf'})
+        assert not os.path.exists(src_path)
+        job = wait_for(queue, job_id)
+        queue.stop()
+        assert job['state'] == DONE
+        assert job['cache_key'] == '396199333edbf40ad43e62a1c1397793_1_1'
+        assert job['finished'] >= job['started'] >= job['created']
+        # sources are removed when done
+        assert os.listdir(str(job_env / 'jobs' / job_id)) == ['job.json']
+
+    def test_submit_failing(self, job_env):
+        # failed conversions result in failed jobs
+        queue = JobQueue(str(job_env / 'jobs'), str(job_env / 'cache'))
+        job_id = queue.submit(
+            str(job_env / 'src' / 'sample.txt'), {'fail': 'yes'})
+        job = wait_for(queue, job_id)
+        queue.stop()
+        assert job['state'] == FAILED
+        assert job['error'] == 'bad doc'
+
+    def test_get_invalid(self, job_env):
+        # we cope with invalid or unknown job ids
+        queue = JobQueue(str(job_env / 'jobs'), str(job_env / 'cache'))
+        queue.stop()
+        assert queue.get('../../etc') is None
+        assert queue.get('0' * 32) is None
+
+    def test_recover(self, job_env):
+        # unfinished jobs are run by the next queue
+        job_dir = str(job_env / 'jobs')
+        queue = JobQueue(job_dir, str(job_env / 'cache'), workers=0)
+        job_id = queue.submit(str(job_env / 'src' / 'sample.txt'), {})
+        job = queue.get(job_id)
+        job['state'] = RUNNING  # crashed while running
+        with open(os.path.join(job_dir, job_id, 'job.json'), 'w') as fd:
+            json.dump(job, fd)
+        queue = JobQueue(job_dir, str(job_env / 'cache'))
+        assert wait_for(queue, job_id)['state'] == DONE
+        queue.stop()
+
+    def test_stop(self, job_env):
+        # jobs still queued when stopping, are kept queued
+        queue = JobQueue(str(job_env / 'jobs'), str(job_env / 'cache'))
+        queue.stop()
+        job_id = queue.submit(str(job_env / 'src' / 'sample.txt'), {})
+        time.sleep(0.05)
+        assert queue.get(job_id)['state'] == QUEUED
+
+    def test_purge(self, job_env):
+        # old finished jobs are removed
+        queue = JobQueue(
+            str(job_env / 'jobs'), str(job_env / 'cache'), max_age=0)
+        job_id = queue.submit(str(job_env / 'src' / 'sample.txt'), {})
+        wait_for(queue, job_id)
+        queue.stop()
+        queue.purge()  # too early
+        assert queue.get(job_id) is not None
+        queue._last_purge = 0
+        queue.purge()
+        assert queue.get(job_id) is None
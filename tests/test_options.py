@@ -1,10 +1,12 @@
 # tests for options module
 import argparse
 import pytest
+import threading
+from ulif.openoffice import options as options_module
 from ulif.openoffice.helpers import string_to_stringtuple
 from ulif.openoffice.options import (
-    dict_to_argtuple, Argument, ArgumentParserError,
-    ExceptionalArgumentParser, Options, )
+    canonical_options, dict_to_argtuple, Argument, ArgumentParserError,
+    ExceptionalArgumentParser, Options, ProcessorRegistry, registry)
 from ulif.openoffice.processor import DEFAULT_PROCORDER
 
 
@@ -40,6 +42,28 @@ class TestArgument(object):
         with pytest.raises(ValueError):
             Argument('-myproc-opt1', '-myproc-option1')
 
+    def test_dest(self):
+        # we can get the keys of arguments in options
+        assert Argument('-my-opt', '--my-option').dest == 'my_option'
+        assert Argument('-my-opt').dest == 'my_opt'
+
+    def test_affects_output(self):
+        # arguments affect output by default
+        assert Argument('-my-opt').affects_output is True
+        arg = Argument('-my-opt', affects_output=False, default=1)
+        assert arg.affects_output is False
+        assert arg.keywords == dict(default=1)
+
+    def test_convert(self):
+        # we can convert values like argparse does
+        arg = Argument('-my-opt', type=int, choices=[1, 2])
+        assert arg.convert('2') == 2
+        with pytest.raises(ArgumentParserError):
+            arg.convert('foo')
+        with pytest.raises(ArgumentParserError):
+            arg.convert('3')
+        assert Argument('-my-opt').convert('foo') == 'foo'
+
     def test_default_string(self):
         # we can get the defaults as string
         assert Argument(  # ints
@@ -76,8 +100,8 @@ class TestOptions(object):
         opts = Options()
         avail_procs = opts.avail_procs
         core_procs = [
-            'css_cleaner', 'error', 'html_cleaner', 'meta', 'oocp', 'tidy',
-            'unzip', 'zip',
+            'css_cleaner', 'error', 'html_cleaner', 'html_css_cleaner',
+            'meta', 'oocp', 'tidy', 'unzip', 'zip',
             ]
         for name in core_procs:
             assert name in avail_procs
@@ -140,5 +164,107 @@ class TestOptions(object):
             'css-cleaner-min', 'css-cleaner-prettify',
             'html-cleaner-fix-head-nums', 'html-cleaner-fix-img-links',
             'html-cleaner-fix-sd-fields', 'meta-procord',
-            'oocp-host', 'oocp-out-fmt', 'oocp-pdf-tagged',
-            'oocp-pdf-version', 'oocp-port']
+            'oocp-host', 'oocp-listeners', 'oocp-out-fmt', 'oocp-pdf-tagged',
+            'oocp-pdf-version', 'oocp-port', 'oocp-worker']
+
+
+class TestProcessorRegistry(object):
+
+    def test_built_once(self, monkeypatch):
+        # entry points are looked up once only
+        calls = []
+        orig_get_entry_points = options_module.get_entry_points
+
+        def fake_get_entry_points(group):
+            calls.append(group)
+            return orig_get_entry_points(group)
+
+        monkeypatch.setattr(
+            options_module, 'get_entry_points', fake_get_entry_points)
+        reg = ProcessorRegistry()
+        assert 'oocp' in reg.processors
+        assert reg.defaults['oocp_output_format'] == 'html'
+        assert reg.arguments['oocp-out-fmt'].dest == 'oocp_output_format'
+        assert calls == ['ulif.openoffice.processors']
+        reg.invalidate()
+        assert 'oocp' in reg.processors
+        assert len(calls) == 2
+
+    def test_shared(self):
+        # the registry is shared, changes of results do not harm
+        registry.defaults['oocp_output_format'] = 'pdf'
+        assert Options()['oocp_output_format'] == 'html'
+
+    def test_parse(self):
+        # we can parse dicts of string values
+        assert registry.parse({'oocp-pdf-tagged': 'yes', 'foo': 'bar'}) == {
+            'oocp_pdf_tagged': True}
+        with pytest.raises(ArgumentParserError):
+            registry.parse({'oocp-pdf-tagged': 'maybe'})
+        # misspelled options are not ignored
+        with pytest.raises(ArgumentParserError):
+            registry.parse({'oocp_out_fmt': 'pdf'})
+
+    def test_parse_long_names(self):
+        # long names and unique prefixes are accepted like by argparse
+        assert registry.parse({'-oocp-output-format': 'pdf'}) == {
+            'oocp_output_format': 'pdf'}
+        assert registry.parse({'oocp-out': 'pdf'}) == {
+            'oocp_output_format': 'pdf'}
+        assert registry.parse({'-oocp-output': 'pdf'}) == {
+            'oocp_output_format': 'pdf'}
+        assert Options(string_dict={'-oocp-output-format': 'pdf'})[
+            'oocp_output_format'] == 'pdf'
+        with pytest.raises(ArgumentParserError):
+            registry.parse({'oocp-p': '2003'})  # ambiguous
+        with pytest.raises(ArgumentParserError):
+            registry.parse({'oocp_output_format': 'pdf'})
+
+    def test_reentrant(self, monkeypatch):
+        # argument types can use the registry
+        reg = ProcessorRegistry()
+
+        def proc_names(string):
+            return [x for x in string.split(',') if x in reg.processors]
+
+        class FakeProcessor(object):
+            args = [Argument('-fake-procs', '--fake-processors',
+                             default='fake,other', type=proc_names)]
+
+        monkeypatch.setattr(
+            options_module, 'get_entry_points',
+            lambda group: {'fake': FakeProcessor})
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(reg.defaults))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        assert result == [{'fake_processors': ['fake']}]
+
+
+class TestCanonicalOptions(object):
+
+    def test_defaults(self):
+        # we get all output-affecting options with their defaults
+        result = dict(canonical_options({}))
+        assert result['meta_processor_order'] == DEFAULT_PROCORDER
+        assert result['oocp_output_format'] == 'html'
+        assert 'oocp_hostname' not in result
+        assert 'oocp_port' not in result
+
+    def test_normalized(self):
+        # equivalent option sets give equal results
+        assert canonical_options(
+            {'oocp-pdf-tagged': 'yes', 'meta-procord': 'unzip, oocp'}) == (
+            canonical_options(Options(val_dict={
+                'oocp_pdf_tagged': 'true',
+                'meta_processor_order': ['unzip', 'oocp'],
+                'oocp_port': 2003})))
+
+    def test_invalid(self):
+        # invalid values are not accepted
+        with pytest.raises(ArgumentParserError):
+            canonical_options({'oocp-out-fmt': 'invalid'})
+        with pytest.raises(ArgumentParserError):
+            canonical_options(Options(val_dict={'oocp_pdf_tagged': 'maybe'}))
@@ -30,7 +30,8 @@ from argparse import ArgumentParser
 from ulif.openoffice.options import ArgumentParserError, Options
 from ulif.openoffice.processor import (
     BaseProcessor, MetaProcessor, OOConvProcessor, UnzipProcessor,
-    ZipProcessor, Tidy, CSSCleaner, HTMLCleaner, Error, processor_order)
+    ZipProcessor, Tidy, CSSCleaner, HTMLCleaner, HTMLCSSCleaner, Error,
+    processor_order)
 from ulif.openoffice.testing import (
     TestOOServerSetup, ConvertLogCatcher, envpath_wo_virtualenvs)
 
@@ -119,10 +120,12 @@ class TestMetaProcessor(object):
             "meta_processor_order=('unzip', 'oocp', 'tidy', 'html_cleaner', "
             "'css_cleaner', 'zip')"
             "oocp_hostname=localhost"
+            "oocp_listeners=None"
             "oocp_output_format=html"
             "oocp_pdf_tagged=False"
             "oocp_pdf_version=False"
             "oocp_port=2002"
+            "oocp_worker_socket=None"
         )
 
     def test_options_invalid(self):
@@ -432,18 +435,24 @@ class TestOOConvProcessor(TestOOServerSetup):
                           'oocp_pdf_tagged': False,
                           'oocp_hostname': 'localhost',
                           'oocp_port': 2002,
+                          'oocp_listeners': None,
+                          'oocp_worker_socket': None,
                           }
         # explicitly set value (different from default)
         result = vars(parser.parse_args(['-oocp-out-fmt', 'pdf',
                                          '-oocp-pdf-version', '1',
                                          '-oocp-pdf-tagged', '1',
                                          '-oocp-host', 'example.com',
-                                         '-oocp-port', '1234', ]))
+                                         '-oocp-port', '1234',
+                                         '-oocp-listeners', 'a:1,b:2',
+                                         '-oocp-worker', '/tmp/sock', ]))
         assert result == {'oocp_output_format': 'pdf',
                           'oocp_pdf_version': True,
                           'oocp_pdf_tagged': True,
                           'oocp_hostname': 'example.com',
-                          'oocp_port': 1234}
+                          'oocp_port': 1234,
+                          'oocp_listeners': (('a', 1), ('b', 2)),
+                          'oocp_worker_socket': '/tmp/sock'}
 
 
 class TestUnzipProcessor(object):
@@ -896,6 +905,49 @@ class TestHTMLCleanerProcessor(object):
             'html_cleaner_fix_sd_fields': False}
 
 
+class TestHTMLCSSCleanerProcessor(object):
+
+    def test_cleaner(self, workdir, samples_dir):
+        # we get the same result as with html_cleaner and css_cleaner
+        samples_dir.join("image_sample.html").copy(
+            workdir / "src" / "sample.html")
+        samples_dir.join("image_sample_html_m20918026.gif").copy(
+            workdir / "src" / "image_sample_html_m20918026.gif")
+        proc = HTMLCSSCleaner()
+        resultpath, metadata = proc.process(
+            str(workdir / "src" / "sample.html"), {'error': False})
+        contents = codecs.open(resultpath, 'r', 'utf-8').read()
+        list_dir = os.listdir(os.path.dirname(resultpath))
+        assert 'sample.css' in list_dir
+        assert 'sample_1.gif' in list_dir
+        assert 'image_sample_html_m20918026.gif' not in list_dir
+        assert 'href="sample.css"' in contents
+        assert 'src="sample_1.gif"' in contents
+
+    def test_options_respected(self, workdir, samples_dir):
+        # we respect options of html_cleaner and css_cleaner
+        samples_dir.join("sample3.html").copy(workdir / "src" / "sample.html")
+        proc = HTMLCSSCleaner(
+            options={'html-cleaner-fix-head-nums': 'no',
+                     'css-cleaner-min': 'no'})
+        resultpath, metadata = proc.process(
+            str(workdir / "src" / "sample.html"), {'error': False})
+        contents = codecs.open(resultpath, 'r', 'utf-8').read()
+        assert 'u-o-headnum' not in contents
+
+    def test_non_html_ignored(self, workdir):
+        # Non .html/.xhtml files are ignored
+        proc = HTMLCSSCleaner()
+        sample_path = workdir / "src" / "sample.txt"
+        resultpath, metadata = proc.process(
+            str(sample_path), {'error': False})
+        assert resultpath == str(sample_path)
+
+    def test_args(self):
+        # this processor has no options of its own
+        assert HTMLCSSCleaner.args == []
+
+
 class TestErrorProcessor(object):
 
     def test_error(self):
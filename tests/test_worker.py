@@ -0,0 +1,37 @@
+# tests for the worker module
+import os
+import pytest
+import stat
+from ulif.openoffice.worker import (
+    get_default_socket_path, main, WorkerServer)
+
+
+class TestWorker(object):
+
+    def test_default_socket_path(self, monkeypatch, tmpdir):
+        # we do not put sockets into world-writable dirs by default
+        monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmpdir))
+        assert get_default_socket_path() == str(tmpdir / 'oooworker.sock')
+        monkeypatch.delenv('XDG_RUNTIME_DIR')
+        monkeypatch.setenv('HOME', str(tmpdir))
+        assert get_default_socket_path() == str(tmpdir / '.oooworker.sock')
+
+    def test_socket_permissions(self, tmpdir):
+        # only the owner can talk to the worker
+        socket_path = str(tmpdir / 'worker.sock')
+        server = WorkerServer(socket_path, converter=lambda **kw: (0, ''))
+        try:
+            mode = os.stat(socket_path).st_mode
+            assert stat.S_ISSOCK(mode)
+            assert stat.S_IMODE(mode) == 0o600
+        finally:
+            server.server_close()
+
+    def test_main_no_socket(self, tmpdir, capsys):
+        # we do not remove files other than sockets
+        path = tmpdir / 'some.file'
+        path.write('Hi there!')
+        with pytest.raises(SystemExit):
+            main(['--socket', str(path)])
+        assert 'not a socket' in capsys.readouterr()[1]
+        assert path.exists()
@@ -17,14 +17,22 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 #
+import hashlib
+import json
+import os
 import pytest
+import time
+from io import BytesIO
 import zipfile
 from paste.deploy import loadapp
 from webob import Request
-from ulif.openoffice.cachemanager import get_marker
+from webob.multidict import MultiDict
+from ulif.openoffice.cachemanager import (
+    get_digest_key, get_file_digest, get_file_digests, get_marker)
 from ulif.openoffice.wsgi import (
-    RESTfulDocConverter, FileIterator, FileIterable, get_mimetype
-    )
+    MultipartReader, RESTfulDocConverter, FileIterator, FileIterable,
+    UploadTooLarge, get_header_params, get_mimetype, is_not_modified,
+    get_upload_filename, make_response, parse_cache_control)
 
 pytestmark = pytest.mark.wsgi
 
@@ -126,6 +134,148 @@ class TestFileIterable(object):
         assert [b'67'] == list(fi.app_iter_range(6, 8))
 
 
+class FakeFileWrapper(object):
+    # a `wsgi.file_wrapper` as provided by WSGI servers
+    def __init__(self, fileobj, block_size):
+        self.fileobj = fileobj
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.fileobj.read(self.block_size), b'')
+
+    def close(self):
+        self.fileobj.close()
+
+
+class TestMakeResponse(object):
+
+    def test_no_request(self, iter_path):
+        # w/o request we deliver files in chunks
+        resp = make_response(iter_path, chunk_size=4)
+        assert isinstance(resp.app_iter, FileIterable)
+        assert list(resp.app_iter) == [b'0123', b'4567', b'89']
+        assert resp.content_length == 10
+
+    def test_file_wrapper(self, iter_path):
+        # if the server provides a file wrapper, we use it
+        req = Request.blank('http://localhost/docs/foo', environ={
+            'wsgi.file_wrapper': FakeFileWrapper})
+        resp = make_response(iter_path, req)
+        assert isinstance(resp.app_iter, FakeFileWrapper)
+        assert resp.app_iter.block_size == 65536
+        resp = req.get_response(make_response(iter_path, req, 4))
+        assert resp.body == b'0123456789'
+
+    def test_file_wrapper_range(self, iter_path):
+        # ranges are served by file iterables
+        req = Request.blank('http://localhost/docs/foo', environ={
+            'wsgi.file_wrapper': FakeFileWrapper}, range=(2, 5))
+        resp = make_response(iter_path, req)
+        assert isinstance(resp.app_iter, FileIterable)
+        resp = req.get_response(resp)
+        assert resp.status == '206 Partial Content'
+        assert resp.body == b'234'
+
+
+def multipart_request(**fields):
+    # get a request with a multipart/form-data body
+    return Request.blank('http://localhost/docs', POST=fields)
+
+
+class TestMultipartReader(object):
+
+    def get_reader(self, req, **kw):
+        boundary = get_header_params(req.headers['Content-Type'])['boundary']
+        return MultipartReader(
+            req.body_file_raw, boundary, req.content_length, **kw)
+
+    @pytest.mark.parametrize("chunk_size", [1, 7, 65536])
+    def test_read(self, chunk_size):
+        # we can read parts, whatever the chunk size
+        req = multipart_request(
+            doc=('sample.txt', b'Hi\r\n--there!' * 100), foo='bar')
+        reader = self.get_reader(req, chunk_size=chunk_size)
+        parts = []
+        while True:
+            headers = reader.next_part()
+            if headers is None:
+                break
+            parts.append((get_header_params(
+                headers['content-disposition'])['name'],
+                b''.join(iter(lambda: reader.read(5), b''))))
+        assert sorted(parts) == [
+            ('doc', b'Hi\r\n--there!' * 100), ('foo', b'bar')]
+
+    def test_skip_unread_parts(self):
+        # unread parts are skipped
+        req = multipart_request(doc=('sample.txt', b'x' * 1000), foo='bar')
+        reader = self.get_reader(req, chunk_size=10)
+        names = []
+        while True:
+            headers = reader.next_part()
+            if headers is None:
+                break
+            names.append(headers['content-disposition'])
+        assert len(names) == 2
+
+    def test_max_size(self):
+        # too large bodies are detected early
+        req = multipart_request(doc=('sample.txt', b'x' * 100000))
+        reader = self.get_reader(req, max_size=1000, chunk_size=100)
+        reader.next_part()
+        with pytest.raises(UploadTooLarge):
+            reader.read()
+        assert reader.received <= 1100
+
+    def test_malformed(self):
+        # malformed bodies are rejected
+        reader = MultipartReader(BytesIO(b'Hi there!'), 'xyz', 9)
+        with pytest.raises(ValueError):
+            reader.next_part()
+
+    def test_get_header_params(self):
+        # we can parse parameters of headers
+        assert get_header_params(
+            'form-data; name="doc"; filename="a; b.txt"') == {
+                'name': 'doc', 'filename': 'a; b.txt'}
+        assert get_header_params(
+            'multipart/form-data; boundary=xyz') == {'boundary': 'xyz'}
+
+    def test_get_upload_filename(self):
+        # we get filenames safe to store uploads
+        assert get_upload_filename('a.txt') == 'a.txt'
+        assert get_upload_filename('/foo/a.txt') == 'a.txt'
+        assert get_upload_filename('C:\\foo\\a.txt') == 'a.txt'
+        for name in (None, '', '.', '..', 'foo/', '../..', '..\\..'):
+            assert get_upload_filename(name) == 'upload'
+
+
+class TestCacheControl(object):
+
+    def test_parse_cache_control(self):
+        # we can parse cache control settings
+        assert parse_cache_control(None) == {}
+        assert parse_cache_control(
+            'PDF: public, max-age=60; *: no-cache') == {
+                'pdf': 'public, max-age=60', '*': 'no-cache'}
+        assert parse_cache_control(
+            '\n.html: no-store\nzip:private\n') == {
+                'html': 'no-store', 'zip': 'private'}
+
+    def test_is_not_modified(self, iter_path):
+        # we can tell whether clients have a document already
+        resp = make_response(iter_path, etag='abc')
+        req = Request.blank('http://localhost/')
+        assert is_not_modified(req, resp) is False
+        req.if_none_match = 'abc'
+        assert is_not_modified(req, resp) is True
+        req.if_none_match = 'def'
+        assert is_not_modified(req, resp) is False
+        req = Request.blank('http://localhost/')
+        req.if_modified_since = resp.last_modified
+        assert is_not_modified(req, resp) is True
+
+
 class TestDocConverterFunctional(object):
 
     def test_restful_doc_converter(self):
@@ -144,6 +294,16 @@ class TestDocConverterFunctional(object):
         resp = app(req)
         assert resp.status == "200 OK"
 
+    def test_restful_doc_converter_cache_limits(self, tmpdir):
+        # with cache limits set, a janitor is started
+        app = RESTfulDocConverter(cache_dir=str(tmpdir))
+        assert app.cache_janitor is None
+        app = RESTfulDocConverter(
+            cache_dir=str(tmpdir), cache_max_size='1M')
+        assert app.cache_manager.max_size == 1024 * 1024
+        assert app.cache_janitor.is_alive()
+        app.cache_janitor.stop()
+
     def test_paste_deploy_loader(self, conv_env):
         # we can find the docconverter via paste.deploy plugin
         app = loadapp('config:%s' % (conv_env / "sample1.ini"))
@@ -181,6 +341,340 @@ class TestDocConverterFunctional(object):
         assert resp.headers['Content-Type'] == 'application/zip'
         assert is_zipfile_with_file(conv_env, resp.body)
 
+    def test_create_hashes_upload_once(self, conv_env, monkeypatch):
+        # uploaded docs are hashed while written, not read again
+        from ulif.openoffice import cachemanager, client
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        conv_env.join("sample.pdf").write("Fake result.")
+        monkeypatch.setattr(client, '_process_doc', lambda path, opts: (
+            str(conv_env / "sample.pdf"), dict(error=False)))
+        opened = []
+        orig_open = cachemanager.io.open
+
+        def fake_open(*args, **kw):
+            opened.append(args[0])
+            return orig_open(*args, **kw)
+
+        monkeypatch.setattr(cachemanager.io, 'open', fake_open)
+        req = Request.blank(
+            'http://localhost/docs',
+            POST=dict(doc=('sample.txt', 'Hi there!'), CREATE='Send'))
+        resp = app(req)
+        assert resp.status == "201 Created"
+        assert [x for x in opened if x.endswith('sample.txt')] == []
+
+    def test_create_dot_filename(self, conv_env, monkeypatch):
+        # uploads named like dirs are stored under a safe name
+        from ulif.openoffice import client
+        conv_env.join("sample.pdf").write("Fake result.")
+        names = []
+
+        def fake_process_doc(path, opts):
+            names.append(os.path.basename(path))
+            return str(conv_env / "sample.pdf"), dict(error=False)
+
+        monkeypatch.setattr(client, '_process_doc', fake_process_doc)
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        for name in ('..', '.'):
+            resp = app(Request.blank(
+                'http://localhost/docs', POST=dict(doc=(name, 'Hi!'))))
+            assert resp.status == "201 Created"
+        assert names == ['upload']  # second one from cache
+
+    def test_create_dot_prefixed_filename(self, conv_env, monkeypatch):
+        # uploads named like hidden files can be cached
+        from ulif.openoffice import client
+        conv_env.join(".notes.html").write("<p>Fake result.</p>" * 100)
+        monkeypatch.setattr(client, '_process_doc', lambda path, opts: (
+            str(conv_env / ".notes.html"), dict(error=False)))
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), cache_sidecars='yes')
+        resp = app(Request.blank(
+            'http://localhost/docs', POST=dict(doc=('.notes.doc', 'Hi!'))))
+        assert resp.status == "201 Created"
+        resp = Request.blank(resp.location).get_response(app)
+        assert resp.status == "200 OK"
+        assert resp.body == b"<p>Fake result.</p>" * 100
+
+    def test_create_too_large(self, conv_env):
+        # uploads can be limited in size
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), max_upload_size='1K')
+        req = multipart_request(doc=('sample.txt', 'x' * 2048))
+        assert app(req).status == "413 Request Entity Too Large"
+        # also, if the size is not known in advance
+        req = multipart_request(doc=('sample.txt', 'x' * 2048))
+        req.content_length = None
+        assert app(req).status == "411 Length Required"
+        req.environ['wsgi.input_terminated'] = True
+        assert app(req).status == "413 Request Entity Too Large"
+
+    def test_create_bad_upload(self, conv_env):
+        # uploads without document are rejected
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        req = multipart_request(foo='bar')
+        assert app(req).status == "400 Bad Request"
+        req = Request.blank('http://localhost/docs', POST='doc=foo')
+        assert app(req).status == "400 Bad Request"
+
+    def test_create_async(self, conv_env, monkeypatch):
+        # with a job dir we can convert docs in background
+        from ulif.openoffice import client
+
+        def fake_process_doc(src_doc, options):
+            result_path = str(conv_env.mkdtemp() / "sample.pdf")
+            open(result_path, 'w').write('Fake result.')
+            return result_path, dict(error=False)
+
+        monkeypatch.setattr(client, '_process_doc', fake_process_doc)
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), job_dir=str(conv_env / "jobs"))
+        req = Request.blank(
+            'http://localhost/docs',
+            POST={'doc': ('sample.txt', 'Hi there!'), 'async': '1'})
+        resp = app(req)
+        assert resp.status == "202 Accepted"
+        job_id = resp.json['id']
+        assert resp.location == 'http://localhost:80/docs/%s' % job_id
+        assert resp.json['state'] in ('queued', 'running', 'done')
+        job_url = resp.location
+        for x in range(200):
+            resp = app(Request.blank(job_url))
+            if resp.status_int != 200:
+                break
+            time.sleep(0.01)
+        app.job_queue.stop()
+        # done jobs redirect to results
+        assert resp.status == "303 See Other"
+        assert resp.location == (
+            'http://localhost:80/docs/396199333edbf40ad43e62a1c1397793_1_1')
+        resp = app(Request.blank(
+            'http://localhost/docs/%s' % ('0' * 32)))
+        assert resp.status == "404 Not Found"
+
+    def test_create_async_no_job_dir(self, conv_env, monkeypatch):
+        # w/o job dir, async requests are converted immediately
+        from ulif.openoffice import client
+        conv_env.join("sample.pdf").write("Fake result.")
+        monkeypatch.setattr(client, '_process_doc', lambda path, opts: (
+            str(conv_env / "sample.pdf"), dict(error=False)))
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        assert app.job_queue is None
+        req = Request.blank(
+            'http://localhost/docs',
+            POST={'doc': ('sample.txt', 'Hi there!'), 'async': '1'})
+        resp = app(req)
+        assert resp.status == "201 Created"
+
+    def test_create_overloaded(self, conv_env):
+        # conversions beyond the limits are refused
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), max_conversions='1')
+        app.admission.running = 1
+        req = Request.blank(
+            'http://localhost/docs',
+            POST=dict(doc=('sample.txt', 'Hi there!')))
+        resp = app(req)
+        assert resp.status == "503 Service Unavailable"
+        assert resp.headers['Retry-After'] == '10'
+
+    def test_create_not_modified(self, conv_env, monkeypatch):
+        # clients having a doc already, do not get it again
+        from ulif.openoffice import client
+        conv_env.join("sample.pdf").write("Fake result.")
+        monkeypatch.setattr(client, '_process_doc', lambda path, opts: (
+            str(conv_env / "sample.pdf"), dict(error=False)))
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        req = Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!')))
+        resp = app(req)
+        assert resp.status == "201 Created"
+        req = Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!')))
+        req.if_none_match = resp.etag
+        resp2 = app(req)
+        assert resp2.status == "304 Not Modified"
+        assert resp2.etag == resp.etag
+        assert resp2.location == resp.location
+
+    def fake_process_batch_doc(self, workdir, src_doc, options):
+        # 'convert' docs to PDF, failing for docs named 'bad...'
+        if os.path.basename(src_doc).startswith('bad'):
+            return None, {'error': True, 'error-descr': 'bad doc'}
+        result_path = str(workdir.mkdtemp() / "sample.pdf")
+        with open(result_path, 'wb') as fd:
+            fd.write(b'Result of ' + open(src_doc, 'rb').read())
+        return result_path, dict(error=False)
+
+    def test_batch(self, conv_env, monkeypatch):
+        # we can convert many docs at once, results are streamed as ZIP
+        from ulif.openoffice import client
+        monkeypatch.setattr(
+            client, '_process_doc',
+            lambda *args: self.fake_process_batch_doc(conv_env, *args))
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        req = Request.blank('http://localhost/docs/batch', POST=MultiDict([
+            ('doc', ('sample.txt', 'Hi there!')),
+            ('doc', ('sample.txt', 'Hi again!')),
+            ('doc', ('bad.txt', 'Hi!')), ('out_fmt', 'pdf')]))
+        resp = app(req)
+        assert resp.status == "200 OK"
+        assert resp.content_type == "application/zip"
+        zf = zipfile.ZipFile(BytesIO(resp.body))
+        manifest = [json.loads(line) for line in zf.read(
+            'manifest.ndjson').decode('utf-8').splitlines()]
+        assert len(manifest) == 3
+        results = dict([(x['name'], x) for x in manifest if not x['error']])
+        assert sorted(zf.namelist()) == [
+            'manifest.ndjson', 'sample-1.pdf', 'sample.pdf']
+        assert sorted([x['filename'] for x in manifest if 'filename' in x]
+                      ) == ['sample-1.pdf', 'sample.pdf']
+        assert sorted(
+            [zf.read(x['filename']) for x in manifest if not x['error']]) == [
+            b'Result of Hi again!', b'Result of Hi there!']
+        assert results['sample.txt']['location'].startswith(
+            'http://localhost:80/docs/')
+        assert [x['error-descr'] for x in manifest if x['error']] == [
+            'bad doc']
+        # temporary files were removed
+        assert os.listdir(str(conv_env / "tmp")) == []
+
+    def test_batch_zip_ndjson(self, conv_env, monkeypatch):
+        # docs can be sent as ZIP, results reported as lines of JSON
+        from ulif.openoffice import client
+        monkeypatch.setattr(
+            client, '_process_doc',
+            lambda *args: self.fake_process_batch_doc(conv_env, *args))
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        body = BytesIO()
+        with zipfile.ZipFile(body, 'w') as zf:
+            zf.writestr('dir/', '')
+            zf.writestr('dir/sample.txt', 'Hi there!')
+            zf.writestr('bad.txt', 'Hi!')
+        req = Request.blank(
+            'http://localhost/docs/batch?format=ndjson&out_fmt=pdf',
+            method='POST', body=body.getvalue(),
+            content_type='application/zip')
+        resp = app(req)
+        assert resp.content_type == "application/x-ndjson"
+        lines = sorted([json.loads(x) for x in resp.text.splitlines()],
+                       key=lambda x: x['name'])
+        assert [(x['name'], x['error']) for x in lines] == [
+            ('bad.txt', True), ('sample.txt', False)]
+        assert app.cache_manager.get_cached_file(
+            lines[1]['cache_key']) is not None
+
+    def test_batch_bad_upload(self, conv_env):
+        # bad batches are rejected
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), max_upload_size='1K')
+        req = Request.blank(
+            'http://localhost/docs/batch', method='POST', body=b'foo',
+            content_type='application/zip')
+        assert app(req).status == "400 Bad Request"
+        body = BytesIO()
+        with zipfile.ZipFile(body, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('sample.txt', 'x' * 4096)
+        req = Request.blank(
+            'http://localhost/docs/batch', method='POST',
+            body=body.getvalue(), content_type='application/zip')
+        assert app(req).status == "413 Request Entity Too Large"
+        req = Request.blank('http://localhost/docs/batch', POST=dict(
+            doc=('sample.txt', 'Hi!'), format='xml'))
+        assert app(req).status == "400 Bad Request"
+
+    def test_batch_bad_zip_members(self, conv_env):
+        # corrupt or encrypted ZIP members are rejected
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        body = BytesIO()
+        with zipfile.ZipFile(body, 'w') as zf:
+            zf.writestr('sample.txt', 'Hi there!')
+        corrupt = body.getvalue().replace(b'Hi there!', b'Hi th3re!')
+        # set the 'encrypted' flag in local and central headers
+        encrypted = body.getvalue().replace(
+            b'PK\x03\x04\x14\x00\x00', b'PK\x03\x04\x14\x00\x01').replace(
+            b'PK\x01\x02\x14\x03\x14\x00\x00',
+            b'PK\x01\x02\x14\x03\x14\x00\x01')
+        for data in (corrupt, encrypted):
+            req = Request.blank(
+                'http://localhost/docs/batch', method='POST', body=data,
+                content_type='application/zip')
+            assert app(req).status == "400 Bad Request"
+        assert os.listdir(str(conv_env / "tmp")) == []
+
+    def test_batch_closed(self, conv_env, monkeypatch):
+        # clients going away early leave no files behind
+        from ulif.openoffice import client
+        monkeypatch.setattr(
+            client, '_process_doc',
+            lambda *args: self.fake_process_batch_doc(conv_env, *args))
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), batch_workers=1)
+        req = Request.blank(
+            'http://localhost/docs/batch?format=ndjson', POST=MultiDict([
+                ('doc', ('sample%s.txt' % num, 'Hi %s!' % num))
+                for num in range(5)]))
+        app_iter = app(req).app_iter
+        next(iter(app_iter))
+        app_iter.close()
+        assert os.listdir(str(conv_env / "tmp")) == []
+
+    def test_create_digest_keys(self, conv_env, monkeypatch):
+        # with digest keys, clients can compute locations themselves
+        from ulif.openoffice import client
+        conv_env.join("sample.pdf").write("Fake result.")
+        monkeypatch.setattr(client, '_process_doc', lambda path, opts: (
+            str(conv_env / "sample.pdf"), dict(error=False)))
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), cache_key_scheme='digest')
+        req = Request.blank('http://localhost/docs', POST=dict(
+            doc=('sample.txt', 'Hi!'), out_fmt='pdf'))
+        resp = app(req)
+        assert resp.status == "201 Created"
+        key = get_digest_key(
+            hashlib.sha256(b'Hi!').hexdigest(),
+            get_marker({'oocp-out-fmt': 'pdf'}))
+        assert resp.location == 'http://localhost:80/docs/%s' % key
+        resp = app(Request.blank('http://localhost/docs/%s' % key))
+        assert resp.status == "200 OK"
+        assert resp.body == b'Fake result.'
+
+    def test_lookup(self, conv_env):
+        # we can look up docs by source digests and options
+        app = RESTfulDocConverter(cache_dir=str(conv_env / "cache"))
+        conv_env.join("sample_in.txt").write("Fake source.")
+        conv_env.join("sample_out.pdf").write("Fake result.")
+        src_path = str(conv_env.join("sample_in.txt"))
+        doc_id = app.cache_manager.register_doc(
+            src_path, str(conv_env.join("sample_out.pdf")),
+            repr_key=get_marker({'oocp-out-fmt': 'pdf'}))
+        digests = get_file_digests(src_path, ('md5', 'sha256'))
+        url = 'http://localhost/docs/lookup?digest.md5=%s&digest.sha256=%s' % (
+            digests['md5'], digests['sha256'])
+        resp = app(Request.blank(url + '&oocp-out-fmt=pdf'))
+        assert resp.status == "200 OK"
+        assert resp.body == doc_id.encode('utf-8')
+        assert resp.location == 'http://localhost:80/docs/%s' % doc_id
+        resp = app(Request.blank(
+            url + '&oocp-out-fmt=pdf', environ={'REQUEST_METHOD': 'HEAD'}))
+        assert resp.status == "200 OK"
+        # other options, other docs
+        resp = app(Request.blank(url + '&oocp-out-fmt=html'))
+        assert resp.status == "404 Not Found"
+        assert resp.headers['X-Digest-Algorithms'] == 'md5 sha256'
+        # listeners do not matter
+        resp = app(Request.blank(url + '&oocp-out-fmt=pdf&oocp-port=2003'))
+        assert resp.status == "200 OK"
+        # invalid options are rejected
+        resp = app(Request.blank(url + '&oocp-out-fmt=invalid'))
+        assert resp.status == "400 Bad Request"
+
+    def test_lookup_no_cache(self):
+        # w/o a cache we cannot find anything
+        app = RESTfulDocConverter()
+        resp = app(Request.blank('http://localhost/docs/lookup'))
+        assert resp.status == "404 Not Found"
+
     def test_create_without_cache(self, conv_env):
         # we can convert docs without cache but won't get a GET location
         app = RESTfulDocConverter(cache_dir=None)
@@ -238,3 +732,72 @@ class TestDocConverterFunctional(object):
         resp = app(req)
         assert resp.status == "200 OK"
         assert resp.content_type == "application/pdf"
+
+    def test_show_etag(self, conv_env):
+        # cached docs have stable etags and support conditional GETs
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"),
+            cache_control='pdf: public, max-age=60; *: no-cache')
+        conv_env.join("sample_in.txt").write("Fake source.")
+        conv_env.join("sample_out.pdf").write("Fake result.")
+        doc_id = app.cache_manager.register_doc(
+            str(conv_env.join("sample_in.txt")),
+            str(conv_env.join("sample_out.pdf")))
+        url = 'http://localhost/docs/%s' % doc_id
+        resp = app(Request.blank(url))
+        assert resp.etag == get_file_digest(str(conv_env / "sample_out.pdf"))
+        assert resp.headers['Cache-Control'] == 'public, max-age=60'
+        req = Request.blank(url)
+        req.if_none_match = resp.etag
+        resp = req.get_response(app)
+        assert resp.status == "304 Not Modified"
+        assert resp.body == b''
+        req = Request.blank(url)
+        req.if_modified_since = resp.last_modified
+        assert req.get_response(app).status == "304 Not Modified"
+
+    def test_show_sidecars(self, conv_env):
+        # compressed copies of docs are delivered if acceptable
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), cache_sidecars='yes')
+        conv_env.join("sample_in.txt").write("Fake source.")
+        conv_env.join("sample_out.html").write("<p>Fake result.</p>" * 100)
+        doc_id = app.cache_manager.register_doc(
+            str(conv_env.join("sample_in.txt")),
+            str(conv_env.join("sample_out.html")))
+        url = 'http://localhost/docs/%s' % doc_id
+        req = Request.blank(url)
+        resp = req.get_response(app)
+        assert resp.content_encoding is None
+        assert resp.vary == ('Accept-Encoding', )
+        assert resp.body == b"<p>Fake result.</p>" * 100
+        req = Request.blank(url, headers={'Accept-Encoding': 'gzip'})
+        resp = req.get_response(app)
+        assert resp.content_encoding == 'gzip'
+        assert resp.content_type == 'text/html'
+        assert resp.vary == ('Accept-Encoding', )
+        assert resp.content_length == len(resp.body) < 1900
+        assert resp.etag.endswith('-gzip')
+        resp.decode_content()
+        assert resp.body == b"<p>Fake result.</p>" * 100
+        req = Request.blank(url, headers={'Accept-Encoding': 'identity'})
+        assert req.get_response(app).content_encoding is None
+
+    def test_create_sidecars(self, conv_env, monkeypatch):
+        # converted docs get compressed copies as well
+        from ulif.openoffice import client
+        conv_env.join("sample.html").write("<p>Fake result.</p>" * 100)
+        monkeypatch.setattr(client, '_process_doc', lambda path, opts: (
+            str(conv_env / "sample.html"), dict(error=False)))
+        app = RESTfulDocConverter(
+            cache_dir=str(conv_env / "cache"), cache_sidecars='yes')
+        resp = app(Request.blank(
+            'http://localhost/docs', POST=dict(doc=('sample.txt', 'Hi!'))))
+        assert resp.status == "201 Created"
+        req = Request.blank(
+            resp.location, headers={'Accept-Encoding': 'gzip'})
+        resp = req.get_response(app)
+        assert resp.status == "200 OK"
+        assert resp.content_encoding == 'gzip'
+        resp.decode_content()
+        assert resp.body == b"<p>Fake result.</p>" * 100
@@ -6,7 +6,8 @@ import tempfile
 import unittest
 from paste.deploy import loadapp
 from webob import Request
-from ulif.openoffice.cachemanager import CacheManager
+from ulif.openoffice.cachemanager import (
+    CacheManager, get_file_digests, get_marker)
 from ulif.openoffice.testing import WSGIXMLRPCAppTransport
 from ulif.openoffice.xmlrpc import WSGIXMLRPCApplication
 try:
@@ -82,6 +83,16 @@ class ServerTests(ServerTestsSetup):
         self.result_dir = os.path.dirname(result_path)   # for cleanup
         assert metadata['error'] is False
 
+    def test_convert_locally_overloaded(self):
+        # conversions beyond the limits are refused
+        app = WSGIXMLRPCApplication(max_conversions=1)
+        app.admission.running = 1
+        req = self.xmlrpc_request(
+            'convert_locally', (self.src_path, {}))
+        resp = req.get_response(app)
+        self.assertEqual(resp.status, '503 Service Unavailable')
+        self.assertEqual(resp.headers['Retry-After'], '10')
+
     def test_paste_deploy_loader(self):
         # we can find the xmlrpcapp via paste.deploy plugin
         app = loadapp('config:%s' % self.paste_conf1)
@@ -132,3 +143,18 @@ class ServerProxyTests(ServerTestsSetup):
         assert result_path is not None
         assert result_path != fake_result_path
         assert filecmp.cmp(result_path, fake_result_path, shallow=False)
+
+    def test_get_cached_by_digests(self):
+        # we can get cached docs by source digests and options
+        cm = CacheManager(self.cachedir)
+        fake_result_path = os.path.join(self.src_dir, 'result.txt')
+        with open(fake_result_path, 'w') as fd:
+            fd.write('The Result\n')
+        key = cm.register_doc(self.src_path, fake_result_path,
+                              get_marker({'oocp-out-fmt': 'pdf'}))
+        digests = get_file_digests(self.src_path, ('md5', 'sha256'))
+        result_path, cache_key = self.proxy.get_cached_by_digests(
+            digests, {'oocp-out-fmt': 'pdf'})
+        assert cache_key == key
+        assert filecmp.cmp(result_path, fake_result_path, shallow=False)
+        assert self.proxy.get_cached_by_digests(digests, {}) == [None, None]